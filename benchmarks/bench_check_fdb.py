@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+"""
+bench_check_fdb.py
+
+Times reading the local forwarding database in files/nrpe/check_fdb.py
+from a large recorded dump, and compares it with the shell pipeline it
+replaced:
+
+ * json    get_data_from_fdb() streaming the output of `bridge -j fdb show`
+           into (mac, vni) -> ip entries
+ * legacy  `bridge fdb show | grep dst | grep vxlan | awk ...` through a
+           shell, split line by line into a dict per entry
+
+Both read the same entries: the dump is `bridge -j fdb show` output, and the
+legacy pipeline reads it rendered the way `bridge fdb show` prints it. For
+each the wall time, CPU time of the child processes, peak memory allocated
+by the script (tracemalloc, in a second run) and the entries read are
+recorded. Without --dump a synthetic dump of a network node is generated:
+
+    ./bench_check_fdb.py --entries 500000 -o fdb.json
+    bridge -j fdb show > recorded.json
+    ./bench_check_fdb.py --dump recorded.json
+"""
+
+import argparse
+import json
+import os
+import os.path
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NRPE_DIR = os.path.join(os.path.dirname(BENCH_DIR), "files", "nrpe")
+sys.path.insert(0, NRPE_DIR)
+
+import check_fdb  # noqa: E402
+
+LEGACY_PIPELINE = """cat %s | grep dst | grep vxlan | awk '{ print $1" "substr($3,7)" "$5 }'"""
+
+
+def synthetic_entries(entries, vnis, hosts, seed):
+    """
+    FDB of a network node: a unicast entry per remote port, flooding entries
+    to every host for each VNI and local entries without a destination
+    """
+    rnd = random.Random(seed)
+    tunnel_ips = ["10.%d.%d.%d" % (i // 65536, i // 256 % 256, i % 256 + 1)
+                  for i in range(hosts)]
+    fdb = []
+    for vni in range(1, vnis + 1):
+        for ip in rnd.sample(tunnel_ips, min(4, hosts)):
+            fdb.append({"mac": "00:00:00:00:00:00", "ifname": "vxlan-%d" % vni,
+                        "dst": ip, "flags": ["self"], "state": "permanent"})
+    macs = rnd.sample(range(2 ** 24), entries)
+    for index, mac in enumerate(macs):
+        address = "fa:16:3e:%02x:%02x:%02x" % (mac >> 16, mac >> 8 & 255, mac & 255)
+        if index % 10 == 0:
+            fdb.append({"mac": address, "ifname": "tap%06x" % mac,
+                        "master": "brq%06x" % mac, "state": ""})
+        else:
+            fdb.append({"mac": address, "ifname": "vxlan-%d" % rnd.randint(1, vnis),
+                        "dst": rnd.choice(tunnel_ips), "flags": ["self"],
+                        "state": "permanent"})
+    return fdb
+
+
+def text_line(entry):
+    """
+    The entry as `bridge fdb show` prints it
+    """
+    line = "%s dev %s" % (entry["mac"], entry["ifname"])
+    if "dst" in entry:
+        line += " dst %s" % entry["dst"]
+    if "master" in entry:
+        line += " master %s" % entry["master"]
+    line += "".join(" " + flag for flag in entry.get("flags", []))
+    if entry.get("state"):
+        line += " " + entry["state"]
+    return line + "\n"
+
+
+def legacy_read(text_path):
+    """
+    The text pipeline as it was before, kept here as the baseline
+    """
+    fdb_data = {}
+    output = subprocess.run(
+        LEGACY_PIPELINE % text_path,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=False
+    )
+    for line in output.stdout.split('\n')[:-1]:
+        pieces = line.split(' ')
+        if pieces[0] not in check_fdb.EXCLUDED_MACS:
+            key = pieces[0] + "_" + pieces[1]
+            assert key not in fdb_data.keys()
+            fdb_data[key] = {}
+            fdb_data[key]['mac_address'] = pieces[0]
+            fdb_data[key]['vxlan_id'] = pieces[1]
+            fdb_data[key]['ip_address'] = pieces[2]
+    return fdb_data
+
+
+def json_read(json_path):
+    fdb_data = {}
+    exit_code = check_fdb.get_data_from_fdb(fdb_data, ["cat", json_path])
+    assert exit_code == check_fdb.NAGIOS_STATE_OK
+    return fdb_data
+
+
+def child_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(name, read, path):
+    started = time.time()
+    cpu = child_cpu()
+    fdb_data = read(path)
+    seconds = time.time() - started
+    cpu = child_cpu() - cpu
+    # Memory in a second run, tracemalloc slows allocations down
+    tracemalloc.start()
+    read(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    sys.stderr.write("%-7s %.3fs children=%.3fs peak=%.1fMB entries=%d\n" % (
+        name, seconds, cpu, peak / 1048576.0, len(fdb_data)))
+    return {"reader": name, "seconds": seconds, "child_cpu_seconds": cpu,
+            "peak_bytes": peak, "entries": len(fdb_data)}, fdb_data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fdb reader of check_fdb.py on a large dump.")
+    parser.add_argument("--dump", help="recorded `bridge -j fdb show` output "
+                        "(default: a synthetic dump)")
+    parser.add_argument("--entries", type=int, default=500000,
+                        help="entries of the synthetic dump (default 500000)")
+    parser.add_argument("--vnis", type=int, default=2000,
+                        help="VNIs of the synthetic dump (default 2000)")
+    parser.add_argument("--hosts", type=int, default=1000,
+                        help="tunnel endpoints of the synthetic dump (default 1000)")
+    parser.add_argument("--seed", type=int, default=4711,
+                        help="random seed for the synthetic dump")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_fdb_")
+    try:
+        if args.dump:
+            with open(args.dump) as dump:
+                fdb = json.load(dump)
+        else:
+            fdb = synthetic_entries(args.entries, args.vnis, args.hosts, args.seed)
+        json_path = os.path.join(workdir, "fdb.json")
+        text_path = os.path.join(workdir, "fdb.txt")
+        with open(json_path, "w") as output:
+            json.dump(fdb, output, separators=(",", ":"))
+        with open(text_path, "w") as output:
+            output.writelines(text_line(entry) for entry in fdb)
+        dump_size = len(fdb)
+        del fdb
+
+        (json_result, json_data) = measure("json", json_read, json_path)
+        (legacy_result, legacy_data) = measure("legacy", legacy_read, text_path)
+        # The legacy reader keeps its dict per entry under a string key
+        legacy_compact = dict(((entry['mac_address'], entry['vxlan_id']), entry['ip_address'])
+                              for entry in legacy_data.values())
+        if json_data != legacy_compact:
+            sys.stderr.write("MISMATCH: json and legacy readers differ\n")
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        "meta": {"dump": args.dump, "dump_entries": dump_size,
+                 "entries": args.entries, "vnis": args.vnis,
+                 "hosts": args.hosts, "seed": args.seed},
+        "results": [json_result, legacy_result],
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
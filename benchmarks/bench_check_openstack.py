@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+"""
+bench_check_openstack.py
+
+Runs every check_openstack.py command against the local fake OpenStack API
+(fake_openstack.py) and records, per command:
+
+ * wall time of the check process
+ * peak RSS of the check process
+ * number of API requests it made
+ * number of response bytes it received
+
+Results are written as JSON so runs from two commits can be compared:
+
+    ./bench_check_openstack.py --servers 50000 --hypervisors 2000 \\
+        --ports 200000 --aggregates 100 -o before.json
+    ./bench_check_openstack.py ... -o after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_openstack
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NRPE_DIR = os.path.join(os.path.dirname(BENCH_DIR), "files", "nrpe")
+CHECK_OPENSTACK = os.path.join(NRPE_DIR, "check_openstack.py")
+
+# Commands that cannot be exercised against the fake API, with the reason
+SKIPPED_COMMANDS = {
+    "ghostinstance": "needs ssh access to the compute nodes",
+    "ghostvolumessh": "needs ssh access to the storage nodes",
+    "barbican": "barbican is not served by the fake API",
+    "magnum": "magnum is not served by the fake API",
+}
+
+# Extra arguments needed to run a command offline
+COMMAND_ARGUMENTS = {
+    "instance": ["--no-ping"],
+}
+
+# Commands that refuse to run with admin credentials
+NON_ADMIN_COMMANDS = ["instance"]
+
+
+def os_check_commands():
+    """
+    Return the command names of the check_openstack.py registry. The module
+    is imported in a throwaway interpreter to keep the OpenStack clients out
+    of this process's memory.
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c",
+         "import check_openstack; print(' '.join(sorted(check_openstack.OS_CHECK)))"],
+        cwd=NRPE_DIR, universal_newlines=True)
+    return output.split()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def check_command_line(fake, command, extra_args=()):
+    username = fake_openstack.ADMIN_USER
+    if command in NON_ADMIN_COMMANDS:
+        username = fake_openstack.NAGIOS_USER
+    return [sys.executable, CHECK_OPENSTACK,
+            "--auth_url", fake.base_url + "/identity/v3",
+            "--username", username,
+            "--password", fake_openstack.ADMIN_PASSWORD,
+            "--tenant", fake_openstack.AUTH_PROJECT,
+            "--domain", "default",
+            "--milliseconds"] + COMMAND_ARGUMENTS.get(command, []) + \
+        list(extra_args) + [command]
+
+
+def run_check(fake, command, timeout, extra_args=()):
+    """
+    Run one check in a child process and return its measurements. The fake
+    API counters are reset first so they only cover this check. The child is
+    reaped with wait4() so its own peak RSS is known, rather than the maximum
+    over all children that getrusage() would give.
+    """
+    fake.reset()
+    with tempfile.TemporaryFile() as output:
+        started = time.time()
+        process = subprocess.Popen(check_command_line(fake, command, extra_args),
+                                   cwd=NRPE_DIR, stdout=output,
+                                   stderr=subprocess.STDOUT)
+        killer = threading.Timer(timeout, process.kill)
+        killer.start()
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        finally:
+            killer.cancel()
+        wall = time.time() - started
+        # Keep Popen from trying to reap the child a second time
+        process.returncode = os.waitstatus_to_exitcode(status)
+        output.seek(0)
+        lines = output.read().decode("utf-8", "replace").strip().splitlines()
+    stats = fake.stats()
+    timed_out = process.returncode == -signal.SIGKILL
+    return {
+        "command": command,
+        "exit_code": None if timed_out else process.returncode,
+        "timed_out": timed_out,
+        "wall_seconds": round(wall, 4),
+        "peak_rss_kb": rusage.ru_maxrss,
+        "requests": stats["requests"],
+        "bytes_received": stats["bytes"],
+        "per_endpoint": stats["per_endpoint"],
+        "output": lines[-1] if lines else "",
+    }
+
+
+def compare(old, new):
+    """
+    Print per command ratios between two result files.
+    """
+    old_results = dict((r["command"], r) for r in old["results"])
+    print("%-18s %12s %12s %12s %12s" % ("command", "wall", "rss", "requests", "bytes"))
+    for result in new["results"]:
+        before = old_results.get(result["command"])
+        if before is None:
+            continue
+        row = [result["command"]]
+        for key in ("wall_seconds", "peak_rss_kb", "requests", "bytes_received"):
+            if before.get(key) and result.get(key) is not None:
+                row.append("%11.2fx" % (float(result[key]) / before[key]))
+            else:
+                row.append("%12s" % "-")
+        print("%-18s %s %s %s %s" % tuple(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark check_openstack.py commands against a fake OpenStack API.")
+    parser.add_argument("-c", "--commands", nargs="+",
+                        help="commands to run (default: every command in the registry)")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="print ratios against an earlier result file")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="seconds before a check is killed")
+    fake_openstack.add_dataset_arguments(parser)
+    args = parser.parse_args()
+
+    commands = args.commands or [c for c in os_check_commands()
+                                 if c not in SKIPPED_COMMANDS]
+    fake = fake_openstack.FakeOpenStackProcess(args)
+
+    results = []
+    try:
+        for command in commands:
+            result = run_check(fake, command, args.timeout)
+            results.append(result)
+            sys.stderr.write("%-18s exit=%s wall=%.2fs rss=%skB requests=%d bytes=%d\n" % (
+                command, result["exit_code"], result["wall_seconds"],
+                result["peak_rss_kb"], result["requests"], result["bytes_received"]))
+    finally:
+        fake.stop()
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "python": platform.python_version(),
+            "dataset": fake.sizes,
+            "latency_ms": args.latency_ms,
+            "skipped": dict((c, r) for c, r in SKIPPED_COMMANDS.items()
+                            if not args.commands),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), report)
+
+
+if __name__ == "__main__":
+    main()
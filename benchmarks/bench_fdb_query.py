@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+"""
+bench_fdb_query.py
+
+Measures the database query of files/nrpe/check_fdb.py against a local
+MariaDB loaded with a synthetic cloud, comparing:
+
+ * all     QUERY for every vxlan port in the cloud, as every node used to run
+ * local   QUERY restricted to the vxlan ids of one compute node, in batches
+           of QUERY_BATCH_SIZE ids, as check_fdb.py runs it now
+
+For each the median query time over --repeat runs, the rows returned, of
+them the rows of active ports, and the bytes the server sent are
+recorded. The dataset goes into the `nova`
+and `neutron` schemas, with the tables and indexes the query uses. Those
+schemas must not exist yet, so point it at a scratch server only:
+
+    ./bench_fdb_query.py -d 127.0.0.1 -u root -p secret --instances 200000 \\
+        --networks 5000 --hosts 1000 -o fdb_query.json
+
+--keep leaves the dataset loaded, and --reuse runs against a dataset kept
+by an earlier run.
+"""
+
+import argparse
+import json
+import os.path
+import random
+import sys
+import time
+import uuid
+
+import MySQLdb
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NRPE_DIR = os.path.join(os.path.dirname(BENCH_DIR), "files", "nrpe")
+sys.path.insert(0, NRPE_DIR)
+
+import check_fdb  # noqa: E402
+
+SCHEMA = [
+    "CREATE DATABASE nova",
+    "CREATE DATABASE neutron",
+    "CREATE TABLE nova.instances ("
+    " id INT AUTO_INCREMENT PRIMARY KEY,"
+    " uuid VARCHAR(36) NOT NULL,"
+    " host VARCHAR(255),"
+    " deleted_at DATETIME,"
+    " UNIQUE KEY uniq_instances0uuid (uuid),"
+    " KEY instances_host_deleted_idx (host, deleted_at))",
+    "CREATE TABLE neutron.agents ("
+    " id VARCHAR(36) PRIMARY KEY,"
+    " host VARCHAR(255) NOT NULL,"
+    " configurations VARCHAR(4095) NOT NULL,"
+    " KEY ix_agents_host (host))",
+    "CREATE TABLE neutron.ports ("
+    " id VARCHAR(36) PRIMARY KEY,"
+    " network_id VARCHAR(36) NOT NULL,"
+    " mac_address VARCHAR(32) NOT NULL,"
+    " device_id VARCHAR(255) NOT NULL,"
+    " status VARCHAR(16) NOT NULL,"
+    " UNIQUE KEY uniq_ports0network_id0mac_address (network_id, mac_address),"
+    " KEY ix_ports_device_id (device_id))",
+    "CREATE TABLE neutron.networksegments ("
+    " id VARCHAR(36) PRIMARY KEY,"
+    " network_id VARCHAR(36) NOT NULL,"
+    " network_type VARCHAR(32) NOT NULL,"
+    " segmentation_id INT,"
+    " KEY ix_networksegments_network_id (network_id))",
+]
+
+INSERT_BATCH = 5000
+
+
+def insert(cur, statement, rows):
+    for start in range(0, len(rows), INSERT_BATCH):
+        cur.executemany(statement, rows[start:start + INSERT_BATCH])
+
+
+def load_dataset(conn, instances, networks, hosts, seed):
+    rnd = random.Random(seed)
+
+    def new_id():
+        return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+    cur = conn.cursor()
+    for statement in SCHEMA:
+        cur.execute(statement)
+    host_names = ["compute-%05d" % i for i in range(hosts)]
+    insert(cur, "INSERT INTO neutron.agents VALUES (%s, %s, %s)",
+           [(new_id(), host,
+             json.dumps({"tunneling_ip": "10.%d.%d.%d" % (i // 65536, i // 256 % 256,
+                                                          i % 256 + 1)}))
+            for i, host in enumerate(host_names)])
+    network_ids = [new_id() for _ in range(networks)]
+    # A few flat and vlan networks besides the vxlan ones
+    insert(cur, "INSERT INTO neutron.networksegments VALUES (%s, %s, %s, %s)",
+           [(new_id(), network_id, "vxlan" if i % 20 else "vlan", i + 1)
+            for i, network_id in enumerate(network_ids)])
+    instance_rows = []
+    port_rows = []
+    for i in range(instances):
+        instance = new_id()
+        deleted = "2026-01-01 00:00:00" if rnd.random() < 0.1 else None
+        instance_rows.append((instance, rnd.choice(host_names), deleted))
+        mac = "fa:16:3e:%02x:%02x:%02x" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        # Ports of stopped instances are down and expected out of the fdb
+        status = "DOWN" if rnd.random() < 0.15 else "ACTIVE"
+        port_rows.append((new_id(), rnd.choice(network_ids), mac, instance, status))
+    insert(cur, "INSERT INTO nova.instances (uuid, host, deleted_at) "
+           "VALUES (%s, %s, %s)", instance_rows)
+    insert(cur, "INSERT INTO neutron.ports VALUES (%s, %s, %s, %s, %s)", port_rows)
+    conn.commit()
+
+
+def local_vxlan_ids(cur, host):
+    """
+    The vxlan ids a compute node has in its fdb: those of the networks
+    of its own instances
+    """
+    cur.execute("SELECT DISTINCT networksegments.segmentation_id "
+                "FROM nova.instances "
+                "INNER JOIN neutron.ports ON instances.uuid = ports.device_id "
+                "INNER JOIN neutron.networksegments "
+                "ON ports.network_id = networksegments.network_id "
+                "WHERE instances.host = %s AND instances.deleted_at IS NULL "
+                "AND networksegments.network_type = 'vxlan'", (host,))
+    return set(str(row[0]) for row in cur)
+
+
+def bytes_sent(cur):
+    cur.execute("SHOW SESSION STATUS LIKE 'Bytes_sent'")
+    return int(cur.fetchone()[1])
+
+
+def run_queries(cur, queries):
+    sent = bytes_sent(cur)
+    started = time.time()
+    rows = 0
+    active = 0
+    for query, parameters in queries:
+        cur.execute(query, parameters)
+        for row in cur.fetchall():
+            rows += 1
+            # the port status check_fdb.py tells missing entries apart by
+            active += row[4] == 'ACTIVE'
+    seconds = time.time() - started
+    return seconds, rows, bytes_sent(cur) - sent, active
+
+
+def measure(name, cur, queries, repeat):
+    # Bytes of the status queries themselves, measured by an empty run
+    overhead = run_queries(cur, [])[2]
+    runs = [run_queries(cur, queries) for _ in range(repeat)]
+    seconds = sorted(run[0] for run in runs)[len(runs) // 2]
+    (rows, sent, active) = (runs[0][1], runs[0][2] - overhead, runs[0][3])
+    sys.stderr.write("%-6s %.3fs rows=%d active=%d bytes=%d queries=%d\n" % (
+        name, seconds, rows, active, sent, len(queries)))
+    return {"query": name, "seconds": seconds, "rows": rows,
+            "active_rows": active, "bytes_sent": sent, "queries": len(queries)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the database query of check_fdb.py on a local MariaDB.")
+    parser.add_argument("-d", "--database", default="127.0.0.1",
+                        help="scratch MariaDB server (default 127.0.0.1)")
+    parser.add_argument("-u", "--user", default="root", help="database user")
+    parser.add_argument("-p", "--password", default="", help="database password")
+    parser.add_argument("--instances", type=int, default=200000,
+                        help="synthetic instances, one port each (default 200000)")
+    parser.add_argument("--networks", type=int, default=5000,
+                        help="synthetic networks (default 5000)")
+    parser.add_argument("--hosts", type=int, default=1000,
+                        help="synthetic compute hosts (default 1000)")
+    parser.add_argument("--seed", type=int, default=4712,
+                        help="random seed for the synthetic dataset")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs of each query, the median time is reported")
+    parser.add_argument("--keep", action="store_true",
+                        help="leave the dataset loaded")
+    parser.add_argument("--reuse", action="store_true",
+                        help="use the dataset kept by an earlier run")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    conn = MySQLdb.connect(host=args.database, user=args.user,
+                           password=args.password)
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM information_schema.schemata "
+                "WHERE schema_name IN ('nova', 'neutron')")
+    existing = cur.fetchone()[0]
+    if existing and not args.reuse:
+        sys.exit("nova or neutron schema exists, refusing to touch it "
+                 "(use --reuse for a dataset kept with --keep)")
+    if not existing and args.reuse:
+        sys.exit("no dataset to reuse")
+    try:
+        if not args.reuse:
+            started = time.time()
+            load_dataset(conn, args.instances, args.networks, args.hosts, args.seed)
+            sys.stderr.write("dataset loaded in %.1fs\n" % (time.time() - started))
+        vxlan_ids = local_vxlan_ids(cur, "compute-00000")
+        results = [measure("all", cur, check_fdb.vxlan_id_queries(None), args.repeat),
+                   measure("local", cur, check_fdb.vxlan_id_queries(vxlan_ids),
+                           args.repeat)]
+    finally:
+        if not args.keep and not args.reuse:
+            cur.execute("DROP DATABASE IF EXISTS nova")
+            cur.execute("DROP DATABASE IF EXISTS neutron")
+        conn.close()
+
+    report = {
+        "meta": {"instances": args.instances, "networks": args.networks,
+                 "hosts": args.hosts, "seed": args.seed, "repeat": args.repeat,
+                 "local_vxlan_ids": len(vxlan_ids)},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+"""
+bench_s3_transport.py
+
+Compares the plain boto S3Connection with the pooled S3Transport of
+files/nrpe/check_object.py on small GETs against the local fake S3 API
+(fake_s3.py). Each mode fetches the same small object --requests times:
+
+ * boto-cold    a new S3Connection per request, as the checks used to do
+ * boto-warm    one S3Connection for all requests
+ * pooled-cold  a new S3Transport per request
+ * pooled-warm  one S3Transport shared by all requests, like the checks
+
+and records mean, p50 and p95 request latency, the connections the fake
+server accepted and, for pooled-warm, the phase totals of the
+transport. --connect-latency-ms stands in for the TCP and TLS handshake
+round trips of a remote endpoint:
+
+    ./bench_s3_transport.py --requests 200 --connect-latency-ms 20 -o s3.json
+"""
+
+import argparse
+import json
+import os.path
+import sys
+import time
+
+import fake_s3
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NRPE_DIR = os.path.join(os.path.dirname(BENCH_DIR), "files", "nrpe")
+sys.path.insert(0, NRPE_DIR)
+
+import check_object  # noqa: E402
+
+BUCKET = "bench-transport"
+KEY = "small-object"
+MODES = ["boto-cold", "boto-warm", "pooled-cold", "pooled-warm"]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def connection_factory(url, mode):
+    """
+    Return a function giving the S3Connection for the next request, and the
+    transport of the pooled modes
+    """
+    arguments = check_object.s3_host_arguments(url)
+    arguments.update(aws_access_key_id="bench", aws_secret_access_key="bench")
+    if mode.startswith("boto"):
+        def boto_connection():
+            return check_object.S3Connection(**arguments)
+        transport = None
+        factory = boto_connection
+    else:
+        transport = check_object.S3Transport()
+
+        def pooled_connection():
+            if mode == "pooled-cold":
+                return check_object.PooledS3Connection(check_object.S3Transport(),
+                                                       **arguments)
+            return check_object.PooledS3Connection(transport, **arguments)
+        factory = pooled_connection
+    if mode.endswith("warm"):
+        shared = factory()
+        return (lambda: shared), transport
+    return factory, transport
+
+
+def run_mode(fake, mode, requests):
+    factory, transport = connection_factory(fake.url, mode)
+    # One request outside the measurement warms up the shared connection
+    factory().get_bucket(BUCKET, validate=False).get_key(KEY).get_contents_as_string()
+    fake.reset()
+    if transport is not None:
+        transport.totals.clear()
+        transport.counts.clear()
+    samples = []
+    for _ in range(requests):
+        started = time.time()
+        key = factory().get_bucket(BUCKET, validate=False).get_key(KEY)
+        key.get_contents_as_string()
+        samples.append(time.time() - started)
+    server = fake.stats()
+    result = {
+        "mode": mode,
+        "requests": requests,
+        "mean_ms": 1000.0 * sum(samples) / len(samples),
+        "p50_ms": 1000.0 * percentile(samples, 0.50),
+        "p95_ms": 1000.0 * percentile(samples, 0.95),
+        "server_requests": server["requests"],
+        # Less the connection of the /_stats request itself
+        "server_connections": server["connections"] - 1,
+    }
+    if transport is not None and mode == "pooled-warm":
+        result["phase_ms"] = dict((name, 1000.0 * seconds)
+                                  for name, seconds in transport.totals.items())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pooled S3 transport of check_object.py against a fake S3 API.")
+    parser.add_argument("-n", "--requests", type=int, default=200,
+                        help="GET requests per mode")
+    parser.add_argument("-s", "--object-size", type=int, default=4096,
+                        help="size of the object in bytes")
+    parser.add_argument("-m", "--modes", nargs="+", choices=MODES, default=MODES,
+                        help="modes to run (default: all)")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="added latency per request in milliseconds")
+    parser.add_argument("--connect-latency-ms", type=float, default=0.0,
+                        help="added latency per new connection in milliseconds")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    fake = fake_s3.FakeS3Process(args.latency_ms, args.connect_latency_ms)
+    results = []
+    try:
+        setup = check_object.S3Connection(
+            aws_access_key_id="bench", aws_secret_access_key="bench",
+            **check_object.s3_host_arguments(fake.url))
+        bucket = setup.create_bucket(BUCKET)
+        bucket.new_key(KEY).set_contents_from_string(b"x" * args.object_size)
+        for mode in args.modes:
+            result = run_mode(fake, mode, args.requests)
+            results.append(result)
+            sys.stderr.write("%-12s mean=%.2fms p50=%.2fms p95=%.2fms connections=%d\n" % (
+                mode, result["mean_ms"], result["p50_ms"], result["p95_ms"],
+                result["server_connections"]))
+    finally:
+        fake.stop()
+
+    report = {
+        "meta": {
+            "object_size": args.object_size,
+            "latency_ms": args.latency_ms,
+            "connect_latency_ms": args.connect_latency_ms,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+"""
+bench_usage_stats.py
+
+Times the user/VM join of files/nrpe/check_openstack_usage_stats.py on a
+synthetic cloud held in memory, without any API traffic, and compares it
+with the list based join it replaced:
+
+ * wall time of the join
+ * peak memory allocated during the join (tracemalloc, in a second run)
+
+The clients are small in-process stand-ins that only answer the calls the
+join makes, building new user and server objects for every call like the
+real clients do, so the numbers are those of the join itself:
+
+    ./bench_usage_stats.py --users 100000 --servers 50000 -o usage.json
+
+The legacy join is quadratic; --no-legacy skips it on large datasets.
+"""
+
+import argparse
+import json
+import os.path
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NRPE_DIR = os.path.join(os.path.dirname(BENCH_DIR), "files", "nrpe")
+sys.path.insert(0, NRPE_DIR)
+
+import check_openstack_usage_stats as usage  # noqa: E402
+
+EMAIL_SUFFIXES = ["@csc.fi", "@helsinki.fi", "@aalto.fi", "@example.org",
+                  "@localhost"]
+DOMAINS = ["default", "users"]
+
+
+def copies(items):
+    """
+    New objects for every call, like a client parsing an API response
+    """
+    return [SimpleNamespace(**vars(item)) for item in items]
+
+
+class Keystone(object):
+    def __init__(self, users):
+        self.users_by_domain = {}
+        for user in users:
+            self.users_by_domain.setdefault(user.domain_id, []).append(user)
+        self.domains = SimpleNamespace(
+            find=lambda name: SimpleNamespace(id=name, name=name))
+        self.users = SimpleNamespace(
+            list=lambda domain: copies(self.users_by_domain.get(domain, [])))
+
+
+class Nova(object):
+    def __init__(self, servers):
+        self.all_servers = servers
+        self.servers = SimpleNamespace(list=self.list_servers)
+
+    def list_servers(self, search_opts=None, limit=None, marker=None):
+        start = 0
+        if marker is not None:
+            start = self.index[marker] + 1
+        if limit is None:
+            return copies(self.all_servers[start:])
+        return copies(self.all_servers[start:start + limit])
+
+    @property
+    def index(self):
+        if not hasattr(self, "_index"):
+            self._index = dict((s.id, i) for i, s in enumerate(self.all_servers))
+        return self._index
+
+
+def build_cloud(users, servers, flavors, seed):
+    rnd = random.Random(seed)
+    user_list = []
+    for i in range(users):
+        name = ("trng%06d" if rnd.random() < 0.05 else "user%06d") % i
+        user = SimpleNamespace(id=str(uuid.UUID(int=rnd.getrandbits(128))),
+                               name=name, domain_id=rnd.choice(DOMAINS))
+        if rnd.random() > 0.02:
+            user.email = name + rnd.choice(EMAIL_SUFFIXES)
+        user_list.append(user)
+    # Embedded flavor details as of compute API 2.47, plus the id the
+    # legacy join counts by
+    flavor_list = [{"id": str(uuid.UUID(int=rnd.getrandbits(128))),
+                    "original_name": "standard.%d" % i, "vcpus": 2 ** (i % 6),
+                    "ram": 2048 * 2 ** (i % 6)} for i in range(flavors)]
+    server_list = []
+    for i in range(servers):
+        # A few servers belong to users of other domains or deleted users
+        owner = rnd.choice(user_list).id if rnd.random() > 0.05 else \
+            str(uuid.UUID(int=rnd.getrandbits(128)))
+        server_list.append(SimpleNamespace(
+            id=str(uuid.UUID(int=rnd.getrandbits(128))), user_id=owner,
+            tenant_id=str(uuid.UUID(int=rnd.getrandbits(128))), status="ACTIVE",
+            flavor=rnd.choice(flavor_list)))
+    return Keystone(user_list), Nova(server_list)
+
+
+def legacy_join(keystone, nova, domain):
+    """
+    The join as it was before, kept here as the baseline
+    """
+    all_servers = nova.servers.list(search_opts={'all_tenants': True})
+    user_domain_id = keystone.domains.find(name=domain).id
+    all_users = keystone.users.list(domain=user_domain_id)
+    users = list(filter(lambda user: 'trng' not in user.name, all_users))
+    users = list(filter(lambda user: hasattr(user, 'email'), users))
+    users = list(filter(lambda user: '@localhost' not in user.email, users))
+    vm_user_ids = list(map(lambda x: x.user_id, all_servers))
+    csc_users = list(filter(lambda user: '@csc.fi' in user.email, users))
+    csc_user_ids = list(map(lambda x: x.id, csc_users))
+    csc_vm_users = list()
+    for user_id in vm_user_ids:
+        if user_id in csc_user_ids:
+            csc_vm_users.append(user_id)
+    flavor_id_dict = dict()
+    for server in all_servers:
+        flavor = server.flavor['id']
+        flavor_id_dict[flavor] = flavor_id_dict.get(flavor, 0) + 1
+    return {"total_number_of_vms": len(all_servers),
+            "users_with_vms": len(set(vm_user_ids)),
+            "total_number_of_users": len(users),
+            "num_vms_by_csc_users": len(csc_vm_users),
+            "num_csc_users_with_vm": len(set(csc_vm_users))}
+
+
+def indexed_join(keystone, nova, domain):
+    user_index = usage.get_user_index(keystone, [domain], ["csc.fi"])
+    servers = (usage.server_record(s) for s in usage.get_all_servers(nova))
+    results, flavor_counts = usage.get_user_vm_usage(
+        servers, user_index, [domain], ["csc.fi"])
+    return results
+
+
+def measure(name, join, keystone, nova, domain):
+    started = time.time()
+    results = join(keystone, nova, domain)
+    seconds = time.time() - started
+    # Memory in a second run, tracemalloc slows allocations down
+    tracemalloc.start()
+    join(keystone, nova, domain)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    sys.stderr.write("%-8s %.3fs peak=%.1fMB\n" % (name, seconds, peak / 1048576.0))
+    return {"join": name, "seconds": seconds, "peak_bytes": peak,
+            "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the user/VM join of check_openstack_usage_stats.py.")
+    parser.add_argument("--users", type=int, default=100000,
+                        help="number of synthetic users (default 100000)")
+    parser.add_argument("--servers", type=int, default=50000,
+                        help="number of synthetic servers (default 50000)")
+    parser.add_argument("--flavors", type=int, default=40,
+                        help="number of synthetic flavors (default 40)")
+    parser.add_argument("--seed", type=int, default=4667,
+                        help="random seed for the synthetic dataset")
+    parser.add_argument("--no-legacy", dest="legacy", action="store_false",
+                        help="skip the quadratic legacy join")
+    parser.add_argument("-o", "--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    keystone, nova = build_cloud(args.users, args.servers, args.flavors, args.seed)
+    # Build the marker index of the paging stand-in before the clock starts
+    nova.index
+    runs = [measure("indexed", indexed_join, keystone, nova, "default")]
+    if args.legacy:
+        runs.append(measure("legacy", legacy_join, keystone, nova, "default"))
+        for key, value in runs[1]["results"].items():
+            if runs[0]["results"][key] != value:
+                sys.stderr.write("MISMATCH %s: indexed %s legacy %s\n" % (
+                    key, runs[0]["results"][key], value))
+
+    report = {
+        "meta": {"users": args.users, "servers": args.servers,
+                 "flavors": args.flavors, "seed": args.seed},
+        "results": runs,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+check_api_budget.py
+
+Regression test for the number of API requests each check command makes.
+Every command with an entry in OS_CHECK_API_BUDGET (check_openstack.py) is
+run against the fake OpenStack API at two dataset sizes. The test fails when
+a command needs more requests than its budget at either size, which is what
+happens as soon as a per-item API call slips into a check.
+
+    ./check_api_budget.py            # default sizes and 10x those
+    ./check_api_budget.py --scale 50 -c l3agent capacity
+
+Exits 0 when every command is within budget and 1 otherwise.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+import bench_check_openstack
+import fake_openstack
+
+
+def budget_table():
+    """
+    Return OS_CHECK_API_BUDGET, read in a throwaway interpreter like the
+    command registry in bench_check_openstack.py.
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c",
+         "import json, check_openstack; print(json.dumps(check_openstack.OS_CHECK_API_BUDGET))"],
+        cwd=bench_check_openstack.NRPE_DIR, universal_newlines=True)
+    return json.loads(output)
+
+
+def dataset_arguments(scale, latency_ms=0.0, seed=4667):
+    sizes = dict((key, value * scale) for key, value in fake_openstack.DEFAULT_SIZES.items())
+    return argparse.Namespace(latency_ms=latency_ms, seed=seed, **sizes)
+
+
+def count_requests(commands, scale, timeout):
+    fake = fake_openstack.FakeOpenStackProcess(dataset_arguments(scale))
+    counts = {}
+    try:
+        for command in commands:
+            result = bench_check_openstack.run_check(fake, command, timeout)
+            counts[command] = result
+    finally:
+        fake.stop()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that API request counts stay within their budget.")
+    parser.add_argument("-c", "--commands", nargs="+",
+                        help="commands to check (default: every budgeted command)")
+    parser.add_argument("--scale", type=int, default=10,
+                        help="size multiplier of the large dataset (default 10)")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="seconds before a check is killed")
+    args = parser.parse_args()
+
+    budgets = budget_table()
+    commands = args.commands or sorted(budgets)
+    small = count_requests(commands, 1, args.timeout)
+    large = count_requests(commands, args.scale, args.timeout)
+
+    failures = []
+    print("%-18s %8s %8s %8s" % ("command", "budget", "small", "x%d" % args.scale))
+    for command in commands:
+        budget = budgets.get(command)
+        counts = (small[command]["requests"], large[command]["requests"])
+        print("%-18s %8s %8d %8d" % (command, budget, counts[0], counts[1]))
+        if budget is None:
+            failures.append("%s: no budget in OS_CHECK_API_BUDGET" % command)
+        elif max(counts) > budget:
+            endpoints = large[command]["per_endpoint"]
+            worst = max(endpoints, key=endpoints.get) if endpoints else "-"
+            failures.append("%s: %d requests, budget %d (most called: %s x%d)" % (
+                command, max(counts), budget, worst, endpoints.get(worst, 0)))
+
+    for failure in failures:
+        print("FAIL " + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
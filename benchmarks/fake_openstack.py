@@ -0,0 +1,1063 @@
+#!/usr/bin/python3
+"""
+fake_openstack.py
+
+A local stand-in for the OpenStack APIs used by the NRPE checks in
+files/nrpe. A single HTTP server answers for Keystone, Nova, Neutron,
+Cinder, Glance, Placement and Swift under per-service path prefixes and
+serves a synthetic, deterministic dataset whose size is set on the command
+line.
+
+The server counts every request and every response byte. The counters are
+read from GET /_stats and cleared with POST /_reset, which is what the
+benchmark harness uses to attribute API traffic to a single check run.
+
+It can be run on its own for manual testing:
+
+    ./fake_openstack.py --port 5000 --servers 50000 --ports 200000
+"""
+
+import argparse
+import hashlib
+import json
+import os.path
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+ADMIN_USER = "admin"
+ADMIN_PASSWORD = "secret"
+# Non-admin user for checks that refuse to run as admin
+NAGIOS_USER = "nagios"
+AUTH_PROJECT = "admin"
+SERVICE_PROJECT = "service"
+PUBLIC_NET_NAME = "public"
+NOVA_MAX_LIMIT = 1000
+CINDER_MAX_LIMIT = 1000
+GLANCE_DEFAULT_LIMIT = 25
+NOVA_MAX_MICROVERSION = "2.96"
+
+DEFAULT_SIZES = {
+    "servers": 5000,
+    "hypervisors": 200,
+    "ports": 20000,
+    "aggregates": 20,
+    "projects": 500,
+    "users": 5000,
+    "volumes": 5000,
+    "flavors": 20,
+    "images": 100,
+    "server_groups": 500,
+    "l3_agents": 10,
+    "floatingips": 1000,
+}
+
+
+def _uuid(rnd):
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def _mac(rnd):
+    return "fa:16:3e:%02x:%02x:%02x" % (rnd.randrange(256),
+                                          rnd.randrange(256),
+                                          rnd.randrange(256))
+
+
+class Dataset(object):
+    """
+    Synthetic cloud contents. Generation is seeded so two runs with the same
+    sizes serve exactly the same data.
+    """
+
+    def __init__(self, sizes, seed=4667):
+        self.sizes = dict(DEFAULT_SIZES)
+        self.sizes.update(sizes)
+        rnd = random.Random(seed)
+        self._build_identity(rnd)
+        self._build_compute(rnd)
+        self._build_network(rnd)
+        self._build_volume(rnd)
+        self._build_image(rnd)
+        self._build_placement()
+
+    def _build_identity(self, rnd):
+        self.domains = [
+            {"id": "default", "name": "default", "enabled": True},
+            {"id": "users", "name": "users", "enabled": True},
+        ]
+        self.projects = [
+            {"id": _uuid(rnd), "name": AUTH_PROJECT, "domain_id": "default",
+             "enabled": True},
+            {"id": _uuid(rnd), "name": SERVICE_PROJECT, "domain_id": "default",
+             "enabled": True},
+        ]
+        for i in range(self.sizes["projects"]):
+            self.projects.append({"id": _uuid(rnd), "name": "project_%06d" % i,
+                                  "domain_id": "default",
+                                  "enabled": rnd.random() > 0.1})
+        self.auth_project = self.projects[0]
+        self.service_project = self.projects[1]
+        self.admin_user = {"id": _uuid(rnd), "name": ADMIN_USER,
+                           "domain_id": "default", "enabled": True}
+        self.nagios_user = {"id": _uuid(rnd), "name": NAGIOS_USER,
+                            "domain_id": "default", "enabled": True}
+        self.users = [self.admin_user, self.nagios_user]
+        suffixes = ["@csc.fi", "@helsinki.fi", "@example.org", "@localhost"]
+        for i in range(self.sizes["users"]):
+            name = ("trng%06d" if rnd.random() < 0.05 else "user%06d") % i
+            user = {"id": _uuid(rnd), "name": name,
+                    "domain_id": rnd.choice(["default", "users"]),
+                    "enabled": True}
+            if rnd.random() > 0.02:
+                user["email"] = name + rnd.choice(suffixes)
+            self.users.append(user)
+        self.roles = [{"id": _uuid(rnd), "name": name}
+                      for name in ("admin", "member", "reader", "object_store_user")]
+        self.role_assignments = []
+        for project in self.projects:
+            user = rnd.choice(self.users)
+            self.role_assignments.append({
+                "role": {"id": rnd.choice(self.roles)["id"]},
+                "user": {"id": user["id"]},
+                "scope": {"project": {"id": project["id"]}},
+            })
+
+    def _build_compute(self, rnd):
+        self.flavors = []
+        for i in range(self.sizes["flavors"]):
+            vcpus = 2 ** (i % 6)
+            self.flavors.append({"id": _uuid(rnd), "name": "standard.%d" % i,
+                                 "vcpus": vcpus, "ram": vcpus * 4096,
+                                 "disk": 80, "ephemeral": 0, "swap": 0,
+                                 "extra_specs": {}})
+        self.flavors.append({"id": _uuid(rnd), "name": "m1.tiny", "vcpus": 1,
+                             "ram": 512, "disk": 1, "ephemeral": 0, "swap": 0,
+                             "extra_specs": {}})
+        self.hypervisors = []
+        self.compute_services = []
+        for i in range(self.sizes["hypervisors"]):
+            host = "compute-%05d" % i
+            vcpus = 64
+            memory_mb = 512 * 1024
+            status = "disabled" if rnd.random() < 0.05 else "enabled"
+            state = "down" if rnd.random() < 0.01 else "up"
+            self.hypervisors.append({
+                "id": i + 1, "hypervisor_hostname": host,
+                "state": state, "status": status, "host_ip": "10.0.%d.%d" % (i // 250, i % 250 + 1),
+                "vcpus": vcpus, "vcpus_used": rnd.randrange(vcpus),
+                "memory_mb": memory_mb, "memory_mb_used": rnd.randrange(memory_mb),
+                "local_gb": 1000, "local_gb_used": rnd.randrange(1000),
+                "running_vms": 0, "hypervisor_type": "QEMU",
+                "service": {"id": i + 1, "host": host, "disabled_reason": None},
+            })
+            self.compute_services.append({
+                "id": i + 1, "binary": "nova-compute", "host": host,
+                "zone": "nova", "status": status, "state": state,
+                "updated_at": "2026-01-01T00:00:00.000000",
+            })
+        for i in range(3):
+            for binary in ("nova-scheduler", "nova-conductor"):
+                self.compute_services.append({
+                    "id": len(self.compute_services) + 1, "binary": binary,
+                    "host": "controller-%d" % i, "zone": "internal",
+                    "status": "enabled", "state": "up",
+                    "updated_at": "2026-01-01T00:00:00.000000",
+                })
+        self.aggregates = []
+        for i in range(self.sizes["aggregates"]):
+            name = "windows_%d" % i if i % 10 == 9 else "aggregate_%d" % i
+            hosts = [hv["hypervisor_hostname"] for hv in self.hypervisors
+                     if hv["id"] % self.sizes["aggregates"] == i]
+            self.aggregates.append({"id": i + 1, "name": name, "hosts": hosts,
+                                    "availability_zone": None,
+                                    "metadata": {}})
+        self.servers = []
+        project_ids = [p["id"] for p in self.projects]
+        user_ids = [u["id"] for u in self.users]
+        for i in range(self.sizes["servers"]):
+            hv = rnd.choice(self.hypervisors)
+            hv["running_vms"] += 1
+            flavor = rnd.choice(self.flavors)
+            self.servers.append({
+                "id": _uuid(rnd), "name": "vm-%06d" % i,
+                "status": "ERROR" if rnd.random() < 0.01 else "ACTIVE",
+                "tenant_id": rnd.choice(project_ids),
+                "user_id": rnd.choice(user_ids),
+                "flavor_ref": flavor,
+                "OS-EXT-SRV-ATTR:host": hv["service"]["host"],
+                "OS-EXT-SRV-ATTR:hypervisor_hostname": hv["hypervisor_hostname"],
+                "OS-EXT-SRV-ATTR:instance_name": "instance-%08x" % (i + 1),
+                "OS-EXT-STS:vm_state": "active",
+                "created": "2026-01-01T00:00:00Z",
+                "updated": "2026-01-01T00:00:00Z",
+                "metadata": {}, "addresses": {},
+            })
+        self.servers_by_id = dict((s["id"], s) for s in self.servers)
+        # Servers deleted through the API, listed with changes-since
+        self.deleted_servers = []
+        self.server_groups = []
+        policies = ["anti-affinity", "soft-anti-affinity", "affinity",
+                    "soft-affinity"]
+        for i in range(self.sizes["server_groups"]):
+            members = [rnd.choice(self.servers)["id"]
+                       for _ in range(rnd.randrange(1, 6))] if self.servers else []
+            self.server_groups.append({
+                "id": _uuid(rnd), "name": "group-%06d" % i,
+                "policies": [rnd.choice(policies)], "members": members,
+                "project_id": rnd.choice(project_ids), "metadata": {},
+            })
+
+    def _build_network(self, rnd):
+        self.networks = []
+        self.subnets = []
+        public = {"id": _uuid(rnd), "name": PUBLIC_NET_NAME,
+                  "tenant_id": self.service_project["id"],
+                  "project_id": self.service_project["id"],
+                  "provider:network_type": "flat", "router:external": True,
+                  "status": "ACTIVE", "admin_state_up": True, "subnets": []}
+        self.networks.append(public)
+        for i in range(4):
+            subnet = {"id": _uuid(rnd), "network_id": public["id"],
+                      "cidr": "192.0.%d.0/24" % i,
+                      "allocation_pools": [{"start": "192.0.%d.2" % i,
+                                            "end": "192.0.%d.254" % i}]}
+            public["subnets"].append(subnet["id"])
+            self.subnets.append(subnet)
+        self.networks.append({
+            "id": _uuid(rnd), "name": "nagiostest",
+            "tenant_id": self.auth_project["id"], "project_id": self.auth_project["id"],
+            "provider:network_type": "vxlan", "provider:segmentation_id": 1,
+            "router:external": False, "status": "ACTIVE", "admin_state_up": True,
+            "subnets": [],
+        })
+        for i in range(max(1, self.sizes["projects"] // 2)):
+            kind = "vlan" if i % 20 == 0 else "vxlan"
+            project_id = rnd.choice(self.projects)["id"]
+            self.networks.append({
+                "id": _uuid(rnd), "name": "net-%06d" % i,
+                "tenant_id": project_id, "project_id": project_id,
+                "provider:network_type": kind,
+                "provider:segmentation_id": i + 2,
+                "router:external": False, "status": "ACTIVE",
+                "admin_state_up": True, "subnets": [],
+            })
+        self.agents = []
+        for i in range(self.sizes["l3_agents"]):
+            alive = rnd.random() > 0.1
+            admin_state_up = rnd.random() > 0.1
+            self.agents.append({
+                "id": _uuid(rnd), "agent_type": "L3 agent",
+                "binary": "neutron-l3-agent", "host": "network-%03d" % i,
+                "alive": alive, "admin_state_up": admin_state_up,
+                "configurations": {},
+            })
+        owners = ["compute:nova"] * 17 + ["network:router_interface",
+                                          "network:router_gateway",
+                                          "network:dhcp"]
+        l3_hosts = [a["host"] for a in self.agents] or ["network-000"]
+        self.ports = []
+        for i in range(self.sizes["ports"]):
+            owner = rnd.choice(owners)
+            if owner == "compute:nova" and self.servers:
+                server = rnd.choice(self.servers)
+                device_id = server["id"]
+                host = server["OS-EXT-SRV-ATTR:host"]
+                project_id = server["tenant_id"]
+                network = rnd.choice(self.networks)
+            else:
+                device_id = _uuid(rnd)
+                host = rnd.choice(l3_hosts)
+                project_id = rnd.choice(self.projects)["id"]
+                network = public if rnd.random() < 0.3 else rnd.choice(self.networks)
+            self.ports.append({
+                "id": _uuid(rnd), "name": "", "network_id": network["id"],
+                "tenant_id": project_id, "project_id": project_id,
+                "mac_address": _mac(rnd), "device_id": device_id,
+                "device_owner": owner, "binding:host_id": host,
+                "status": "ACTIVE", "admin_state_up": True,
+                "fixed_ips": [{"subnet_id": "", "ip_address": "10.%d.%d.%d" % (
+                    i >> 16 & 255, i >> 8 & 255, i & 255)}],
+            })
+        self.floatingips = []
+        for i in range(self.sizes["floatingips"]):
+            assigned = rnd.random() > 0.3
+            project_id = rnd.choice(self.projects)["id"]
+            self.floatingips.append({
+                "id": _uuid(rnd), "floating_network_id": public["id"],
+                "floating_ip_address": "192.0.%d.%d" % (i // 250 % 4, i % 250 + 2),
+                "fixed_ip_address": "10.0.0.%d" % (i % 250 + 2) if assigned else None,
+                "status": "ACTIVE" if assigned else "DOWN",
+                "tenant_id": project_id, "project_id": project_id,
+            })
+        self.subnetpools = [{"id": _uuid(rnd), "name": "pool-%d" % i,
+                             "prefixes": ["10.%d.0.0/16" % i]} for i in range(5)]
+
+    def _build_volume(self, rnd):
+        backends = ["cloud-storagegw1@ddn1", "cloud-storagegw2@ddn1",
+                    "cloud-storagegw3@ceph"]
+        volume_types = ["standard", "fast", "archive"]
+        self.volumes = []
+        for i in range(self.sizes["volumes"]):
+            status = "error" if rnd.random() < 0.001 else "available"
+            self.volumes.append({
+                "id": _uuid(rnd), "name": "vol-%06d" % i,
+                "size": rnd.choice([1, 10, 20, 50, 100, 500]),
+                "status": status, "volume_type": rnd.choice(volume_types),
+                "os-vol-host-attr:host": rnd.choice(backends),
+                "os-vol-tenant-attr:tenant_id": rnd.choice(self.projects)["id"],
+                "attachments": [], "metadata": {},
+            })
+        self.volume_services = [{"binary": "cinder-volume", "host": b,
+                                 "zone": "nova", "status": "enabled",
+                                 "state": "up"} for b in backends]
+        self.volume_services.append({"binary": "cinder-scheduler",
+                                     "host": "controller-0", "zone": "nova",
+                                     "status": "enabled", "state": "up"})
+
+    def _build_image(self, rnd):
+        self.images = [{"id": _uuid(rnd), "name": "image-%04d" % i,
+                        "status": "active", "visibility": "public",
+                        "size": 1024 * 1024 * rnd.randrange(100, 2000),
+                        "disk_format": "qcow2", "container_format": "bare"}
+                       for i in range(self.sizes["images"])]
+        self.images.insert(0, {"id": _uuid(rnd), "name": "cirros-0.3.0-x86_64",
+                               "status": "active", "visibility": "public",
+                               "size": 9761280, "disk_format": "qcow2",
+                               "container_format": "bare"})
+
+    def _build_placement(self):
+        self.resource_providers = [{
+            "uuid": str(uuid.UUID(int=hv["id"], version=4)),
+            "name": hv["hypervisor_hostname"], "generation": 1,
+        } for hv in self.hypervisors]
+
+
+def _microversion(headers):
+    value = headers.get("X-OpenStack-Nova-API-Version") or \
+        headers.get("OpenStack-API-Version", "").replace("compute", "").strip()
+    if not value:
+        return (2, 1)
+    if value == "latest":
+        value = NOVA_MAX_MICROVERSION
+    major, minor = value.split(".")
+    return (int(major), int(minor))
+
+
+def _matches(item, query, skip=()):
+    for key, values in query.items():
+        if key in skip:
+            continue
+        if key not in item:
+            continue
+        if str(item[key]) not in values and not (
+                isinstance(item[key], bool) and str(item[key]).lower() in
+                [v.lower() for v in values]):
+            return False
+    return True
+
+
+def _page(items, query, max_limit, key="id"):
+    """Return (page, has_more) following the marker/limit convention."""
+    start = 0
+    marker = query.get("marker", [None])[0]
+    if marker:
+        for index, item in enumerate(items):
+            if item[key] == marker:
+                start = index + 1
+                break
+    limit = int(query.get("limit", [max_limit or len(items)])[0])
+    if max_limit:
+        limit = min(limit, max_limit)
+    page = items[start:start + limit]
+    return page, start + limit < len(items)
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+def _all_tenants(query):
+    return query.get("all_tenants", ["0"])[0].lower() in ("1", "true")
+
+
+def _next_link(url, query, marker):
+    query = dict(query, marker=[marker])
+    return [{"rel": "next", "href": url + "?" + urlencode(query, doseq=True)}]
+
+
+class FakeOpenStack(object):
+    """
+    Request router and counters. Handlers return (status, body, headers);
+    the HTTP layer only encodes and accounts for bytes.
+    """
+
+    def __init__(self, dataset, latency=0.0):
+        self.data = dataset
+        self.latency = latency
+        self.base_url = None
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.ec2_credentials = {}
+        self.swift_containers = {}
+        # (container, object) of large object manifests: ("slo", [segment
+        # paths]) or ("dlo", "container/prefix")
+        self.swift_manifests = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.per_endpoint = {}
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "bytes": self.bytes_sent,
+                    "per_endpoint": dict(self.per_endpoint)}
+
+    def account(self, method, path, nbytes):
+        # Collapse ids so the per-endpoint breakdown stays readable
+        endpoint = re.sub(r"[0-9a-f]{8}-[0-9a-f-]{27}", "{id}", path)
+        endpoint = re.sub(r"/\d+(?=/|$)", "/{id}", endpoint)
+        endpoint = re.sub(r"^(/swift/v1/[^/]+/[^/]+)/.+", r"\1/{object}", endpoint)
+        endpoint = method + " " + endpoint
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += nbytes
+            self.per_endpoint[endpoint] = self.per_endpoint.get(endpoint, 0) + 1
+
+    def catalog(self):
+        base = self.base_url
+        project_id = self.data.auth_project["id"]
+        services = [
+            ("identity", "keystone", base + "/identity/v3"),
+            ("compute", "nova", base + "/compute/v2.1"),
+            ("network", "neutron", base + "/network"),
+            ("volumev3", "cinderv3", base + "/volume/v3/" + project_id),
+            ("block-storage", "cinder", base + "/volume/v3/" + project_id),
+            ("image", "glance", base + "/image"),
+            ("placement", "placement", base + "/placement"),
+            ("object-store", "swift", base + "/swift/v1/AUTH_" + project_id),
+        ]
+        catalog = []
+        for index, (service_type, name, url) in enumerate(services):
+            catalog.append({
+                "id": "service-%d" % index, "type": service_type, "name": name,
+                "endpoints": [{"id": "endpoint-%d-%s" % (index, interface),
+                               "interface": interface, "region": "RegionOne",
+                               "region_id": "RegionOne", "url": url}
+                              for interface in ("public", "internal", "admin")],
+            })
+        return catalog
+
+    # Keystone
+
+    def issue_token(self, body):
+        auth = body["auth"]
+        user = auth["identity"]["password"]["user"]
+        if user.get("password") != ADMIN_PASSWORD:
+            return 401, {"error": {"code": 401, "message": "Unauthorized"}}, {}
+        token_id = uuid.uuid4().hex
+        self.tokens[token_id] = user.get("name")
+        project = self.data.auth_project
+        if user.get("name") == NAGIOS_USER:
+            user_ref, role = self.data.nagios_user, self.data.roles[1]
+        else:
+            user_ref, role = self.data.admin_user, self.data.roles[0]
+        token = {"token": {
+            "methods": ["password"],
+            "expires_at": time.strftime("%Y-%m-%dT%H:%M:%S.000000Z",
+                                        time.gmtime(time.time() + 3600)),
+            "issued_at": time.strftime("%Y-%m-%dT%H:%M:%S.000000Z", time.gmtime()),
+            "user": {"id": user_ref["id"], "name": user_ref["name"],
+                     "domain": {"id": "default", "name": "default"}},
+            "project": {"id": project["id"], "name": project["name"],
+                        "domain": {"id": "default", "name": "default"}},
+            "roles": [{"id": role["id"], "name": role["name"]}],
+            "catalog": self.catalog(),
+        }}
+        return 201, token, {"X-Subject-Token": token_id}
+
+    def identity(self, method, parts, query, body, headers):
+        data = self.data
+        if not parts:
+            return 200, self.version_doc("v3.14", self.base_url + "/identity/v3/"), {}
+        if parts == ["auth", "tokens"]:
+            if method == "POST":
+                return self.issue_token(body)
+            return 200, {}, {}
+        collections = {
+            "projects": data.projects, "users": data.users,
+            "domains": data.domains, "roles": data.roles,
+            "role_assignments": data.role_assignments,
+        }
+        if parts[0] == "users" and parts[2:3] == ["credentials"]:
+            return self.ec2(method, parts[1], parts[4:], body)
+        if parts == ["role_assignments"] and \
+                self.tokens.get(headers.get("X-Auth-Token")) != ADMIN_USER:
+            return 403, {"error": {"code": 403, "message": "Forbidden"}}, {}
+        if parts[0] in collections and len(parts) == 1:
+            items = [i for i in collections[parts[0]] if _matches(i, query, ("domain",))]
+            if "domain" in query:
+                items = [i for i in items if i.get("domain_id") in query["domain"]]
+            return 200, {parts[0]: items, "links": {"next": None}}, {}
+        if parts[0] in collections and len(parts) == 2:
+            for item in collections[parts[0]]:
+                if item.get("id") == parts[1]:
+                    return 200, {parts[0][:-1]: item}, {}
+            return 404, {"error": {"code": 404}}, {}
+        if parts == ["services"]:
+            services = [{"id": s["id"], "type": s["type"], "name": s["name"],
+                         "enabled": True} for s in self.catalog()]
+            return 200, {"services": services, "links": {"next": None}}, {}
+        if parts == ["endpoints"]:
+            endpoints = []
+            for service in self.catalog():
+                for endpoint in service["endpoints"]:
+                    endpoint = dict(endpoint, service_id=service["id"], enabled=True)
+                    if _matches(endpoint, query):
+                        endpoints.append(endpoint)
+            return 200, {"endpoints": endpoints, "links": {"next": None}}, {}
+        return 404, {"error": {"code": 404}}, {}
+
+    def ec2(self, method, user_id, parts, body):
+        """
+        OS-EC2 credentials of a user, kept in memory for the server lifetime.
+        """
+        credentials = self.ec2_credentials.setdefault(user_id, [])
+        if method == "POST":
+            credential = {"user_id": user_id, "tenant_id": body["tenant_id"],
+                          "access": uuid.uuid4().hex, "secret": uuid.uuid4().hex}
+            credentials.append(credential)
+            return 201, {"credential": credential}, {}
+        if not parts:
+            return 200, {"credentials": credentials, "links": {"next": None}}, {}
+        for credential in credentials:
+            if credential["access"] == parts[0]:
+                if method == "DELETE":
+                    credentials.remove(credential)
+                    return 204, None, {}
+                return 200, {"credential": credential}, {}
+        return 404, {"error": {"code": 404}}, {}
+
+    # Nova
+
+    def server_view(self, server, microversion):
+        view = dict(server)
+        flavor = view.pop("flavor_ref")
+        if microversion >= (2, 47):
+            view["flavor"] = {"original_name": flavor["name"],
+                              "vcpus": flavor["vcpus"], "ram": flavor["ram"],
+                              "disk": flavor["disk"], "ephemeral": 0, "swap": 0,
+                              "extra_specs": {}}
+        else:
+            view["flavor"] = {"id": flavor["id"], "links": []}
+        return view
+
+    def compute(self, method, parts, query, body, headers):
+        data = self.data
+        microversion = _microversion(headers)
+        if not parts:
+            return 200, self.version_doc("v2.1", self.base_url + "/compute/v2.1/",
+                                         "2.1", NOVA_MAX_MICROVERSION), {}
+        if parts[0] == "servers":
+            if method == "POST":
+                return self.create_server(body)
+            if len(parts) == 2 and parts[1] != "detail":
+                server = data.servers_by_id.get(parts[1])
+                if server is None:
+                    return 404, {"itemNotFound": {"code": 404}}, {}
+                if method == "DELETE":
+                    data.servers.remove(server)
+                    del data.servers_by_id[parts[1]]
+                    data.deleted_servers.append(dict(server, status="DELETED",
+                                                     updated=_now()))
+                    return 204, None, {}
+                return 200, {"server": self.server_view(server, microversion)}, {}
+            filters = dict(query)
+            for key in ("all_tenants", "deleted", "limit", "marker", "changes-since"):
+                filters.pop(key, None)
+            if not _all_tenants(query):
+                filters["tenant_id"] = [data.auth_project["id"]]
+            if "host" in filters:
+                filters["OS-EXT-SRV-ATTR:host"] = filters.pop("host")
+            servers = data.servers
+            changes_since = query.get("changes-since", [None])[0]
+            if changes_since:
+                # Like nova, deleted servers are included
+                servers = [s for s in servers + data.deleted_servers
+                           if s["updated"] >= changes_since]
+            servers = [s for s in servers if _matches(s, filters)]
+            page, more = _page(servers, query, NOVA_MAX_LIMIT)
+            result = {"servers": [self.server_view(s, microversion) for s in page]}
+            if more:
+                result["servers_links"] = _next_link(
+                    self.base_url + "/compute/v2.1/servers/detail", query, page[-1]["id"])
+            return 200, result, {}
+        if parts[0] == "os-hypervisors":
+            if len(parts) == 3 and parts[2] == "search":
+                found = [h for h in data.hypervisors
+                         if parts[1] in h["hypervisor_hostname"]]
+                return 200, {"hypervisors": [{"id": h["id"],
+                                              "hypervisor_hostname": h["hypervisor_hostname"],
+                                              "state": h["state"], "status": h["status"]}
+                                             for h in found]}, {}
+            if len(parts) == 2 and parts[1] == "statistics":
+                stats = {}
+                for key in ("vcpus", "vcpus_used", "memory_mb", "memory_mb_used",
+                            "local_gb", "local_gb_used", "running_vms"):
+                    stats[key] = sum(h[key] for h in data.hypervisors)
+                stats["count"] = len(data.hypervisors)
+                return 200, {"hypervisor_statistics": stats}, {}
+            page, more = _page(data.hypervisors, query, 0)
+            return 200, {"hypervisors": page}, {}
+        if parts[0] == "os-aggregates":
+            return 200, {"aggregates": data.aggregates}, {}
+        if parts[0] == "os-services":
+            return 200, {"services": [s for s in data.compute_services
+                                      if _matches(s, query)]}, {}
+        if parts[0] == "os-server-groups":
+            # Server groups page by offset, not by marker
+            offset = int(query.get("offset", ["0"])[0])
+            limit = min(int(query.get("limit", [NOVA_MAX_LIMIT])[0]), NOVA_MAX_LIMIT)
+            return 200, {"server_groups": data.server_groups[offset:offset + limit]}, {}
+        if parts[0] == "flavors":
+            if len(parts) == 2 and parts[1] != "detail":
+                for flavor in data.flavors:
+                    if flavor["id"] == parts[1]:
+                        return 200, {"flavor": flavor}, {}
+                return 404, {"itemNotFound": {"code": 404}}, {}
+            return 200, {"flavors": data.flavors}, {}
+        return 404, {"itemNotFound": {"code": 404}}, {}
+
+    def create_server(self, body):
+        server = body["server"]
+        flavor = self.data.flavors[0]
+        for candidate in self.data.flavors:
+            if candidate["id"] == server.get("flavorRef"):
+                flavor = candidate
+        hv = self.data.hypervisors[0]
+        record = {
+            "id": str(uuid.uuid4()), "name": server["name"], "status": "ACTIVE",
+            "tenant_id": self.data.auth_project["id"],
+            "user_id": self.data.admin_user["id"], "flavor_ref": flavor,
+            "OS-EXT-SRV-ATTR:host": hv["service"]["host"],
+            "OS-EXT-SRV-ATTR:hypervisor_hostname": hv["hypervisor_hostname"],
+            "OS-EXT-SRV-ATTR:instance_name": "instance-new",
+            "created": _now(), "updated": _now(),
+            "metadata": {}, "addresses": {},
+        }
+        self.data.servers.append(record)
+        self.data.servers_by_id[record["id"]] = record
+        return 202, {"server": {"id": record["id"], "links": []}}, {}
+
+    # Neutron
+
+    def network(self, method, parts, query, body):
+        data = self.data
+        if not parts:
+            return 200, {"versions": [{"id": "v2.0", "status": "CURRENT",
+                                       "links": [{"rel": "self", "href": self.base_url + "/network/v2.0/"}]}]}, {}
+        if parts[0] == "v2.0":
+            parts = parts[1:]
+        if not parts:
+            return 200, {"resources": []}, {}
+        parts[-1] = re.sub(r"\.json$", "", parts[-1])
+        collections = {
+            "ports": data.ports, "networks": data.networks,
+            "subnets": data.subnets, "agents": data.agents,
+            "floatingips": data.floatingips, "subnetpools": data.subnetpools,
+            "routers": [],
+        }
+        if parts[0] not in collections:
+            return 404, {"NeutronError": {"message": "not found"}}, {}
+        items = collections[parts[0]]
+        singular = parts[0][:-1]
+        if len(parts) == 2:
+            for item in items:
+                if item["id"] == parts[1]:
+                    if method == "DELETE":
+                        items.remove(item)
+                        return 204, None, {}
+                    return 200, {singular: item}, {}
+            return 404, {"NeutronError": {"message": "not found"}}, {}
+        if method == "POST":
+            item = dict(body[singular], id=str(uuid.uuid4()))
+            items.append(item)
+            return 201, {singular: item}, {}
+        filters = dict((k, v) for k, v in query.items() if k not in ("fields",))
+        return 200, {parts[0]: [i for i in items if _matches(i, filters)]}, {}
+
+    # Cinder
+
+    def volume(self, method, parts, query, body):
+        data = self.data
+        if not parts:
+            return 200, self.version_doc("v3.0", self.base_url + "/volume/v3/", "3.0", "3.70"), {}
+        if parts[0] == "v3":
+            parts = parts[1:]
+        if parts and parts[0] == data.auth_project["id"]:
+            parts = parts[1:]
+        if not parts:
+            return 200, self.version_doc("v3.0", self.base_url + "/volume/v3/", "3.0", "3.70"), {}
+        if parts[0] == "volumes":
+            if method == "POST":
+                volume = {"id": str(uuid.uuid4()), "name": body["volume"].get("name"),
+                          "size": int(body["volume"]["size"]), "status": "available",
+                          "volume_type": "standard",
+                          "os-vol-host-attr:host": data.volume_services[0]["host"],
+                          "os-vol-tenant-attr:tenant_id": data.auth_project["id"],
+                          "attachments": [], "metadata": {}}
+                data.volumes.append(volume)
+                return 202, {"volume": volume}, {}
+            if len(parts) >= 2 and parts[1] not in ("detail", "summary"):
+                for volume in data.volumes:
+                    if volume["id"] == parts[1]:
+                        if method == "DELETE":
+                            data.volumes.remove(volume)
+                            return 202, None, {}
+                        return 200, {"volume": volume}, {}
+                return 404, {"itemNotFound": {"code": 404}}, {}
+            if len(parts) == 2 and parts[1] == "summary":
+                return 200, {"volume-summary": {
+                    "total_count": len(data.volumes),
+                    "total_size": sum(v["size"] for v in data.volumes),
+                    "metadata": {}}}, {}
+            filters = dict((k, v) for k, v in query.items()
+                           if k not in ("all_tenants", "limit", "marker"))
+            if "display_name" in filters:
+                filters["name"] = filters.pop("display_name")
+            if not _all_tenants(query):
+                filters["os-vol-tenant-attr:tenant_id"] = [data.auth_project["id"]]
+            volumes = [v for v in data.volumes if _matches(v, filters)]
+            page, more = _page(volumes, query, CINDER_MAX_LIMIT)
+            result = {"volumes": page}
+            if more:
+                result["volumes_links"] = _next_link(
+                    "%s/volume/v3/%s/volumes/detail" % (self.base_url, data.auth_project["id"]),
+                    query, page[-1]["id"])
+            return 200, result, {}
+        if parts[0] == "os-services":
+            return 200, {"services": [s for s in data.volume_services
+                                      if _matches(s, query)]}, {}
+        return 404, {"itemNotFound": {"code": 404}}, {}
+
+    # Glance
+
+    def image(self, method, parts, query, body):
+        if not parts:
+            return 300, {"versions": [{"id": "v2.9", "status": "CURRENT",
+                                       "links": [{"rel": "self", "href": self.base_url + "/image/v2/"}]}]}, {}
+        if parts[0] == "v2":
+            parts = parts[1:]
+        if parts == ["images"]:
+            filters = dict((k, v) for k, v in query.items()
+                           if k not in ("limit", "marker", "sort_key", "sort_dir"))
+            images = [i for i in self.data.images if _matches(i, filters)]
+            query.setdefault("limit", [GLANCE_DEFAULT_LIMIT])
+            page, more = _page(images, query, 1000)
+            result = {"images": page, "first": "/v2/images"}
+            if more:
+                result["next"] = "/v2/images?marker=%s&limit=%s" % (
+                    page[-1]["id"], query["limit"][0])
+            return 200, result, {}
+        if parts == ["schemas", "image"]:
+            return 200, {"name": "image", "properties": {}, "additionalProperties": {"type": "string"}}, {}
+        return 404, {"code": 404}, {}
+
+    # Placement
+
+    def placement(self, method, parts, query, body):
+        if not parts:
+            return 200, {"versions": [{"id": "v1.0", "min_version": "1.0",
+                                       "max_version": "1.39", "status": "CURRENT",
+                                       "links": []}]}, {}
+        if parts == ["resource_providers"]:
+            return 200, {"resource_providers": self.data.resource_providers}, {}
+        return 404, {"errors": [{"status": 404}]}, {}
+
+    # Swift
+
+    def swift_manifest_body(self, manifest):
+        kind, segments = manifest
+        if kind == "dlo":
+            container, _, prefix = segments.partition("/")
+            objects = self.swift_containers.get(container, {})
+            return b"".join(data for name, data in sorted(objects.items())
+                            if name.startswith(prefix))
+        body = []
+        for path in segments:
+            container, _, name = path.lstrip("/").partition("/")
+            body.append(self.swift_containers[container][name])
+        return b"".join(body)
+
+    def swift(self, method, parts, query, body, headers):
+        """
+        Objects are kept in memory and returned as bytes, not JSON. Static
+        (multipart-manifest=put) and dynamic (X-Object-Manifest) large
+        objects are put together from their segments on GET and HEAD.
+        """
+        containers = self.swift_containers
+        if not parts:
+            listing = [{"name": name, "count": len(objects),
+                        "bytes": sum(len(data) for data in objects.values())}
+                       for name, objects in sorted(containers.items())]
+            return 200, listing, {}
+        container, key = parts[0], "/".join(parts[1:])
+        if not key:
+            if method == "PUT":
+                created = container not in containers
+                containers.setdefault(container, {})
+                return (201 if created else 202), b"", {}
+            if container not in containers:
+                return 404, b"", {}
+            if method == "DELETE":
+                if containers[container]:
+                    return 409, b"", {}
+                del containers[container]
+                return 204, b"", {}
+            prefix = query.get("prefix", [""])[0]
+            marker = query.get("marker", [""])[0]
+            listing = [{"name": name, "bytes": len(data)}
+                       for name, data in sorted(containers[container].items())
+                       if name.startswith(prefix) and name > marker]
+            return 200, listing, {"X-Container-Object-Count": str(len(listing))}
+        if container not in containers:
+            return 404, b"", {}
+        objects = containers[container]
+        multipart = query.get("multipart-manifest", [""])[0]
+        if method == "PUT":
+            self.swift_manifests.pop((container, key), None)
+            if multipart == "put":
+                segments = json.loads(body.decode("utf-8"))
+                for segment in segments:
+                    segment_container, _, name = segment["path"].lstrip("/").partition("/")
+                    data = containers.get(segment_container, {}).get(name)
+                    if data is None or len(data) != segment["size_bytes"] or \
+                       hashlib.md5(data).hexdigest() != segment["etag"]:
+                        return 400, b"", {}
+                self.swift_manifests[(container, key)] = (
+                    "slo", [segment["path"] for segment in segments])
+                body = b""
+            elif headers.get("X-Object-Manifest"):
+                self.swift_manifests[(container, key)] = (
+                    "dlo", headers["X-Object-Manifest"])
+            objects[key] = body or b""
+            return 201, b"", {"Etag": hashlib.md5(objects[key]).hexdigest()}
+        if key not in objects:
+            return 404, b"", {}
+        manifest = self.swift_manifests.get((container, key))
+        if method == "DELETE":
+            del objects[key]
+            self.swift_manifests.pop((container, key), None)
+            if manifest and manifest[0] == "slo" and multipart == "delete":
+                for path in manifest[1]:
+                    segment_container, _, name = path.lstrip("/").partition("/")
+                    containers.get(segment_container, {}).pop(name, None)
+            return 204, b"", {}
+        data = self.swift_manifest_body(manifest) if manifest else objects[key]
+        return 200, data, {"Etag": hashlib.md5(data).hexdigest()}
+
+    def version_doc(self, version_id, href, min_version="", max_version=""):
+        return {"version": {"id": version_id, "status": "CURRENT",
+                            "min_version": min_version, "version": max_version,
+                            "links": [{"rel": "self", "href": href}],
+                            "media-types": [{"base": "application/json",
+                                             "type": "application/vnd.openstack+json"}]}}
+
+    def dispatch(self, method, path, query, body, headers):
+        parts = [p for p in path.split("/") if p]
+        if not parts:
+            return 404, {}, {}
+        service, rest = parts[0], parts[1:]
+        if service == "identity":
+            if rest and rest[0] == "v3":
+                return self.identity(method, rest[1:], query, body, headers)
+            return 300, {"versions": {"values": [self.version_doc(
+                "v3.14", self.base_url + "/identity/v3/")["version"]]}}, {}
+        if service == "compute":
+            if rest and rest[0] == "v2.1":
+                rest = rest[1:]
+                if not rest:
+                    return self.compute(method, [], query, body, headers)
+                return self.compute(method, rest, query, body, headers)
+            return 200, {"versions": [self.version_doc(
+                "v2.1", self.base_url + "/compute/v2.1/", "2.1",
+                NOVA_MAX_MICROVERSION)["version"]]}, {}
+        if service == "network":
+            return self.network(method, rest, query, body)
+        if service == "volume":
+            return self.volume(method, rest, query, body)
+        if service == "image":
+            return self.image(method, rest, query, body)
+        if service == "placement":
+            return self.placement(method, rest, query, body)
+        if service == "swift":
+            return self.swift(method, rest[2:], query, body, headers)
+        return 404, {}, {}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def handle_any(self):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if url.path == "/_stats":
+            return self.reply(200, fake.stats(), {}, count=False)
+        if url.path == "/_reset":
+            fake.reset()
+            return self.reply(204, None, {}, count=False)
+        if fake.latency:
+            time.sleep(fake.latency)
+        if url.path.startswith("/swift/"):
+            body = raw
+        else:
+            body = json.loads(raw.decode("utf-8")) if raw else None
+        query = parse_qs(url.query)
+        try:
+            status, result, headers = fake.dispatch(self.command, url.path,
+                                                    query, body, self.headers)
+        except Exception as exception:
+            status, result, headers = 500, {"error": repr(exception)}, {}
+        self.reply(status, result, headers, path=url.path)
+
+    def reply(self, status, result, headers, path=None, count=True):
+        content_type = "application/json"
+        if isinstance(result, bytes):
+            payload, content_type = result, "application/octet-stream"
+        else:
+            payload = b"" if result is None else json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            try:
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up on the request, e.g. a check deadline
+                self.close_connection = True
+                return
+        if count:
+            self.server.fake.account(self.command, path, len(payload))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = do_PATCH = handle_any
+
+
+def start_server(dataset, host="127.0.0.1", port=0, latency=0.0, verbose=False):
+    """
+    Start the fake API in a background thread and return (server, fake).
+    The identity endpoint is fake.base_url + '/identity/v3'.
+    """
+    fake = FakeOpenStack(dataset, latency)
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    server.verbose = verbose
+    fake.base_url = "http://%s:%d" % (host, server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, fake
+
+
+class FakeOpenStackProcess(object):
+    """
+    The fake API running in a child process. Benchmarks use this instead of
+    start_server() so that the dataset does not inflate the memory of the
+    process that spawns the checks: Linux carries the parent's peak RSS over
+    into a forked child's ru_maxrss.
+    """
+
+    def __init__(self, args, verbose=False):
+        command = [sys.executable, os.path.abspath(__file__), "--port", "0",
+                   "--latency-ms", str(args.latency_ms), "--seed", str(args.seed)]
+        for key in DEFAULT_SIZES:
+            command += ["--" + key.replace("_", "-"), str(getattr(args, key))]
+        if verbose:
+            command.append("--verbose")
+        self.sizes = dict((key, getattr(args, key)) for key in DEFAULT_SIZES)
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        line = self.process.stdout.readline()
+        match = re.search(r"OS_AUTH_URL=(\S+)/identity/v3", line)
+        if not match:
+            self.stop()
+            raise RuntimeError("fake OpenStack API did not start: %r" % line)
+        self.base_url = match.group(1)
+
+    def _call(self, method, path):
+        request = urllib.request.Request(self.base_url + path, method=method)
+        with urllib.request.urlopen(request) as response:
+            payload = response.read()
+        return json.loads(payload.decode("utf-8")) if payload else None
+
+    def reset(self):
+        self._call("POST", "/_reset")
+
+    def stats(self):
+        return self._call("GET", "/_stats")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def add_dataset_arguments(parser):
+    for key, value in sorted(DEFAULT_SIZES.items()):
+        parser.add_argument("--" + key.replace("_", "-"), dest=key, type=int,
+                            default=value,
+                            help="number of synthetic %s (default %d)" % (
+                                key.replace("_", " "), value))
+    parser.add_argument("--latency-ms", dest="latency_ms", type=float, default=0.0,
+                        help="added latency per request in milliseconds")
+    parser.add_argument("--seed", type=int, default=4667,
+                        help="random seed for the synthetic dataset")
+
+
+def dataset_from_args(args):
+    return Dataset(dict((key, getattr(args, key)) for key in DEFAULT_SIZES),
+                   seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake OpenStack API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000,
+                        help="port to listen on, 0 picks a free one")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log every request")
+    add_dataset_arguments(parser)
+    args = parser.parse_args()
+    server, fake = start_server(dataset_from_args(args), args.host, args.port,
+                                args.latency_ms / 1000.0, args.verbose)
+    print("OS_AUTH_URL=%s/identity/v3 OS_USERNAME=%s OS_PASSWORD=%s "
+          "OS_TENANT_NAME=%s" % (fake.base_url, ADMIN_USER, ADMIN_PASSWORD,
+                                 AUTH_PROJECT))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+"""
+fake_s3.py
+
+A local stand-in for the S3 API of radosgw, enough for the S3 commands of
+files/nrpe/check_object.py. Buckets and objects are kept in memory and
+bucket names are taken from the path (path style addressing), so point the
+checks at it with a URL:
+
+    ./fake_s3.py --port 8080 --public-bucket nagiospublic
+    check_object.py -l http://127.0.0.1:8080 ... s3func
+
+Requests with an Authorization header are accepted without checking the
+signature, unless --access-key is given, in which case any other access key
+gets InvalidAccessKeyId. Anonymous requests are only allowed to the buckets
+named with --public-bucket. Like fake_openstack.py, the server counts
+requests, connections and response bytes, readable from GET /_stats and
+cleared with POST /_reset.
+"""
+
+import argparse
+import hashlib
+import json
+import os.path
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+DEFAULT_MAX_KEYS = 1000
+
+
+class FakeS3(object):
+    """
+    In-memory buckets, multipart uploads and request counters.
+    """
+
+    def __init__(self, public_buckets=(), access_key=None, latency=0.0,
+                 corrupt=False, connect_latency=0.0):
+        self.buckets = dict((name, {}) for name in public_buckets)
+        self.public_buckets = set(public_buckets)
+        self.access_key = access_key
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.corrupt = corrupt
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = 0
+            self.bytes_sent = 0
+            self.per_operation = {}
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "bytes": self.bytes_sent,
+                    "connections": self.connections,
+                    "per_operation": dict(self.per_operation),
+                    "objects": sum(len(b) for b in self.buckets.values())}
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def account(self, operation, nbytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += nbytes
+            self.per_operation[operation] = self.per_operation.get(operation, 0) + 1
+
+
+def error_xml(code, message, resource=""):
+    return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>%s</Code>"
+            "<Message>%s</Message><Resource>%s</Resource><RequestId>%s</RequestId>"
+            "</Error>" % (code, escape(message), escape(resource),
+                          uuid.uuid4().hex)).encode("utf-8")
+
+
+def access_key_of(authorization):
+    # AWS2: "AWS key:signature", AWS4: "AWS4-HMAC-SHA256 Credential=key/..."
+    match = re.match(r"AWS (\S+?):", authorization) or \
+        re.search(r"Credential=([^/]+)/", authorization)
+    return match.group(1) if match else None
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        s3 = self.server.s3
+        s3.connected()
+        if s3.connect_latency:
+            # Stands in for the round trips of a TCP and TLS handshake
+            time.sleep(s3.connect_latency)
+
+    def handle_any(self):
+        s3 = self.server.s3
+        url = urlsplit(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if url.path == "/_stats":
+            return self.reply(200, json.dumps(s3.stats()).encode("utf-8"),
+                              count=False, content_type="application/json")
+        if url.path == "/_reset":
+            s3.reset()
+            return self.reply(204, b"", count=False)
+        if s3.latency:
+            time.sleep(s3.latency)
+
+        parts = unquote(url.path).lstrip("/").split("/", 1)
+        bucket = parts[0]
+        key = parts[1] if len(parts) > 1 and parts[1] else None
+        self.operation = "%s %s" % (self.command, "object" if key else
+                                    "bucket" if bucket else "service")
+
+        authorization = self.headers.get("Authorization")
+        if authorization is None:
+            if bucket not in s3.public_buckets or self.command not in ("GET", "HEAD"):
+                return self.reply(403, error_xml("AccessDenied", "Access Denied", url.path))
+        elif s3.access_key and access_key_of(authorization) != s3.access_key:
+            return self.reply(403, error_xml(
+                "InvalidAccessKeyId", "The AWS Access Key Id you provided does "
+                "not exist in our records.", url.path))
+
+        if not bucket:
+            return self.list_buckets()
+        if key is None:
+            return self.bucket_request(bucket, query)
+        return self.object_request(bucket, key, query, body)
+
+    def list_buckets(self):
+        buckets = "".join("<Bucket><Name>%s</Name><CreationDate>2020-01-01T00:00:00.000Z"
+                          "</CreationDate></Bucket>" % escape(name)
+                          for name in sorted(self.server.s3.buckets))
+        return self.reply(200, (
+            "<?xml version=\"1.0\" encoding=\"UTF-8\"?><ListAllMyBucketsResult xmlns=\"%s\">"
+            "<Owner><ID>nagios</ID><DisplayName>nagios</DisplayName></Owner>"
+            "<Buckets>%s</Buckets></ListAllMyBucketsResult>" % (XMLNS, buckets)).encode("utf-8"))
+
+    def bucket_request(self, bucket, query):
+        buckets = self.server.s3.buckets
+        if self.command == "PUT":
+            buckets.setdefault(bucket, {})
+            return self.reply(200, b"")
+        if bucket not in buckets:
+            return self.reply(404, error_xml("NoSuchBucket", "The specified bucket "
+                                             "does not exist", bucket))
+        if self.command == "DELETE":
+            if buckets[bucket]:
+                return self.reply(409, error_xml("BucketNotEmpty", "The bucket you "
+                                                 "tried to delete is not empty", bucket))
+            del buckets[bucket]
+            return self.reply(204, b"")
+        if self.command == "HEAD":
+            return self.reply(200, b"")
+        prefix = query.get("prefix", [""])[0]
+        marker = query.get("marker", [""])[0]
+        max_keys = int(query.get("max-keys", [DEFAULT_MAX_KEYS])[0])
+        names = sorted(k for k in list(buckets[bucket])
+                       if k.startswith(prefix) and k > marker)
+        truncated = len(names) > max_keys
+        contents = []
+        for name in names[:max_keys]:
+            data, etag = buckets[bucket].get(name, (b"", ""))
+            contents.append("<Contents><Key>%s</Key><LastModified>2020-01-01T00:00:00.000Z"
+                            "</LastModified><ETag>&quot;%s&quot;</ETag><Size>%d</Size>"
+                            "<StorageClass>STANDARD</StorageClass></Contents>" % (
+                                escape(name), etag, len(data)))
+        return self.reply(200, (
+            "<?xml version=\"1.0\" encoding=\"UTF-8\"?><ListBucketResult xmlns=\"%s\">"
+            "<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker><MaxKeys>%d</MaxKeys>"
+            "<IsTruncated>%s</IsTruncated>%s</ListBucketResult>" % (
+                XMLNS, escape(bucket), escape(prefix), escape(marker), max_keys,
+                "true" if truncated else "false", "".join(contents))).encode("utf-8"))
+
+    def object_request(self, bucket, key, query, body):
+        s3 = self.server.s3
+        if bucket not in s3.buckets:
+            return self.reply(404, error_xml("NoSuchBucket", "The specified bucket "
+                                             "does not exist", bucket))
+        objects = s3.buckets[bucket]
+        if "uploads" in query and self.command == "POST":
+            upload_id = uuid.uuid4().hex
+            s3.uploads[upload_id] = {}
+            return self.reply(200, (
+                "<?xml version=\"1.0\" encoding=\"UTF-8\"?><InitiateMultipartUploadResult "
+                "xmlns=\"%s\"><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>"
+                "</InitiateMultipartUploadResult>" % (
+                    XMLNS, escape(bucket), escape(key), upload_id)).encode("utf-8"))
+        if "uploadId" in query:
+            upload_id = query["uploadId"][0]
+            if upload_id not in s3.uploads:
+                return self.reply(404, error_xml("NoSuchUpload", "The specified "
+                                                 "upload does not exist", key))
+            if self.command == "PUT":
+                etag = hashlib.md5(body).hexdigest()
+                s3.uploads[upload_id][int(query["partNumber"][0])] = body
+                return self.reply(200, b"", {"ETag": '"%s"' % etag})
+            if self.command == "DELETE":
+                del s3.uploads[upload_id]
+                return self.reply(204, b"")
+            if self.command == "GET":
+                parts = s3.uploads[upload_id]
+                listing = "".join(
+                    "<Part><PartNumber>%d</PartNumber><ETag>&quot;%s&quot;</ETag>"
+                    "<Size>%d</Size></Part>" % (number, hashlib.md5(parts[number]).hexdigest(),
+                                                len(parts[number]))
+                    for number in sorted(parts))
+                return self.reply(200, (
+                    "<?xml version=\"1.0\" encoding=\"UTF-8\"?><ListPartsResult xmlns=\"%s\">"
+                    "<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>"
+                    "<IsTruncated>false</IsTruncated>%s</ListPartsResult>" % (
+                        XMLNS, escape(bucket), escape(key), upload_id,
+                        listing)).encode("utf-8"))
+            if self.command == "POST":
+                parts = s3.uploads.pop(upload_id)
+                data = b"".join(parts[number] for number in sorted(parts))
+                etag = "%s-%d" % (hashlib.md5(data).hexdigest(), len(parts))
+                objects[key] = (data, etag)
+                return self.reply(200, (
+                    "<?xml version=\"1.0\" encoding=\"UTF-8\"?><CompleteMultipartUploadResult "
+                    "xmlns=\"%s\"><Bucket>%s</Bucket><Key>%s</Key><ETag>&quot;%s&quot;</ETag>"
+                    "</CompleteMultipartUploadResult>" % (
+                        XMLNS, escape(bucket), escape(key), etag)).encode("utf-8"))
+        if self.command == "PUT":
+            etag = hashlib.md5(body).hexdigest()
+            objects[key] = (body, etag)
+            return self.reply(200, b"", {"ETag": '"%s"' % etag})
+        if self.command == "DELETE":
+            objects.pop(key, None)
+            return self.reply(204, b"")
+        if key not in objects:
+            return self.reply(404, error_xml("NoSuchKey", "The specified key does "
+                                             "not exist.", key))
+        data, etag = objects[key]
+        if s3.corrupt and data:
+            data = bytes([data[0] ^ 0xff]) + data[1:]
+        return self.reply(200, data, {"ETag": '"%s"' % etag},
+                          content_type="binary/octet-stream")
+
+    def reply(self, status, payload, headers=None, count=True,
+              content_type="application/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            try:
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+                return
+        if count:
+            self.server.s3.account(getattr(self, "operation", self.command),
+                                   0 if self.command == "HEAD" else len(payload))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_any
+
+
+def start_server(s3, host="127.0.0.1", port=0, verbose=False):
+    """
+    Start the fake S3 API in a background thread and return (server, url).
+    """
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.s3 = s3
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://%s:%d" % (host, server.server_address[1])
+
+
+class FakeS3Process(object):
+    """
+    The fake S3 API in a child process, for benchmarks that should not share
+    the interpreter (and its GIL) with the server.
+    """
+
+    def __init__(self, latency_ms=0.0, connect_latency_ms=0.0, verbose=False):
+        command = [sys.executable, os.path.abspath(__file__), "--port", "0",
+                   "--latency-ms", str(latency_ms),
+                   "--connect-latency-ms", str(connect_latency_ms)]
+        if verbose:
+            command.append("--verbose")
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        line = self.process.stdout.readline()
+        match = re.search(r"S3_URL=(\S+)", line)
+        if not match:
+            self.stop()
+            raise RuntimeError("fake S3 API did not start: %r" % line)
+        self.url = match.group(1)
+
+    def _call(self, method, path):
+        request = urllib.request.Request(self.url + path, method=method)
+        with urllib.request.urlopen(request) as response:
+            payload = response.read()
+        return json.loads(payload.decode("utf-8")) if payload else None
+
+    def reset(self):
+        self._call("POST", "/_reset")
+
+    def stats(self):
+        return self._call("GET", "/_stats")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake S3 API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="port to listen on, 0 picks a free one")
+    parser.add_argument("--public-bucket", action="append", default=[],
+                        help="bucket readable without credentials, can be repeated")
+    parser.add_argument("--access-key",
+                        help="only accept this access key, others get InvalidAccessKeyId")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="added latency per request in milliseconds")
+    parser.add_argument("--connect-latency-ms", type=float, default=0.0,
+                        help="added latency per new connection in milliseconds")
+    parser.add_argument("--corrupt", action="store_true",
+                        help="flip the first byte of every object read")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log every request")
+    args = parser.parse_args()
+    s3 = FakeS3(args.public_bucket, args.access_key, args.latency_ms / 1000.0,
+                args.corrupt, args.connect_latency_ms / 1000.0)
+    server, url = start_server(s3, args.host, args.port, args.verbose)
+    print("S3_URL=%s" % url)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -30,12 +30,72 @@ ServerGroup = namedtuple(
      'members_with_conflicts',
      ))
 
+PolicyStats = namedtuple(
+    'PolicyStats',
+    ('groups',
+     'conflicts',
+     'colocated_members',
+     'worst_ratio',
+     ))
+
 LOCAL_DEBUG           = False
 NAGIOS_STATE_OK       = 0
 NAGIOS_STATE_WARNING  = 1
 NAGIOS_STATE_CRITICAL = 2
 NAGIOS_STATE_UNKNOWN  = 3
 
+# Servers and server groups fetched per API request
+PAGE_SIZE             = 1000
+# check_nrpe cuts plugin output at 1024 characters
+NRPE_OUTPUT_LIMIT     = 1024
+
+ANTI_AFFINITY_POLICIES = ('anti-affinity', 'soft-anti-affinity')
+AFFINITY_POLICIES      = ('affinity', 'soft-affinity')
+POLICIES               = ANTI_AFFINITY_POLICIES + AFFINITY_POLICIES
+# Conflicts in these policies make the check CRITICAL
+HARD_POLICIES          = ('anti-affinity', 'affinity')
+
+
+def group_policy(server_group):
+  '''
+  Policy of a server group, from "policy" as of compute API 2.64 or the
+  first of "policies" before it
+  '''
+  policy = getattr(server_group, 'policy', None)
+  if policy:
+    return policy
+  policies = getattr(server_group, 'policies', None) or [None]
+  return policies[0]
+
+
+def group_spread(policy, host_members, hypervisor_count):
+  '''
+  Placement of one group from its members per hypervisor. Returns whether
+  it breaks the policy, the members placed against the policy and the
+  packing ratio: for anti-affinity the most members on one hypervisor
+  divided by the ideal, for affinity the members divided by the most on
+  one hypervisor. 1.0 is an ideal placement.
+  '''
+  counts = [len(members) for members in host_members.values()]
+  if not counts:
+    return False, [], 0.0
+  placed = sum(counts)
+  most = max(counts)
+  if policy in ANTI_AFFINITY_POLICIES:
+    ideal = max(1, -(-placed // max(hypervisor_count, 1)))
+    misplaced = [vm_id for members in host_members.values()
+                 if len(members) > 1 for vm_id in members]
+    return most > 1, misplaced, most / float(ideal)
+  # Members outside the host holding most of the group
+  largest = max(host_members.values(), key=len)
+  misplaced = [vm_id for members in host_members.values()
+               if members is not largest for vm_id in members]
+  return len(counts) > 1, misplaced, placed / float(most)
+
+
+def perfdata_name(policy):
+  return policy.replace('-', '_')
+
 
 class CheckOpenStackException(Exception):
   ''' Base Exception '''
@@ -129,7 +189,6 @@ def keystone_session_v3(options):
   return sessionx
 
 class AntiAffinityChecker:
-  dict_ = {}
   def __init__(self, options):
     #creds = OSCredentials(options).provide_keystone_v3()
     self.keystone_session = keystone_session_v3(options)
@@ -166,76 +225,137 @@ class AntiAffinityChecker:
       print('Credentials not loaded to environment: did you load the rc file?')
       exit(1)
 
-  def vm_server(self, vm_id=0):
-    if "vm_id" + vm_id not in self.dict_.keys():
-      self.dict_["vm_id" + vm_id] = self.nova.servers.get(vm_id)
-    return self.dict_["vm_id" + vm_id]
-
-  def vm_host(self, vm_id=0):
-    try:
-      host = self.vm_server(vm_id).to_dict()[
-          "OS-EXT-SRV-ATTR:host"]
-      return host
-    except BaseException:
-      return None
-
-  def vm_hypervisor_id(self, vm_id=0):
-    vm_host = self.vm_host(vm_id)
-    if vm_host == None:
-      return None
-    return self.nova.hypervisors.search(vm_host).pop().to_dict()['id']
+  def server_hosts(self):
+    '''
+    Map server id to compute host for every server of every project, from
+    one paginated listing instead of a request per group member
+    '''
+    hosts = {}
+    marker = None
+    while True:
+      page = self.nova.servers.list(search_opts={'all_tenants': True},
+                                    limit=PAGE_SIZE, marker=marker)
+      if not page:
+        break
+      for server in page:
+        hosts[server.id] = getattr(server, 'OS-EXT-SRV-ATTR:host', None)
+      marker = page[-1].id
+    return hosts
+
+  def host_hypervisors(self):
+    '''
+    Map compute host to hypervisor id from one hypervisor listing
+    '''
+    hypervisors = {}
+    for hypervisor in self.nova.hypervisors.list(detailed=True):
+      service = getattr(hypervisor, 'service', None) or {}
+      host = service.get('host', hypervisor.hypervisor_hostname)
+      hypervisors[host] = hypervisor.id
+    return hypervisors
+
+  def server_groups(self):
+    '''
+    All server groups of all projects. The API pages them by offset and
+    returns at most one page without a limit. Pages can be shorter than
+    PAGE_SIZE when osapi_max_limit is lower, so only an empty page ends
+    the listing.
+    '''
+    offset = 0
+    while True:
+      page = self.nova.server_groups.list(all_projects=True,
+                                          limit=PAGE_SIZE, offset=offset)
+      if not page:
+        break
+      for server_group in page:
+        yield server_group
+      offset += len(page)
 
   def run(self):
     server_group_list = []
-    for server_group in self.nova.server_groups.list(all_projects=True):
-      if server_group.policies[0] != "anti-affinity" and server_group.policies[0] != "soft-anti-affinity":
+    server_hosts = self.server_hosts()
+    host_hypervisors = self.host_hypervisors()
+    groups = dict((policy, 0) for policy in POLICIES)
+    conflicts = dict((policy, 0) for policy in POLICIES)
+    colocated = dict((policy, 0) for policy in POLICIES)
+    worst = dict((policy, 0.0) for policy in POLICIES)
+    for server_group in self.server_groups():
+      policy = group_policy(server_group)
+      if policy not in POLICIES:
         continue
       hosts = {}
       for vm_id in server_group.members:
-        vm_hypervisor_id = self.vm_hypervisor_id(vm_id)
-        if vm_hypervisor_id is None:
+        vm_host = server_hosts.get(vm_id)
+        if vm_host is None:
           continue
-        if vm_hypervisor_id not in hosts.keys():
-          hosts[vm_hypervisor_id] = set()
-        hosts[vm_hypervisor_id].add(vm_id)
-      for host_id in hosts.keys():
-        if len(hosts[host_id]) > 1:
-          server_group_list.append(
-            ServerGroup(
-              server_group.id,
-              server_group.policies[0],
-              list(hosts[host_id])
-            )
-          )
-
-    self.execute_check(server_group_list)
-
-  def execute_check(self, server_group_list):
-
-    if len(server_group_list) == 0:
-      print("OK : There is no conflict")
-      sys.exit(NAGIOS_STATE_OK)
-
-    exit_code = NAGIOS_STATE_OK
-    list_server_group_anti_affinity = []
-    list_server_group_soft_anti_affinity = []
-
-    for server_group in server_group_list:
-      if server_group.policy == "anti-affinity":
-        exit_code = NAGIOS_STATE_CRITICAL
-        list_server_group_anti_affinity.append(server_group.id)
-      else:
-        list_server_group_soft_anti_affinity.append(server_group.id)
-
-    if exit_code == NAGIOS_STATE_OK:
-      output = 'OK : The following server groups with soft-anti-affinity have conflicts: '
-      output = output + ", ".join(str(id) for id in list_server_group_soft_anti_affinity)
-    else:
+        # A host missing from the hypervisor list still groups its servers
+        vm_hypervisor_id = host_hypervisors.get(vm_host, vm_host)
+        hosts.setdefault(vm_hypervisor_id, set()).add(vm_id)
+      (conflict, misplaced, ratio) = group_spread(policy, hosts,
+                                                  len(host_hypervisors))
+      groups[policy] += 1
+      colocated[policy] += len(misplaced)
+      worst[policy] = max(worst[policy], ratio)
+      if conflict:
+        conflicts[policy] += 1
+        server_group_list.append(
+          ServerGroup(server_group.id, policy, misplaced))
+
+    stats = dict((policy, PolicyStats(groups[policy], conflicts[policy],
+                                      colocated[policy], worst[policy]))
+                 for policy in POLICIES)
+    self.execute_check(server_group_list, stats)
+
+  def perfdata(self, stats):
+    values = []
+    for policy in POLICIES:
+      name = perfdata_name(policy)
+      values.append('%s_groups=%d' % (name, stats[policy].groups))
+      values.append('%s_conflicts=%d' % (name, stats[policy].conflicts))
+      values.append('%s_colocated_members=%d' % (name, stats[policy].colocated_members))
+      values.append('%s_worst_ratio=%.2f' % (name, stats[policy].worst_ratio))
+    return ' '.join(values)
+
+  def id_list(self, ids, room):
+    '''
+    Comma separated ids, cut to fit in room characters with a count of
+    the ids left out
+    '''
+    output = ", ".join(str(id) for id in ids)
+    if len(output) <= room:
+      return output
+    shown = []
+    for (index, id) in enumerate(ids):
+      more = ' (%d more)' % (len(ids) - index)
+      if len(", ".join(shown + [str(id)])) + len(more) > room:
+        return ", ".join(shown) + more
+      shown.append(str(id))
+    return ", ".join(shown)
+
+  def execute_check(self, server_group_list, stats):
+    perfdata = self.perfdata(stats)
+    hard_conflicts = [server_group.id for server_group in server_group_list
+                      if server_group.policy in HARD_POLICIES]
+    soft_conflicts = [server_group.id for server_group in server_group_list
+                      if server_group.policy not in HARD_POLICIES]
+
+    if hard_conflicts:
+      exit_code = NAGIOS_STATE_CRITICAL
       output = 'CRITICAL : The following server groups have conflicts: '
-      output = output + ", ".join(str(id) for id in list_server_group_anti_affinity)
-
-    print(output)
-    exit(exit_code)
+      ids = hard_conflicts
+    elif soft_conflicts:
+      exit_code = NAGIOS_STATE_OK
+      output = 'OK : The following server groups with soft policies have conflicts: '
+      ids = soft_conflicts
+    else:
+      exit_code = NAGIOS_STATE_OK
+      output = 'OK : There is no conflict'
+      ids = []
+
+    if ids:
+      room = NRPE_OUTPUT_LIMIT - len(output) - len(perfdata) - len(' | ')
+      output = output + self.id_list(ids, room)
+    print(output + ' | ' + perfdata)
+    sys.exit(exit_code)
 
 
 def main():
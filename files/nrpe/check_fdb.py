@@ -7,12 +7,26 @@ The script compares the data about reachability of virtual machines in vxlan
 networks. Specifically, the script compares the data from the remote database
 with the data contained in the local forwarding database (fdb).
 If the data matches, the script exits with return code 0.
-If there are discrepancies, the script exits with return code 1.
+If entries of active ports are missing from the fdb, it exits with return
+code 1, and if entries point to the wrong hypervisor, with return code 2.
+
+With --export, the script instead runs the database query once and writes
+a snapshot of the expected fdb entries of the whole cloud to a file. Run
+from one host on a schedule, and served over HTTP if needed, the snapshot
+can be read by the checks of every node with --snapshot, so that the
+database is only queried when the snapshot is missing or stale.
 """
 
 import argparse
+import gzip
+import json
+import os
+import os.path
 import subprocess
 import sys
+import tempfile
+import time
+import urllib.request
 
 import MySQLdb
 
@@ -25,7 +39,8 @@ QUERY = ("SELECT "
          "instances.UUID,"
          "ports.mac_address,"
          "json_unquote(json_extract(agents.configurations,'$.tunneling_ip')) as ip,"
-         "networksegments.segmentation_id "
+         "networksegments.segmentation_id,"
+         "ports.status "
          "FROM "
          "nova.instances "
          "INNER JOIN neutron.ports ON instances.UUID = ports.device_id "
@@ -36,17 +51,60 @@ QUERY = ("SELECT "
          "AND "
          "networksegments.network_type = 'vxlan'")
 
-FDB_COMMAND = """bridge fdb show | grep dst | grep vxlan | awk '{ print $1" "substr($3,7)" "$5 }'"""
+# restricts QUERY to the vxlan ids of the local fdb, filled with one
+# placeholder per id
+VXLAN_ID_FILTER = " AND networksegments.segmentation_id IN (%s)"
+# vxlan ids per query, to keep each statement and its IN list small
+QUERY_BATCH_SIZE = 1000
+
+FDB_COMMAND = ["bridge", "-j", "fdb", "show"]
+# vxlan devices with the local tunnel endpoint address
+LOCAL_IP_COMMAND = ["ip", "-j", "-d", "link", "show", "type", "vxlan"]
+# vxlan devices of the linuxbridge agent are named after their VNI
+VXLAN_DEVICE_PREFIX = "vxlan-"
+# characters of bridge output parsed at a time
+FDB_READ_SIZE = 64 * 1024
+
+# format of the snapshots written by --export
+SNAPSHOT_VERSION = 2
+# seconds after which a snapshot is not used
+DEFAULT_SNAPSHOT_MAX_AGE = 900
+# seconds to wait for a snapshot from an HTTP URL
+SNAPSHOT_TIMEOUT = 30
 
 EXCLUDED_MACS = [
     "00:00:00:00:00:00",
 ]
 
-def get_data_from_db(db_data, database, user, password):
+# entries listed after the summary line, per category
+MAX_REPORTED_ENTRIES = 20
+
+def vxlan_id_queries(vxlan_ids):
+    """
+    The function returns the (query, parameters) pairs retrieving the rows
+    of the given vxlan ids, at most QUERY_BATCH_SIZE ids per query. Without
+    vxlan_ids, a single query retrieves the rows of every vxlan network.
+    """
+    if vxlan_ids is None:
+        return [(QUERY, None)]
+    ids = sorted(int(vxlan_id) for vxlan_id in vxlan_ids if vxlan_id.isdigit())
+    queries = []
+    for start in range(0, len(ids), QUERY_BATCH_SIZE):
+        batch = ids[start:start + QUERY_BATCH_SIZE]
+        queries.append((QUERY + VXLAN_ID_FILTER % ", ".join(["%s"] * len(batch)),
+                        batch))
+    return queries
+
+def get_data_from_db(db_data, database, user, password, vxlan_ids=None):
     """
     The function retrieves the data about the reachability of the virtual
-    machines from the database and fills the dictionary db_data with it.
+    machines from the database and fills the dictionary db_data with it,
+    mapping (mac address, vxlan id) to (instance uuid, ip address, whether
+    the port is active). With vxlan_ids, only the rows of those vxlan
+    networks are retrieved.
     """
+    intern = sys.intern
+    conn = None
     try:
         conn = MySQLdb.connect(
             host=database,
@@ -54,17 +112,16 @@ def get_data_from_db(db_data, database, user, password):
             password=password
         )
         cur = conn.cursor()
-        cur.execute(QUERY)
-        for row in cur:
-            # a mac address is not guaranteed to be unique, so we create a key
-            # by combining it with the corresponding vxlan id
-            key=row[1] + "_" + str(row[3])
-            assert key not in db_data.keys()
-            db_data[key] = {}
-            db_data[key]['instance_uuid'] = row[0]
-            db_data[key]['mac_address'] = row[1]
-            db_data[key]['ip_address'] = row[2]
-            db_data[key]['vxlan_id'] = str(row[3])
+        for query, parameters in vxlan_id_queries(vxlan_ids):
+            cur.execute(query, parameters)
+            for instance_uuid, mac_address, ip_address, vxlan_id, status in cur:
+                # a mac address is not guaranteed to be unique, so it is
+                # keyed together with the corresponding vxlan id
+                key = (mac_address, intern(str(vxlan_id)))
+                assert key not in db_data
+                # few distinct tunnel endpoints are shared by all entries
+                db_data[key] = (instance_uuid, ip_address and intern(ip_address),
+                                status == 'ACTIVE')
     except MySQLdb.Error as exception:
         print(f"Error connecting to MariaDB: {exception}")
         return NAGIOS_STATE_CRITICAL
@@ -73,75 +130,304 @@ def get_data_from_db(db_data, database, user, password):
             conn.close()
     return NAGIOS_STATE_OK
 
-def get_data_from_fdb(fdb_data):
+def export_snapshot(path, database, user, password):
+    """
+    The function writes the expected fdb entries of every vxlan network in
+    the database to a gzipped JSON snapshot at path. The entries are grouped
+    by vxlan id and mac address, and the tunnel ip addresses, shared by
+    many entries, are stored once and referred to by their index.
+    """
+    db_data = {}
+    exit_code = get_data_from_db(db_data, database, user, password)
+    if exit_code != NAGIOS_STATE_OK:
+        return exit_code
+    ip_indexes = {}
+    vxlans = {}
+    for (mac_address, vxlan_id), (instance_uuid, ip_address, active) in db_data.items():
+        ip_index = ip_indexes.setdefault(ip_address, len(ip_indexes))
+        vxlans.setdefault(vxlan_id, {})[mac_address] = [instance_uuid, ip_index,
+                                                        int(active)]
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': int(time.time()),
+        'ip_addresses': sorted(ip_indexes, key=ip_indexes.get),
+        'vxlans': vxlans,
+    }
+    temporary = None
+    try:
+        (fd, temporary) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as output:
+            output.write(json.dumps(snapshot, separators=(',', ':')).encode())
+        # readable by the checks and the web server of other users
+        os.chmod(temporary, 0o644)
+        # replaced atomically, readers never see a partial snapshot
+        os.replace(temporary, path)
+    except OSError as exception:
+        print(f"Failed to write the snapshot {path}: {exception}")
+        if temporary and os.path.exists(temporary):
+            os.unlink(temporary)
+        return NAGIOS_STATE_CRITICAL
+    print(f"exported {len(db_data)} fdb entries of {len(vxlans)} vxlan networks to {path}")
+    return NAGIOS_STATE_OK
+
+def load_snapshot(location, max_age):
+    """
+    The function reads the snapshot written by export_snapshot() from a
+    path or an HTTP URL. It raises ValueError for snapshots of another
+    version or older than max_age seconds, and OSError when the snapshot
+    cannot be read.
+    """
+    if location.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(location, timeout=SNAPSHOT_TIMEOUT) as response:
+            data = response.read()
+    else:
+        with open(location, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+    snapshot = json.loads(gzip.decompress(data))
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {snapshot.get('version')}")
+    age = time.time() - snapshot['created']
+    if age > max_age:
+        raise ValueError(f"snapshot is {int(age)} seconds old")
+    return snapshot
+
+def get_data_from_snapshot(db_data, snapshot, vxlan_ids):
+    """
+    The function fills the dictionary db_data with the entries of the given
+    vxlan ids in the snapshot, as get_data_from_db() would from the
+    database.
+    """
+    ip_addresses = [ip_address and sys.intern(ip_address)
+                    for ip_address in snapshot['ip_addresses']]
+    for vxlan_id in vxlan_ids:
+        entries = snapshot['vxlans'].get(vxlan_id, {})
+        for mac_address, (instance_uuid, ip_index, active) in entries.items():
+            db_data[(mac_address, vxlan_id)] = (instance_uuid, ip_addresses[ip_index],
+                                                bool(active))
+    return NAGIOS_STATE_OK
+
+def iter_json_array(stream):
+    """
+    The function yields the elements of the JSON array read from stream
+    one by one, without holding the whole document in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = stream.read(FDB_READ_SIZE).lstrip()
+    if not buffer:
+        return
+    if buffer[0] != "[":
+        raise ValueError("expected a JSON array")
+    position = 1
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            if position == len(buffer):
+                raise ValueError("more input needed")
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # the element continues in the next piece of input
+            chunk = stream.read(FDB_READ_SIZE)
+            if not chunk:
+                raise ValueError("truncated JSON array")
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+
+def read_fdb(command=FDB_COMMAND):
+    """
+    The function yields a (mac address, vxlan id, destination ip) tuple for
+    every vxlan entry with a destination in the fdb, read from the JSON
+    output of command as it is produced. Excluded mac addresses are
+    skipped.
+    """
+    excluded = set(EXCLUDED_MACS)
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    prefix_length = len(VXLAN_DEVICE_PREFIX)
+    intern = sys.intern
+    try:
+        for entry in iter_json_array(process.stdout):
+            if "dst" not in entry:
+                continue
+            ifname = entry.get("ifname", "")
+            mac_address = entry["mac"]
+            if ifname[:prefix_length] != VXLAN_DEVICE_PREFIX or mac_address in excluded:
+                continue
+            # few distinct tunnel endpoints are shared by all entries
+            yield (mac_address, ifname[prefix_length:], intern(entry["dst"]))
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command,
+                                                stderr=stderr)
+
+def get_data_from_fdb(fdb_data, command=FDB_COMMAND):
     """
     The function retrieves the data about the reachability of the virtual
-    machines from the local fdb and fills the dictionary fdb_data with it.
+    machines from the local fdb and fills the dictionary fdb_data with it,
+    mapping (mac address, vxlan id) to the ip address.
     """
+    intern = sys.intern
     try:
-        output = subprocess.run(
-            FDB_COMMAND,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            check=False
-        )
-        for line in output.stdout.split('\n')[:-1]:
-            pieces = line.split(' ')
-            if pieces[0] not in EXCLUDED_MACS:
-                # a mac address is not guaranteed to be unique, so we create a
-                # key by combining it with the corresponding vxlan id
-                key = pieces[0] + "_" + pieces[1]
-                assert key not in fdb_data.keys()
-                fdb_data[key] = {}
-                fdb_data[key]['mac_address'] = pieces[0]
-                fdb_data[key]['vxlan_id'] = pieces[1]
-                fdb_data[key]['ip_address'] = pieces[2]
+        for mac_address, vxlan_id, ip_address in read_fdb(command):
+            # a mac address is not guaranteed to be unique, so it is keyed
+            # together with the corresponding vxlan id
+            key = (mac_address, intern(vxlan_id))
+            assert key not in fdb_data
+            fdb_data[key] = ip_address
     except subprocess.CalledProcessError as exception:
-        print("Failed to run command:", exception)
+        print("Failed to run command:", exception, exception.stderr.strip())
+        return NAGIOS_STATE_CRITICAL
+    except (OSError, ValueError) as exception:
+        print("Failed to read the fdb:", exception)
         return NAGIOS_STATE_CRITICAL
     return NAGIOS_STATE_OK
 
+def get_local_ips(command=LOCAL_IP_COMMAND):
+    """
+    The function returns the local tunnel endpoint addresses of the vxlan
+    devices. The fdb has no entries for the virtual machines behind them.
+    """
+    output = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+    local_ips = set()
+    for device in json.loads(output.stdout or "[]"):
+        local_ip = device.get("linkinfo", {}).get("info_data", {}).get("local")
+        if local_ip:
+            local_ips.add(local_ip)
+    return local_ips
+
+def compare(db_data, fdb_data, local_ips):
+    """
+    The function compares the two datasets in both directions and returns
+    the keys of
+    - mismatched entries, pointing to another hypervisor than expected
+    - missing entries, of active ports on other hypervisors not in the fdb
+    - unexpected entries, in the fdb but not in the database
+    """
+    mismatched = []
+    missing = []
+    for key, (instance_uuid, ip_address, active) in db_data.items():
+        fdb_ip_address = fdb_data.get(key)
+        if fdb_ip_address is None:
+            if active and ip_address not in local_ips:
+                missing.append(key)
+        elif fdb_ip_address != ip_address:
+            mismatched.append(key)
+    unexpected = [key for key in fdb_data if key not in db_data]
+    return mismatched, missing, unexpected
+
+def report_entries(lines):
+    """
+    The function prints at most MAX_REPORTED_ENTRIES of lines.
+    """
+    for line in lines[:MAX_REPORTED_ENTRIES]:
+        print(line)
+    if len(lines) > MAX_REPORTED_ENTRIES:
+        print(f"... and {len(lines) - MAX_REPORTED_ENTRIES} more")
+
 def main():
     """
     The script:
-    - retrieves the data from the database
     - retrieves the data from the local fdb
-    - iterates over the mac addresses that appear in both datasets
+    - retrieves the data of the vxlan networks in the local fdb from the
+      snapshot, or from the database when there is no usable snapshot
+    - compares the datasets in both directions
     - if some discrepancies between the data about the same virtual machine is
-      found, the script prints it
+      found, or entries of active ports are missing from the fdb, the script
+      prints them
     """
     parser = argparse.ArgumentParser(
         description=("Compares the data on how to reach a virtual machine in "
                      "a vxlan. It compares the data in the database with the "
                      "data in the local forwarding database (fdb).")
         )
-    parser.add_argument('-d','--database', help='FQDN or IP address of the database', required=True)
-    parser.add_argument('-u','--user', help='User of the database', required=True)
-    parser.add_argument('-p','--password', help='Password of the database user', required=True)
+    parser.add_argument('-d','--database', help='FQDN or IP address of the database')
+    parser.add_argument('-u','--user', help='User of the database')
+    parser.add_argument('-p','--password', help='Password of the database user')
+    parser.add_argument('-e','--export', metavar='PATH', help='Write a snapshot of the expected fdb entries of the whole cloud to PATH and exit')
+    parser.add_argument('-s','--snapshot', metavar='PATH_OR_URL', help='Compare against the snapshot at PATH_OR_URL, and query the database only when it is unusable')
+    parser.add_argument('-m','--snapshot-max-age', type=int, default=DEFAULT_SNAPSHOT_MAX_AGE, help='Seconds after which the snapshot is stale (default %(default)s)')
     args = vars(parser.parse_args())
+    database_given = args['database'] and args['user'] and args['password'] is not None
+    if not database_given and (args['export'] or not args['snapshot']):
+        parser.error("--database, --user and --password are required without --snapshot")
+    if args['export']:
+        sys.exit(export_snapshot(args['export'], args['database'], args['user'],
+                                 args['password']))
     exit_code = NAGIOS_STATE_OK
-    db_data = {}
-    exit_code = get_data_from_db(db_data, args['database'], args['user'], args['password'])
+    fdb_data = {}
+    exit_code = get_data_from_fdb(fdb_data)
+    source = "the database"
     if exit_code == NAGIOS_STATE_OK:
-        fdb_data = {}
-        exit_code = get_data_from_fdb(fdb_data)
-        if exit_code == NAGIOS_STATE_OK:
-            for key in set(db_data.keys()).intersection(set(fdb_data.keys())):
-                assert db_data[key]["mac_address"] == fdb_data[key]["mac_address"]
-                assert db_data[key]["vxlan_id"] == fdb_data[key]["vxlan_id"]
-                if db_data[key]['ip_address'] != fdb_data[key]['ip_address']:
-                    print("vm " + db_data[key]["instance_uuid"] + " - " +
-                          "fdb entry for mac address " + db_data[key]['mac_address'] + " " +
-                          "in vxlan " + db_data[key]['vxlan_id'] + " " +
-                          "should point to " +
-                          "hypervisor at address " + db_data[key]["ip_address"] + " " +
-                          "but it is instead pointing to " +
-                          "hypervisor at address " + fdb_data[key]["ip_address"])
-                    exit_code = NAGIOS_STATE_CRITICAL
+        # only the vxlan networks present locally can be compared
+        vxlan_ids = set(vxlan_id for (mac_address, vxlan_id) in fdb_data)
+        db_data = {}
+        snapshot = None
+        if args['snapshot']:
+            try:
+                snapshot = load_snapshot(args['snapshot'], args['snapshot_max_age'])
+            except (OSError, ValueError, KeyError) as exception:
+                source = f"the database, snapshot not used: {exception}"
+                if not database_given:
+                    print(f"Cannot use the fdb snapshot {args['snapshot']}: {exception}")
+                    sys.exit(NAGIOS_STATE_CRITICAL)
+        if snapshot is not None:
+            age = int(time.time() - snapshot['created'])
+            source = f"the database snapshot of {age} seconds ago"
+            exit_code = get_data_from_snapshot(db_data, snapshot, vxlan_ids)
+        else:
+            exit_code = get_data_from_db(db_data, args['database'], args['user'],
+                                         args['password'], vxlan_ids)
     if exit_code == NAGIOS_STATE_OK:
-        print("all fdb entries match the information in the database")
+        try:
+            local_ips = get_local_ips()
+        except (OSError, ValueError, subprocess.CalledProcessError) as exception:
+            print("Failed to read the local tunnel endpoint:", exception)
+            exit_code = NAGIOS_STATE_CRITICAL
+    if exit_code != NAGIOS_STATE_OK:
+        sys.exit(exit_code)
+
+    (mismatched, missing, unexpected) = compare(db_data, fdb_data, local_ips)
+    perfdata = (f"mismatched={len(mismatched)} missing={len(missing)} "
+                f"unexpected={len(unexpected)} fdb_entries={len(fdb_data)} "
+                f"expected_entries={len(db_data)}")
+    if mismatched:
+        exit_code = NAGIOS_STATE_CRITICAL
+    elif missing:
+        exit_code = NAGIOS_STATE_WARNING
+    if exit_code == NAGIOS_STATE_OK:
+        # router and dhcp ports are in the fdb but not in the query, so
+        # unexpected entries are only counted
+        print(f"all fdb entries match the information in {source} | {perfdata}")
+        sys.exit(exit_code)
+
+    print(f"{len(mismatched)} fdb entries point to the wrong hypervisor and "
+          f"{len(missing)} are missing compared to {source} | {perfdata}")
+    report_entries([
+        f"vm {db_data[key][0]} - fdb entry for mac address {key[0]} in vxlan {key[1]} "
+        f"should point to hypervisor at address {db_data[key][1]} but it is instead "
+        f"pointing to hypervisor at address {fdb_data[key]}"
+        for key in sorted(mismatched)])
+    report_entries([
+        f"vm {db_data[key][0]} - fdb entry for mac address {key[0]} in vxlan {key[1]} "
+        f"pointing to hypervisor at address {db_data[key][1]} is missing"
+        for key in sorted(missing)])
     sys.exit(exit_code)
 
 if __name__ == '__main__':
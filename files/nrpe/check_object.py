@@ -12,21 +12,43 @@ import optparse
 import keystoneclient.v2_0.client as keystoneclient
 
 import socket
+import ssl
+import http.client
 import logging
 import yaml
 import re
 
-import subprocess
 import json
+import collections
+from xml.etree import ElementTree
+import base64
+import calendar
+import math
+import random
+import threading
+import copy
+import concurrent.futures
+import hashlib
+import tempfile
+
+from check_profile import add_profile_arguments, start_profiler
 
 import urllib
+import urllib.error
+import urllib.parse
+import urllib.request
 
 # Imports for API availability checks
 import swiftclient
+import boto.connection
+import boto.utils
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.exception import S3ResponseError
 from keystoneauth1 import session
 from keystoneauth1 import identity
+from keystoneauth1 import exceptions as keystoneauth_exceptions
 from keystoneclient.v3 import client as keystoneclientv3
 
 LOCAL_DEBUG           = False
@@ -37,6 +59,43 @@ NAGIOS_STATE_UNKNOWN  = 3
 
 DEFAULT_BUCKET_NAME = "nagiostestbucket4667"
 DEFAULT_DOMAIN_NAME = "default"
+DEFAULT_EC2_CACHE   = os.path.expanduser("~/.cache/check_object/ec2_credentials.json")
+DEFAULT_AUTH_CACHE  = os.path.expanduser("~/.cache/check_object/keystone_auth.json")
+DEFAULT_AUTH_CACHE_TTL = 3600
+# Cached tokens closer than this to expiry are not used
+TOKEN_EXPIRY_MARGIN = 300
+
+DEFAULT_OBJECT_SIZES         = "3M"
+DEFAULT_MULTIPART_THRESHOLD  = "64M"
+MULTIPART_CHUNK_SIZE         = 16 * 1024 * 1024
+READ_CHUNK_SIZE              = 1024 * 1024
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# Content of the test objects, repeated up to the object size
+PAYLOAD_BLOCK = os.urandom(1024 * 1024)
+
+DEFAULT_SEGMENT_THRESHOLD = "64M"
+DEFAULT_SEGMENT_SIZE      = "16M"
+DEFAULT_SEGMENT_TYPE      = "slo"
+DEFAULT_SEGMENT_WORKERS   = 4
+DEFAULT_PHASE_TIMEOUT     = 60
+SEGMENT_TYPES = ['slo', 'dlo']
+
+DEFAULT_LOAD_WORKERS      = 8
+DEFAULT_LOAD_DURATION     = 10
+DEFAULT_LOAD_MIX          = "put=1,get=4,head=2,delete=1"
+DEFAULT_LOAD_OBJECT_SIZE  = "4K"
+LOAD_OPERATIONS  = ['put', 'get', 'head', 'delete']
+LOAD_PERCENTILES = [50, 95, 99]
+
+DEFAULT_HTTP_TIMEOUT = 10
+DEFAULT_S3_POOL_SIZE = 16
+DEFAULT_S3_RETRIES   = 1
+# Bytes of a response body the public probes read at most
+MAX_PROBE_BODY       = 64 * 1024
+PROBE_CHUNK_SIZE     = 4 * 1024
+
+# S3 error codes after which the cached EC2 credentials are looked up again
+S3_AUTH_ERRORS = ['InvalidAccessKeyId', 'SignatureDoesNotMatch', 'AccessDenied']
 
 USE_SECONDS              = True
 
@@ -58,6 +117,40 @@ class CredentialsOrParametersMissingException(CheckObjectException):
 class ProjectNotAvailableException(CheckObjectException):
   msg_fmt = "Project does not exist with name: %(msgs)s"
 
+class EC2CredentialsException(CheckObjectException):
+  msg_fmt = "Could not create EC2 credentials: %(error)s"
+
+class LoadErrorsException(CheckObjectException):
+  msg_fmt = "%(errors)d of %(requests)d requests failed, %(left)d test objects left behind"
+
+  def __init__(self, stats, **kwargs):
+    CheckObjectException.__init__(self, **kwargs)
+    self.stats = stats
+
+class PublicBucketException(CheckObjectException):
+  msg_fmt = "%(url)s answered %(status)d (%(code)s)"
+
+class ObjectIntegrityException(CheckObjectException):
+  msg_fmt = "Object %(name)s read back as %(size)d bytes with MD5 %(md5)s, expected %(expected_size)d bytes with MD5 %(expected_md5)s"
+
+class PhaseTimeoutException(CheckObjectException):
+  msg_fmt = "%(phase)s of %(name)s did not finish in %(timeout)s seconds"
+
+class CleanupException(CheckObjectException):
+  msg_fmt = "%(left)d test objects of %(name)s left behind"
+
+  def __init__(self, stats, **kwargs):
+    CheckObjectException.__init__(self, **kwargs)
+    self.stats = stats
+
+def time_used(name, seconds):
+  '''
+  Perfdata entry for the time spent in one part of a check
+  '''
+  if USE_SECONDS:
+    return {name + '_seconds_used': int(seconds)}
+  return {name + '_milliseconds_used': int(1000 * seconds)}
+
 class OSCredentials(object):
   '''
   Read authentication credentials from environment or optionParser
@@ -100,6 +193,72 @@ class OSCredentials(object):
       if not key in self.keystone_v3_cred:
         raise CredentialsOrParametersMissingException(key=key)
 
+class SwiftAuth(object):
+  '''
+  Project id, Swift storage URL and token of the check user, cached on disk.
+  The project id and storage URL are used for --auth-cache-ttl seconds, the
+  token until shortly before it expires, so most runs do not talk to
+  Keystone at all. The time spent here is kept in self.seconds so that it
+  is not reported as Swift latency.
+  '''
+
+  def __init__(self, options):
+    self.creds = OSCredentials(options).provide_keystone_v3()
+    self.cache = CredentialsCache(options.auth_cache or DEFAULT_AUTH_CACHE, self.creds)
+    self.ttl = options.auth_cache_ttl or DEFAULT_AUTH_CACHE_TTL
+    # Set with --endpoints, replaces the host of the catalog's storage URL
+    self.endpoint = getattr(options, 'endpoint', None)
+    self.seconds = 0.0
+
+  def lookup(self):
+    auth = identity.v3.Password(**self.creds)
+    session_ = session.Session(auth=auth)
+    access = auth.get_access(session_)
+    if access.project_id is None:
+      raise ProjectNotAvailableException(msgs=self.creds['project_name'])
+    try:
+      storage_url = session_.get_endpoint(service_type='object-store', interface='public')
+    except keystoneauth_exceptions.EndpointNotFound:
+      storage_url = None
+    return {
+      'project_id': access.project_id,
+      'storage_url': storage_url,
+      'token': access.auth_token,
+      'expires_at': calendar.timegm(access.expires.utctimetuple()),
+      'cached_at': time.time(),
+    }
+
+  def get(self, token=False, refresh=False):
+    '''
+    Return the cached entry, looked up again when it is too old, when a
+    token is needed and the cached one is about to expire, or on refresh,
+    which is done after Swift rejected the cached token.
+    '''
+    started = time.time()
+    try:
+      cached = self.cache.get()
+      if cached and not refresh and started - cached['cached_at'] < self.ttl and \
+         (not token or cached['expires_at'] - TOKEN_EXPIRY_MARGIN > started):
+        return cached
+      entry = self.lookup()
+      self.cache.put(entry)
+      return entry
+    finally:
+      self.seconds += time.time() - started
+
+  def swift_connection(self, refresh=False, **kwargs):
+    '''
+    swiftclient Connection using the cached storage URL and token. Other
+    Connection arguments, like retries and timeout, are passed on.
+    '''
+    entry = self.get(token=True, refresh=refresh)
+    storage_url = entry['storage_url']
+    if self.endpoint:
+      endpoint = urllib.parse.urlsplit(self.endpoint)
+      storage_url = urllib.parse.urlunsplit(endpoint[:2] + urllib.parse.urlsplit(storage_url)[2:])
+    return swiftclient.client.Connection(preauthurl=storage_url,
+                                         preauthtoken=entry['token'], **kwargs)
+
 class OSSwiftAvailability():
   '''
   Check Swift API call length by listing containers with get_accounts
@@ -107,18 +266,7 @@ class OSSwiftAvailability():
   options = dict()
 
   def __init__(self, options):
-    creds = OSCredentials(options).provide_keystone_v3()
-    os_options = {
-        'user_domain_name': creds['user_domain_name'],
-        'project_domain_name': creds['project_domain_name'],
-        'project_name': creds['project_name']
-    }
-    self.conn = swiftclient.client.Connection(
-                authurl = creds['auth_url'],
-                user = creds['username'],
-                key = creds['password'],
-                auth_version = '3',
-                os_options = os_options )
+    self.auth = SwiftAuth(options)
 
   def get_swift_buckets(self):
     resp_headers, containers = self.conn.get_account()
@@ -129,44 +277,162 @@ class OSSwiftAvailability():
 
   def execute(self):
     results = dict()
+    self.conn = self.auth.swift_connection()
+    started = time.time()
     try:
       self.get_swift_buckets()
-    except:
-      raise
+    except swiftclient.exceptions.ClientException as e:
+      if e.http_status != 401:
+        raise
+      # Token revoked before it expired
+      self.conn = self.auth.swift_connection(refresh=True)
+      started = time.time()
+      self.get_swift_buckets()
+    results.update(time_used('swift', time.time() - started))
+    results.update(time_used('keystone', self.auth.seconds))
+    return results
+
+class HTTPProbe(object):
+  '''
+  One keep-alive HTTP(S) connection to the host of url, with DNS, TCP
+  connect and TLS handshake timed separately. Response bodies are read up
+  to MAX_PROBE_BODY bytes only; a connection with more left unread is not
+  reused.
+  '''
+
+  def __init__(self, url, timeout=DEFAULT_HTTP_TIMEOUT):
+    self.url = urllib.parse.urlsplit(url)
+    self.timeout = timeout
+    self.port = self.url.port or (443 if self.url.scheme == 'https' else 80)
+    self.conn = None
+    self.response = None
+    self.phases = dict()
+
+  def connect(self):
+    started = time.time()
+    address = socket.getaddrinfo(self.url.hostname, self.port, 0, socket.SOCK_STREAM)[0][4]
+    resolved = time.time()
+    sock = socket.create_connection(address[:2], self.timeout)
+    connected = time.time()
+    if self.url.scheme == 'https':
+      sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.url.hostname)
+      self.conn = http.client.HTTPSConnection(self.url.hostname, self.port, timeout=self.timeout)
+    else:
+      self.conn = http.client.HTTPConnection(self.url.hostname, self.port, timeout=self.timeout)
+    self.conn.sock = sock
+    self.phases = {'dns': resolved - started, 'connect': connected - resolved,
+                   'tls': time.time() - connected}
+
+  def request(self, method, path):
+    '''
+    Send one request and return (status, body, seconds to first byte). The
+    body is body_chunks() of the response, to be read as far as needed
+    before the next request.
+    '''
+    if self.response is not None and (not self.response.isclosed() or self.response.will_close):
+      # Body left unread, drop the connection instead of reading the rest
+      self.close()
+    if self.conn is None:
+      self.connect()
+    started = time.time()
+    self.conn.request(method, path)
+    self.response = self.conn.getresponse()
+    ttfb = time.time() - started
+    return (self.response.status, body_chunks(self.response), ttfb)
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+      self.conn = None
+    self.response = None
+
+def body_chunks(response, limit=MAX_PROBE_BODY):
+  '''
+  The body of response in chunks of at most PROBE_CHUNK_SIZE bytes as they
+  arrive, limit bytes in all
+  '''
+  while limit > 0:
+    chunk = response.read1(min(PROBE_CHUNK_SIZE, limit))
+    if not chunk:
+      # read1() leaves the response open at its end, read() closes it so
+      # that the connection can be reused
+      response.read()
+      return
+    limit -= len(chunk)
+    yield chunk
+
+def s3_error_code(chunks):
+  '''
+  Code of an S3 XML error document, fed to the parser chunk by chunk and
+  read no further than its Code element
+  '''
+  parser = ElementTree.XMLPullParser(events=['end'])
+  try:
+    for chunk in chunks:
+      parser.feed(chunk)
+      for (_, element) in parser.read_events():
+        if element.tag.rsplit('}', 1)[-1] == 'Code':
+          return element.text
+  except ElementTree.ParseError:
+    pass
+  return None
 
 class S3PublicAvailability():
   '''
-  Check S3 API call length by listing contents of a public bucket
+  Check S3 API call length by listing at most one key of a public bucket,
+  or with HEAD when --public-method head is given. The status code decides,
+  only a bounded part of the response is read. With --samples the request
+  is repeated on the same keep-alive connection.
   '''
   options = dict()
 
   def __init__(self, options):
-     self.options = options
-     True
+    self.options = options
+    self.method = (options.public_method or 'GET').upper()
+    self.samples = max(1, options.samples or 1)
+    url = urllib.parse.urlsplit(options.s3_bucket_url)
+    query = url.query
+    if self.method == 'GET':
+      query = '&'.join(q for q in [query, 'max-keys=1'] if q)
+    self.path = urllib.parse.urlunsplit(('', '', url.path or '/', query, ''))
+    self.probe = HTTPProbe(options.s3_bucket_url)
 
   def list_public_s3_objects(self):
-    """ read a public S3 URL with urllib
+    """ request a public S3 URL anonymously
     This does not create a public bucket if one does not exist.
     This fails if the bucket does not exist or if it's private.
     """
-    _response = urllib.request.urlopen(self.options.s3_bucket_url)
-    _html = _response.read().decode('utf-8')
+    (status, body, ttfb) = self.probe.request(self.method, self.path)
 
     if LOCAL_DEBUG:
-      print(_html)
+      print(status)
 
-    try:
-      assert "AccessDenied" not in _html
-      assert "NoSuchBucket" not in _html
-    except:
-      print("ERROR: AccessDenied or NoSuchBucket for {}".format(self.options.s3_bucket_url))
-      raise
+    if status != 200:
+      raise PublicBucketException(url=self.options.s3_bucket_url, status=status,
+                                  code=s3_error_code(body) or 'no error code')
+    for chunk in body:
+      if LOCAL_DEBUG:
+        print(chunk)
+    return ttfb
 
   def execute(self):
+    results = dict()
+    ttfbs = []
     try:
-      self.list_public_s3_objects()
-    except:
-      raise
+      for sample in range(self.samples):
+        ttfbs.append(self.list_public_s3_objects())
+        if sample == 0:
+          phases = dict(self.probe.phases)
+    finally:
+      self.probe.close()
+    for phase in ['dns', 'connect', 'tls']:
+      results.update(time_used(phase, phases[phase]))
+    results.update(time_used('ttfb', ttfbs[0]))
+    if self.samples > 1:
+      ttfbs = sorted(ttfbs[1:])
+      results.update(time_used('ttfb_warm_p50', percentile(ttfbs, 50)))
+      results.update(time_used('ttfb_warm_max', ttfbs[-1]))
+    return results
 
 class SwiftPublicAvailability():
   '''
@@ -176,7 +442,7 @@ class SwiftPublicAvailability():
 
   def __init__(self, options):
 
-    self.creds = OSCredentials(options)
+    self.auth = SwiftAuth(options)
 
     try:
       if options.swift_publicurl is not None:
@@ -202,149 +468,517 @@ class SwiftPublicAvailability():
     except KeyError: 
       raise CredentialsOrParametersMissingException(key='tenant')
 
-  def list_public_swift_objects(self):
-    """ read a public swift URL with urllib
+  def list_public_swift_objects(self, project_id):
+    """ HEAD a public swift URL anonymously with urllib, no body is read
     This does not create a public bucket if one does not exist.
     This fails if the bucket does not exist or if it's private.
     """
-    msgs = []
-    auth = identity.v3.Password(**self.creds.provide_keystone_v3())
-    session_ = session.Session(auth=auth)
-    keystone = keystoneclientv3.Client(session=session_)
+    swift_url = "{}/AUTH_{}/{}".format(self.swift_publicurl,project_id,self.swift_bucket)
+    try:
+      with urllib.request.urlopen(urllib.request.Request(swift_url, method='HEAD')) as response:
+        (status, reason) = (response.status, response.reason)
+    except urllib.error.HTTPError as e:
+      (status, reason) = (e.code, e.reason)
 
-    project_id = keystone.projects.client.get_project_id()
+    if LOCAL_DEBUG:
+      print(status, reason)
 
-    if project_id == None:
-      raise ProjectNotAvailableException(msgs=self.tenant)
+    if not 200 <= status < 300:
+      raise PublicBucketException(url=swift_url, status=status, code=reason)
 
-    swift_url = "{}/AUTH_{}/{}".format(self.swift_publicurl,project_id,self.swift_bucket)
-    _response = urllib.request.urlopen(swift_url)
-    _html = _response.reason
+  def execute(self):
+    results = dict()
+    project_id = self.auth.get()['project_id']
+    started = time.time()
+    self.list_public_swift_objects(project_id)
+    results.update(time_used('swift', time.time() - started))
+    results.update(time_used('keystone', self.auth.seconds))
+    return results
 
-    if LOCAL_DEBUG:
-      print(_html)
+def s3_host_arguments(s3_host):
+  '''
+  S3Connection arguments for --s3_host. A plain host name is used with
+  HTTPS as before; a URL like http://127.0.0.1:8080 also sets the scheme
+  and port and uses path style bucket names.
+  '''
+  if '://' not in s3_host:
+    return {'host': s3_host}
+  url = urllib.parse.urlsplit(s3_host)
+  return {'host': url.hostname, 'port': url.port, 'is_secure': url.scheme == 'https',
+          'calling_format': OrdinaryCallingFormat()}
 
-    try:
-      assert "AccessDenied" not in _html
-      assert "NoSuchBucket" not in _html
-    except:
-      print("ERROR: AccessDenied or NoSuchBucket for {}".format(swift_url))
-      raise
+class TimedHTTPConnection(http.client.HTTPConnection):
+  '''
+  HTTP(S) connection that reports how long DNS, TCP connect, TLS handshake
+  and each request until its response headers took to transport.phase()
+  '''
 
-    try:
-      assert "NoSuchKey" not in _html
-    except:
-      print("ERROR: NoSuchKey for {}".format(swift_url))
-      raise
+  def __init__(self, host, port, is_secure, transport):
+    http.client.HTTPConnection.__init__(self, host, port, timeout=transport.timeout)
+    self.is_secure = is_secure
+    self.transport = transport
+    self.request_started = None
+
+  def connect(self):
+    started = time.time()
+    address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0][4]
+    resolved = time.time()
+    self.sock = socket.create_connection(address[:2], self.timeout)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connected = time.time()
+    if self.is_secure:
+      self.sock = ssl.create_default_context().wrap_socket(self.sock, server_hostname=self.host)
+    self.transport.phase('dns', resolved - started)
+    self.transport.phase('connect', connected - resolved)
+    self.transport.phase('tls', time.time() - connected)
+
+  def putrequest(self, *args, **kwargs):
+    # Both request() and boto's streaming uploads start here
+    self.request_started = time.time()
+    http.client.HTTPConnection.putrequest(self, *args, **kwargs)
+
+  def getresponse(self):
+    response = http.client.HTTPConnection.getresponse(self)
+    if self.request_started is not None:
+      self.transport.phase('response', time.time() - self.request_started)
+      self.request_started = None
+    return response
+
+class S3Transport(object):
+  '''
+  Connection pool for the S3 checks, shared by all their S3Connections and
+  threads. Keeps at most pool_size idle keep-alive connections in total,
+  uses explicit timeouts and retries instead of the boto defaults, and
+  passes the time of every connection phase to the callbacks, which are
+  called with (phase, seconds). The phases are dns, connect, tls and
+  response, from the start of a request until its response headers.
+  By default the phases are summed up in self.totals.
+  '''
 
-  def execute(self):
+  def __init__(self, pool_size=DEFAULT_S3_POOL_SIZE, timeout=DEFAULT_HTTP_TIMEOUT,
+               retries=DEFAULT_S3_RETRIES, callbacks=None):
+    self.pool_size = pool_size
+    self.timeout = timeout
+    self.retries = retries
+    self.callbacks = callbacks if callbacks is not None else [self.total]
+    self.pool = boto.connection.ConnectionPool()
+    self.lock = threading.Lock()
+    self.totals = collections.defaultdict(float)
+    self.counts = collections.defaultdict(int)
+
+  def phase(self, name, seconds):
+    for callback in self.callbacks:
+      callback(name, seconds)
+
+  def total(self, name, seconds):
+    with self.lock:
+      self.totals[name] += seconds
+      self.counts[name] += 1
+
+  def new_connection(self, host, port, is_secure):
+    connection = TimedHTTPConnection(boto.utils.parse_host(host), port, is_secure, self)
+    connection.response_class = boto.connection.HTTPResponse
+    return connection
+
+  def get_connection(self, host, port, is_secure):
+    return self.pool.get_http_connection(host, port, is_secure) or \
+      self.new_connection(host, port, is_secure)
+
+  def put_connection(self, host, port, is_secure, connection):
+    if self.pool.size() >= self.pool_size:
+      connection.close()
+    else:
+      self.pool.put_http_connection(host, port, is_secure, connection)
+
+  def perfdata(self, prefix):
+    '''
+    Connections opened, requests sent and the summed phase times
+    '''
+    results = dict()
+    with self.lock:
+      results[prefix + '_connections'] = self.counts['connect']
+      results[prefix + '_requests'] = self.counts['response']
+      for name in ['dns', 'connect', 'tls', 'response']:
+        results.update(time_used('%s_%s' % (prefix, name), self.totals[name]))
+    return results
+
+class PooledS3Connection(S3Connection):
+  '''
+  boto S3Connection that takes its HTTP connections from an S3Transport
+  '''
+
+  def __init__(self, transport, **kwargs):
+    self.transport = transport
+    S3Connection.__init__(self, **kwargs)
+    self.num_retries = transport.retries
+
+  def get_http_connection(self, host, port, is_secure):
+    return self.transport.get_connection(host, port, is_secure)
+
+  def new_http_connection(self, host, port, is_secure):
+    return self.transport.new_connection(host, port, is_secure)
+
+  def put_http_connection(self, host, port, is_secure, connection):
+    self.transport.put_connection(host, port, is_secure, connection)
+
+class CredentialsCache(object):
+  '''
+  JSON file of cached credentials, shared by the checks run as the same
+  user. The file is only ever readable by its owner and replaced
+  atomically. Entries are keyed by auth URL, user and project.
+  '''
+
+  def __init__(self, path, creds):
+    self.path = path
+    self.key = hashlib.sha256("{auth_url} {username} {project_name}".format(
+                 **creds).encode('utf-8')).hexdigest()
+
+  def read(self):
     try:
-      self.list_public_swift_objects()
-    except:
-      raise
+      with open(self.path) as cache:
+        return json.load(cache)
+    except (IOError, OSError, ValueError):
+      return dict()
+
+  def get(self):
+    return self.read().get(self.key)
+
+  def put(self, entry):
+    cached = self.read()
+    cached[self.key] = entry
+    directory = os.path.dirname(self.path)
+    try:
+      if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+      fd, path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path))
+      with os.fdopen(fd, 'w') as cache:
+        json.dump(cached, cache)
+      os.rename(path, self.path)
+    except (IOError, OSError) as e:
+      # Not fatal, the next run looks the credentials up again
+      logging.warning('Could not write credentials cache %s: %s', self.path, e)
+
+class EC2Credentials(object):
+  '''
+  EC2 access/secret pair of the check user for the S3 checks. Looked up, or
+  created when the user has none for the project, through the Keystone v3
+  API and cached on disk so that most runs do not talk to Keystone at all.
+  The time spent here is kept in self.seconds so that it is not reported
+  as S3 latency.
+  '''
+
+  def __init__(self, options):
+    self.creds = OSCredentials(options).provide_keystone_v3()
+    self.cache = CredentialsCache(options.ec2_cache or DEFAULT_EC2_CACHE, self.creds)
+    self.seconds = 0.0
 
-class S3PrivateAvailability():
+  def lookup(self):
+    auth = identity.v3.Password(**self.creds)
+    session_ = session.Session(auth=auth)
+    keystone = keystoneclientv3.Client(session=session_)
+    user_id = session_.get_user_id()
+    project_id = session_.get_project_id()
+
+    for credential in keystone.ec2.list(user_id):
+      if getattr(credential, 'tenant_id', getattr(credential, 'project_id', None)) == project_id:
+        return (credential.access, credential.secret)
+    try:
+      credential = keystone.ec2.create(user_id, project_id)
+    except Exception as e:
+      raise EC2CredentialsException(error=e.__class__.__name__)
+    return (credential.access, credential.secret)
+
+  def get(self, refresh=False):
+    '''
+    Return (access, secret). With refresh the cache is ignored, which is
+    done after the S3 endpoint rejected the cached pair.
+    '''
+    started = time.time()
+    try:
+      cached = self.cache.get()
+      if cached and not refresh:
+        return (cached['access'], cached['secret'])
+      (access, secret) = self.lookup()
+      if LOCAL_DEBUG:
+        print(access)
+      self.cache.put({'access': access, 'secret': secret})
+      return (access, secret)
+    finally:
+      self.seconds += time.time() - started
+
+class S3Check(object):
   '''
-  Check S3 API call length by listing private containers with get_accounts
-  http://boto.cloudhackers.com/en/latest/s3_tut.html
+  Base class of the checks that talk to S3 with the EC2 credentials of the
+  check user. Subclasses implement s3_check(), which is retried once with
+  fresh credentials when S3 rejects the cached ones.
   Only works with Keystone Auth URL v3
   '''
   options = dict()
 
   def __init__(self, options):
-
-  # First we try to list the ec2 credentials
+    self.options = options
+    self.ec2 = EC2Credentials(options)
+    self.transport = S3Transport(options.s3_pool_size or DEFAULT_S3_POOL_SIZE,
+                                 options.s3_timeout or DEFAULT_HTTP_TIMEOUT)
+
+  def connect(self, refresh=False):
+    (self.access_key, self.secret_key) = self.ec2.get(refresh)
+    self.conn = self.s3_connection()
+
+  def s3_connection(self):
+    return PooledS3Connection(self.transport, aws_access_key_id=self.access_key, aws_secret_access_key=self.secret_key, **s3_host_arguments(self.options.s3_host))
+
+  def test_bucket(self):
+    '''
+    Return the bucket the checks write to, created when missing
+    '''
     try:
-      res = json.loads(subprocess.check_output(["openstack", "--os-auth-url", options.auth_url, "--os-username", options.username, "--os-password", options.password, "--os-project-name", options.tenant, "--os-project-domain-name", DEFAULT_DOMAIN_NAME, "--os-user-domain-name", DEFAULT_DOMAIN_NAME, "--os-identity-api-version", "3", "ec2", "credentials", "list", "-f", "json"]))
-      res[0]['Access']
-  # If they don't exist we create some
-    except:
-      try:
-        subprocess.check_output(["openstack", "--os-auth-url", options.auth_url, "--os-username", options.username, "--os-password", options.password, "--os-project-name", options.tenant, "--os-project-domain-name", DEFAULT_DOMAIN_NAME, "--os-user-domain-name", DEFAULT_DOMAIN_NAME, "--os-identity-api-version", "3", "ec2", "credentials", "create"])
-      except:
-        # If we can't create we exit so as to not print passwords to stdout
-        print("Could not create ec2 credentials")
-        sys.exit(NAGIOS_STATE_UNKNOWN)
-      res = json.loads(subprocess.check_output(["openstack", "--os-auth-url", options.auth_url, "--os-username", options.username, "--os-password", options.password, "--os-project-name", options.tenant, "--os-project-domain-name", DEFAULT_DOMAIN_NAME, "--os-user-domain-name", DEFAULT_DOMAIN_NAME, "--os-identity-api-version", "3", "ec2", "credentials", "list", "-f", "json"]))
+      return self.conn.get_bucket(DEFAULT_BUCKET_NAME)
+    except S3ResponseError as e:
+      if e.error_code in S3_AUTH_ERRORS:
+        raise
+      return self.conn.create_bucket(DEFAULT_BUCKET_NAME)
 
-    if LOCAL_DEBUG:
-      print(res)
-    _access_key = res[0]['Access']
-    _secret_key = res[0]['Secret']
-    _s3_host = options.s3_host
+  def execute(self):
+    results = dict()
+    self.connect()
+    started = time.time()
+    try:
+      results.update(self.s3_check() or dict())
+    except S3ResponseError as e:
+      if e.error_code not in S3_AUTH_ERRORS:
+        raise
+      self.connect(refresh=True)
+      started = time.time()
+      results.update(self.s3_check() or dict())
+    results.update(time_used('s3', time.time() - started))
+    results.update(time_used('ec2_credentials', self.ec2.seconds))
+    results.update(self.transport.perfdata('s3'))
+    return results
 
-    self.conn = S3Connection(aws_access_key_id=_access_key, aws_secret_access_key=_secret_key, host=_s3_host)
+class S3PrivateAvailability(S3Check):
+  '''
+  Check S3 API call length by listing private containers with get_accounts
+  http://boto.cloudhackers.com/en/latest/s3_tut.html
+  Only works with Keystone Auth URL v3
+  '''
 
   def get_s3_private_buckets(self):
     all_them_buckets = self.conn.get_all_buckets()
     if LOCAL_DEBUG:
       print(all_them_buckets)
 
-  def execute(self):
-    results = dict()
-    try:
-      self.get_s3_private_buckets()
-    except:
-      raise
+  def s3_check(self):
+    self.get_s3_private_buckets()
 
-class S3FunctionalityTest():
+class PayloadReader(object):
   '''
-  Functionality Test of an S3 Bucket
+  Read-only file object of the given size that repeats PAYLOAD_BLOCK, so
+  test objects of any size are uploaded without a file on disk and without
+  holding the whole object in memory. Starts at offset within the payload
+  for the parts of a multipart upload. Once the cancelled event is set,
+  reads fail, which aborts an upload still sending the payload.
+  '''
+
+  def __init__(self, size, offset=0, cancelled=None):
+    self.size = size
+    self.offset = offset
+    self.position = 0
+    self.cancelled = cancelled
+
+  def read(self, n=-1):
+    if self.cancelled is not None and self.cancelled.is_set():
+      raise IOError('Upload cancelled')
+    left = self.size - self.position
+    if n is None or n < 0 or n > left:
+      n = left
+    n = min(n, len(PAYLOAD_BLOCK))
+    start = (self.offset + self.position) % len(PAYLOAD_BLOCK)
+    data = PAYLOAD_BLOCK[start:start + n]
+    if len(data) < n:
+      data += PAYLOAD_BLOCK[:n - len(data)]
+    self.position += len(data)
+    return data
+
+  def seek(self, position, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      position += self.position
+    elif whence == os.SEEK_END:
+      position += self.size
+    self.position = max(0, min(position, self.size))
+    return self.position
+
+  def tell(self):
+    return self.position
+
+  def md5(self):
+    '''
+    Return the (hexdigest, base64) pair boto expects and rewind
+    '''
+    digest = hashlib.md5()
+    self.seek(0)
+    data = self.read(len(PAYLOAD_BLOCK))
+    while data:
+      digest.update(data)
+      data = self.read(len(PAYLOAD_BLOCK))
+    self.seek(0)
+    return (digest.hexdigest(), base64.b64encode(digest.digest()).decode('ascii'))
+
+class StreamVerifier(object):
+  '''
+  Reads response bodies in READ_CHUNK_SIZE chunks into one buffer that is
+  reused for every read and object, computing the MD5 on the way. Memory
+  use is the same whatever the object size. Works with any file object
+  that has readinto(), such as http.client.HTTPResponse, and falls back to
+  read() for those that do not, like swiftclient object bodies.
+  '''
+
+  def __init__(self, chunk_size=READ_CHUNK_SIZE):
+    self.buffer = memoryview(bytearray(chunk_size))
+
+  def read(self, name, response, started, expected_size, expected_md5):
+    '''
+    Read response to the end and check it is the expected object. started
+    is when the request was sent. Returns (seconds to first byte, seconds
+    to last byte).
+    '''
+    digest = hashlib.md5()
+    size = 0
+    first_byte = None
+    readinto = getattr(response, 'readinto', None)
+    while True:
+      # The first read is of one byte, which returns as soon as the body
+      # starts arriving instead of when a whole chunk has
+      chunk = self.buffer[:1] if first_byte is None else self.buffer
+      if readinto:
+        n = readinto(chunk)
+        data = chunk[:n]
+      else:
+        data = response.read(len(chunk))
+        n = len(data)
+      if not n:
+        break
+      if first_byte is None:
+        first_byte = time.time()
+      digest.update(data)
+      size += n
+    last_byte = time.time()
+    if size != expected_size or digest.hexdigest() != expected_md5:
+      raise ObjectIntegrityException(name=name, size=size, md5=digest.hexdigest(),
+                                     expected_size=expected_size,
+                                     expected_md5=expected_md5)
+    return ((first_byte or last_byte) - started, last_byte - started)
+
+def parse_size(size):
+  '''
+  Bytes in a size like 4K, 1M or 512M (powers of 1024)
+  '''
+  match = re.match(r'^\s*(\d+)\s*([KMG]?)i?B?\s*$', size, re.IGNORECASE)
+  if not match:
+    raise ValueError('Invalid object size: %s' % size)
+  return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+def parse_object_sizes(sizes):
+  '''
+  (label, bytes) of every size in a comma separated list like 4K,1M
+  '''
+  return [(label.strip().upper(), parse_size(label)) for label in sizes.split(',')]
+
+def throughput(size, seconds):
+  '''
+  MB/s, rounded for perfdata
+  '''
+  return round(size / (1024.0 * 1024.0) / max(seconds, 1e-6), 2)
+
+class S3FunctionalityTest(S3Check):
+  '''
+  Functionality Test of an S3 Bucket. Stores, reads and deletes one object
+  of every size in --object-sizes and reports the latency and throughput of
+  each step. Objects read back are verified against what was stored.
+  Objects of --multipart-threshold or more are uploaded in parts.
   Only works with Keystone Auth URL v3
   '''
-  options = dict()
 
   def __init__(self, options):
-  # First we try to list the ec2 credentials
+    S3Check.__init__(self, options)
+    self.sizes = parse_object_sizes(options.object_sizes or DEFAULT_OBJECT_SIZES)
+    self.multipart_threshold = parse_size(options.multipart_threshold or DEFAULT_MULTIPART_THRESHOLD)
+    self.verifier = StreamVerifier()
 
-    try:
-      res = json.loads(subprocess.check_output(["openstack", "--os-auth-url", options.auth_url, "--os-username", options.username, "--os-password", options.password, "--os-project-name", options.tenant, "--os-project-domain-name", DEFAULT_DOMAIN_NAME, "--os-user-domain-name", DEFAULT_DOMAIN_NAME, "--os-identity-api-version", "3", "ec2", "credentials", "list", "-f", "json"]))
-      res[0]['Access']
-  # If they don't exist we create some
-    except:
-      try:
-        subprocess.check_output(["openstack", "--os-auth-url", options.auth_url, "--os-username", options.username, "--os-password", options.password, "--os-project-name", options.tenant, "--os-project-domain-name", DEFAULT_DOMAIN_NAME, "--os-user-domain-name", DEFAULT_DOMAIN_NAME, "--os-identity-api-version", "3", "ec2", "credentials", "create"], stderr=subprocess.STDOUT)
-      except:
-        print("Could not create EC2 credentials")
-        sys.exit(NAGIOS_STATE_UNKNOWN)
-      res = json.loads(subprocess.check_output(["openstack", "--os-auth-url", options.auth_url, "--os-username", options.username, "--os-password", options.password, "--os-project-name", options.tenant, "--os-project-domain-name", DEFAULT_DOMAIN_NAME, "--os-user-domain-name", DEFAULT_DOMAIN_NAME, "--os-identity-api-version", "3", "ec2", "credentials", "list", "-f", "json"]))
+  def s3_check(self):
+    results = dict()
+    self.b = self.test_bucket()
+    for (label, size) in self.sizes:
+      self.k = Key(self.b)
+      self.k.key = '_'.join(filter(None, ['nagiostest', getattr(self.options, 'endpoint_label', None), label]))
+      payload = PayloadReader(size)
+      md5 = payload.md5()
+      part_md5s = self.part_digests(size)
+
+      started = time.time()
+      self.s3_store_data(payload, md5, part_md5s)
+      put_seconds = time.time() - started
 
-    if LOCAL_DEBUG:
-      print(res)
-    _access_key = res[0]['Access']
-    _secret_key = res[0]['Secret']
-    _s3_host = options.s3_host
+      try:
+        (ttfb_seconds, get_seconds) = self.s3_read_data(size, md5[0])
+      finally:
+        # Also when the object did not read back right
+        started = time.time()
+        self.s3_delete_data()
+        delete_seconds = time.time() - started
+
+      results.update(time_used('obj_%s_put' % label, put_seconds))
+      results.update(time_used('obj_%s_get' % label, get_seconds))
+      results.update(time_used('obj_%s_get_ttfb' % label, ttfb_seconds))
+      results.update(time_used('obj_%s_delete' % label, delete_seconds))
+      results['obj_%s_put_MBps' % label] = throughput(size, put_seconds)
+      results['obj_%s_get_MBps' % label] = throughput(size, get_seconds)
+    return results
 
-    self.conn = S3Connection(aws_access_key_id=_access_key, aws_secret_access_key=_secret_key, host=_s3_host)
-    try:
-      self.b = self.conn.get_bucket(DEFAULT_BUCKET_NAME)
-    except:
-      self.b = self.conn.create_bucket(DEFAULT_BUCKET_NAME)
-    self.k = Key(self.b)
-    self.k.key = 'nagiostest3'
+  def part_digests(self, size):
+    """ md5 of the parts of a multipart upload of size bytes, by part size
 
-  def s3_create_bucket(self):
-    """ create a bucket, does not fail if it exists
+    Parts start at multiples of MULTIPART_CHUNK_SIZE, a multiple of the
+    PAYLOAD_BLOCK length, so all full parts are the same bytes and only the
+    full part and the tail part need a digest.
     """
-    self.conn.create_bucket(DEFAULT_BUCKET_NAME)
 
-  def s3_store_data(self):
-    """ store a 3MB object in the bucket
+    if size < self.multipart_threshold:
+      return dict()
+    part_sizes = set([min(MULTIPART_CHUNK_SIZE, size)])
+    if size % MULTIPART_CHUNK_SIZE:
+      part_sizes.add(size % MULTIPART_CHUNK_SIZE)
+    return dict((part_size, PayloadReader(part_size).md5()) for part_size in part_sizes)
+
+  def s3_store_data(self, payload, md5, part_md5s):
+    """ store the payload in the bucket, in parts if it is large. part_md5s
+    are the digests of part_digests(), computed before the upload is timed
     """
 
-    USERHOMEDIR = os.path.expanduser('~')
-    TESTFILEPATH = "%s/3MBFILE" % USERHOMEDIR
-    if not os.path.exists(TESTFILEPATH):
-      with open(TESTFILEPATH, "wb") as out:
-          out.truncate(1024 * 1024 * 3)
-    self.k.set_contents_from_filename(TESTFILEPATH)
+    if payload.size < self.multipart_threshold:
+      self.k.set_contents_from_file(payload, md5=md5, size=payload.size)
+      return
+    upload = self.b.initiate_multipart_upload(self.k.key)
+    try:
+      for (part, offset) in enumerate(range(0, payload.size, MULTIPART_CHUNK_SIZE)):
+        part_payload = PayloadReader(min(MULTIPART_CHUNK_SIZE, payload.size - offset), offset)
+        upload.upload_part_from_file(part_payload, part + 1, md5=part_md5s[part_payload.size],
+                                     size=part_payload.size)
+      upload.complete_upload()
+    except:
+      upload.cancel_upload()
+      raise
 
-  def s3_read_data(self):
-    """ read object from bucket
+  def s3_read_data(self, size, md5):
+    """ read object from bucket and verify it is what was stored
     """
 
-    self.k.open()
-    self.k.read()
+    started = time.time()
+    self.k.open_read()
+    try:
+      return self.verifier.read(self.k.key, self.k.resp, started, size, md5)
+    finally:
+      self.k.close()
 
   def s3_delete_data(self):
     """ delete object from bucket
@@ -352,23 +986,451 @@ class S3FunctionalityTest():
 
     self.k.delete()
 
+def run_with_timeout(timeout, function, *args):
+  '''
+  Return function(*args), run in a daemon thread, or raise
+  concurrent.futures.TimeoutError after timeout seconds. A call that timed
+  out is left running but does not keep the check from exiting.
+  '''
+  future = concurrent.futures.Future()
+  def run():
+    try:
+      future.set_result(function(*args))
+    except BaseException as e:
+      future.set_exception(e)
+  threading.Thread(target=run, daemon=True).start()
+  return future.result(timeout)
+
+class SwiftFunctionalityTest(object):
+  '''
+  Functionality Test of Swift. Stores, reads, HEADs and deletes one object
+  of every size in --object-sizes and reports the latency and throughput of
+  each step. Objects read back are verified against what was stored.
+  Objects of --segment-threshold or more are stored as static or dynamic
+  large objects (--segment-type) of --segment-size segments, uploaded
+  --segment-workers at a time. Every step has --phase-timeout seconds, and
+  the object and its segments are deleted whatever happened.
+  '''
+
+  def __init__(self, options):
+    self.auth = SwiftAuth(options)
+    self.sizes = parse_object_sizes(options.object_sizes or DEFAULT_OBJECT_SIZES)
+    self.segment_threshold = parse_size(options.segment_threshold or DEFAULT_SEGMENT_THRESHOLD)
+    self.segment_size = parse_size(options.segment_size or DEFAULT_SEGMENT_SIZE)
+    self.segment_type = (options.segment_type or DEFAULT_SEGMENT_TYPE).lower()
+    self.segment_workers = options.segment_workers or DEFAULT_SEGMENT_WORKERS
+    self.timeout = options.phase_timeout or DEFAULT_PHASE_TIMEOUT
+    self.segment_container = DEFAULT_BUCKET_NAME + '_segments'
+    self.prefix = '_'.join(filter(None, ['nagiostest', getattr(options, 'endpoint_label', None)]))
+    self.verifier = StreamVerifier()
+    # swiftclient connections are not thread safe, segment uploads use
+    # one per thread
+    self.local = threading.local()
+
+  def connection(self):
+    if not hasattr(self.local, 'conn'):
+      self.local.conn = self.auth.swift_connection(retries=0, timeout=self.timeout)
+    return self.local.conn
+
   def execute(self):
     results = dict()
+    self.conn = self.auth.swift_connection(retries=0, timeout=self.timeout)
+    containers = [DEFAULT_BUCKET_NAME]
+    if any(size >= self.segment_threshold for (label, size) in self.sizes):
+      containers.append(self.segment_container)
+    try:
+      self.conn.put_container(containers[0])
+    except swiftclient.exceptions.ClientException as e:
+      if e.http_status != 401:
+        raise
+      # Token revoked before it expired
+      self.conn = self.auth.swift_connection(refresh=True, retries=0, timeout=self.timeout)
+      self.conn.put_container(containers[0])
+    for container in containers[1:]:
+      self.conn.put_container(container)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.segment_workers)
+    try:
+      for (label, size) in self.sizes:
+        results.update(self.round_trip(executor, label, size))
+    finally:
+      executor.shutdown(wait=True)
+    results.update(time_used('keystone', self.auth.seconds))
+    return results
+
+  def phase(self, phase, name, function, *args):
+    '''
+    Run one step of the test with --phase-timeout. Returns (result, seconds).
+    '''
+    started = time.time()
+    try:
+      result = run_with_timeout(self.timeout, function, *args)
+    except concurrent.futures.TimeoutError:
+      raise PhaseTimeoutException(phase=phase, name=name, timeout=self.timeout)
+    return (result, time.time() - started)
+
+  def round_trip(self, executor, label, size):
+    results = dict()
+    name = '%s_%s' % (self.prefix, label)
+    segments = []
+    cancelled = threading.Event()
+    payload = PayloadReader(size, cancelled=cancelled)
+    md5 = payload.md5()[0]
     try:
-      self.s3_create_bucket()
-      self.s3_store_data()
-      self.s3_read_data()
-      self.s3_delete_data()
+      if size >= self.segment_threshold:
+        segment_md5s = self.segment_digests(size)
+        (_, put_seconds) = self.phase('put', name, self.put_segmented, executor, name, size,
+                                      segment_md5s, segments, cancelled)
+        results['obj_%s_segments' % label] = len(segments)
+      else:
+        (_, put_seconds) = self.phase('put', name, self.put_object, name, payload, md5)
+      ((ttfb_seconds, get_seconds), _) = self.phase('get', name, self.get_object, name, size, md5)
+      (_, head_seconds) = self.phase('head', name, self.head_object, name, size)
     except:
+      # Stop the segment uploads still running, and do not wait for a
+      # request that timed out on the shared connection
+      cancelled.set()
+      self.conn = self.auth.swift_connection(retries=0, timeout=self.timeout)
+      self.cleanup(executor, name, segments)
       raise
+    (delete_seconds, left) = self.cleanup(executor, name, segments)
+
+    results.update(time_used('obj_%s_put' % label, put_seconds))
+    results.update(time_used('obj_%s_get' % label, get_seconds))
+    results.update(time_used('obj_%s_get_ttfb' % label, ttfb_seconds))
+    results.update(time_used('obj_%s_head' % label, head_seconds))
+    results.update(time_used('obj_%s_delete' % label, delete_seconds))
+    results['obj_%s_put_MBps' % label] = throughput(size, put_seconds)
+    results['obj_%s_get_MBps' % label] = throughput(size, get_seconds)
+    if left:
+      raise CleanupException(results, left=left, name=name)
+    return results
+
+  def put_object(self, name, payload, md5):
+    self.conn.put_object(DEFAULT_BUCKET_NAME, name, payload, content_length=payload.size, etag=md5)
+
+  def segment_digests(self, size):
+    '''
+    MD5 of the segments of an object of size bytes, by segment size and
+    offset within PAYLOAD_BLOCK. Segments that agree on both hold the same
+    bytes, so with a --segment-size that is a multiple of the PAYLOAD_BLOCK
+    length only the full segment and the tail segment need a digest.
+    '''
+    digests = dict()
+    for offset in range(0, size, self.segment_size):
+      key = (min(self.segment_size, size - offset), offset % len(PAYLOAD_BLOCK))
+      if key not in digests:
+        digests[key] = PayloadReader(key[0], offset).md5()[0]
+    return digests
+
+  def put_segmented(self, executor, name, size, segment_md5s, segments, cancelled):
+    '''
+    Upload the segments concurrently, then the manifest. segment_md5s are
+    the digests of segment_digests(), computed before the upload is timed.
+    The futures of the uploads are appended to segments for the cleanup.
+    '''
+    for (number, offset) in enumerate(range(0, size, self.segment_size)):
+      segment_size = min(self.segment_size, size - offset)
+      md5 = segment_md5s[segment_size, offset % len(PAYLOAD_BLOCK)]
+      segments.append(executor.submit(self.put_segment, '%s/%08d' % (name, number),
+                                      segment_size, offset, md5, cancelled))
+    manifest = [future.result() for future in segments]
+    if self.segment_type == 'dlo':
+      self.conn.put_object(DEFAULT_BUCKET_NAME, name, b'', content_length=0,
+                           headers={'X-Object-Manifest': '%s/%s/' % (self.segment_container, name)})
+    else:
+      self.conn.put_object(DEFAULT_BUCKET_NAME, name, json.dumps(manifest),
+                           query_string='multipart-manifest=put')
+
+  def put_segment(self, segment, size, offset, md5, cancelled):
+    payload = PayloadReader(size, offset, cancelled)
+    self.connection().put_object(self.segment_container, segment, payload,
+                                 content_length=size, etag=md5)
+    return {'path': '/%s/%s' % (self.segment_container, segment), 'etag': md5, 'size_bytes': size}
+
+  def get_object(self, name, size, md5):
+    started = time.time()
+    (headers, body) = self.conn.get_object(DEFAULT_BUCKET_NAME, name, resp_chunk_size=READ_CHUNK_SIZE)
+    try:
+      return self.verifier.read(name, body, started, size, md5)
+    finally:
+      body.close()
+
+  def head_object(self, name, size):
+    headers = self.conn.head_object(DEFAULT_BUCKET_NAME, name)
+    if int(headers.get('content-length', -1)) != size:
+      raise ObjectIntegrityException(name=name, size=int(headers.get('content-length', -1)),
+                                     md5=headers.get('etag', '').strip('"'),
+                                     expected_size=size, expected_md5='-')
+
+  def delete(self, conn, container, name):
+    '''
+    Delete one object, returns 1 when it is still there
+    '''
+    try:
+      conn.delete_object(container, name)
+    except swiftclient.exceptions.ClientException as e:
+      if e.http_status != 404:
+        logging.debug('delete of %s/%s failed: %s', container, name, e)
+        return 1
+    except Exception as e:
+      logging.debug('delete of %s/%s failed: %s', container, name, e)
+      return 1
+    return 0
+
+  def delete_segment(self, segment):
+    return self.delete(self.connection(), self.segment_container, segment)
+
+  def cleanup(self, executor, name, segments):
+    '''
+    Delete the object and all its segments, also those of an upload that
+    did not finish, after the uploads still running have stopped. Returns
+    (seconds, objects left).
+    '''
+    for future in segments:
+      future.cancel()
+    concurrent.futures.wait(segments, timeout=self.timeout)
+    started = time.time()
+    left = self.delete(self.conn, DEFAULT_BUCKET_NAME, name)
+    if segments:
+      try:
+        (headers, listing) = self.conn.get_container(self.segment_container, prefix=name + '/',
+                                                     full_listing=True)
+        left += sum(executor.map(self.delete_segment, [o['name'] for o in listing]))
+      except Exception as e:
+        logging.debug('listing segments of %s failed: %s', name, e)
+        left += len(segments)
+    return (time.time() - started, left)
+
+def parse_mix(mix):
+  '''
+  Operation weights from a mix like put=1,get=4,head=2,delete=1
+  '''
+  weights = dict()
+  for item in mix.split(','):
+    (operation, _, weight) = item.partition('=')
+    operation = operation.strip().lower()
+    if operation not in LOAD_OPERATIONS or not weight.strip().isdigit():
+      raise ValueError('Invalid load mix item: %s' % item)
+    weights[operation] = int(weight)
+  return weights
+
+def percentile(latencies, percent):
+  '''
+  Nearest rank percentile of a sorted list
+  '''
+  if not latencies:
+    return 0.0
+  return latencies[max(0, int(math.ceil(percent / 100.0 * len(latencies))) - 1)]
+
+class LoadTest(object):
+  '''
+  Small object load test. --load-workers threads, each with its own keep-alive
+  connection, run a weighted mix of PUT, GET, HEAD and DELETE on keys of
+  their own in the test bucket for --load-duration seconds. Every key still
+  there at the end is deleted. Subclasses provide the connections and the
+  four operations.
+  '''
+
+  def __init__(self, options):
+    self.workers = options.load_workers or DEFAULT_LOAD_WORKERS
+    self.duration = options.load_duration or DEFAULT_LOAD_DURATION
+    weights = parse_mix(options.load_mix or DEFAULT_LOAD_MIX)
+    self.operations = [op for op in LOAD_OPERATIONS for _ in range(weights.get(op, 0))]
+    if 'put' not in self.operations:
+      raise ValueError('The load mix needs put')
+    size = parse_size(options.load_object_size or DEFAULT_LOAD_OBJECT_SIZE)
+    self.payload = (PAYLOAD_BLOCK * (size // len(PAYLOAD_BLOCK) + 1))[:size]
+    self.prefix = '/'.join(filter(None, ['nagiosload', getattr(options, 'endpoint_label', None),
+                                         '%d-%d/' % (os.getpid(), int(time.time()))]))
+    self.latencies = dict((op, []) for op in LOAD_OPERATIONS)
+    self.errors = dict((op, 0) for op in LOAD_OPERATIONS)
+    self.left = 0
+    self.lock = threading.Lock()
+
+  def run_worker(self, number, client, stop_at):
+    rnd = random.Random(number)
+    latencies = dict((op, []) for op in LOAD_OPERATIONS)
+    errors = dict((op, 0) for op in LOAD_OPERATIONS)
+    keys = []
+    sequence = 0
+    while time.time() < stop_at:
+      operation = rnd.choice(self.operations)
+      if operation == 'put' or not keys:
+        operation = 'put'
+        key = '%s%d-%d' % (self.prefix, number, sequence)
+        sequence += 1
+      else:
+        key = rnd.choice(keys)
+      started = time.time()
+      try:
+        getattr(self, 'load_' + operation)(client, key)
+      except Exception as e:
+        errors[operation] += 1
+        logging.debug('%s %s failed: %s', operation, key, e)
+        continue
+      latencies[operation].append(time.time() - started)
+      if operation == 'put':
+        keys.append(key)
+      elif operation == 'delete':
+        keys.remove(key)
+
+    left = 0
+    for key in keys:
+      try:
+        self.load_delete(client, key)
+      except Exception as e:
+        logging.debug('cleanup of %s failed: %s', key, e)
+        left += 1
+    with self.lock:
+      for op in LOAD_OPERATIONS:
+        self.latencies[op].extend(latencies[op])
+        self.errors[op] += errors[op]
+      self.left += left
+
+  def run_load(self, clients):
+    '''
+    Run one worker per client and return the perfdata
+    '''
+    stop_at = time.time() + self.duration
+    threads = [threading.Thread(target=self.run_worker, args=(number, client, stop_at))
+               for (number, client) in enumerate(clients)]
+    started = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = min(time.time(), stop_at) - started
+
+    results = dict()
+    done = sum(len(latencies) for latencies in self.latencies.values())
+    errors = sum(self.errors.values())
+    results['load_ops_per_second'] = round(done / max(elapsed, 1e-6), 2)
+    results['load_error_rate'] = round(100.0 * errors / max(done + errors, 1), 2)
+    results['load_objects_left'] = self.left
+    for op in LOAD_OPERATIONS:
+      latencies = sorted(self.latencies[op])
+      results['%s_ops' % op] = len(latencies)
+      results['%s_errors' % op] = self.errors[op]
+      for percent in LOAD_PERCENTILES:
+        results.update(time_used('%s_p%d' % (op, percent), percentile(latencies, percent)))
+    if errors or self.left:
+      raise LoadErrorsException(results, errors=errors, requests=done + errors, left=self.left)
+    return results
+
+  def verify(self, key, data):
+    if data != self.payload:
+      raise ObjectIntegrityException(name=key, size=len(data),
+                                     md5=hashlib.md5(data).hexdigest(),
+                                     expected_size=len(self.payload),
+                                     expected_md5=hashlib.md5(self.payload).hexdigest())
+
+class S3LoadTest(S3Check, LoadTest):
+  '''
+  Small object load test of S3, see LoadTest
+  Only works with Keystone Auth URL v3
+  '''
+
+  def __init__(self, options):
+    S3Check.__init__(self, options)
+    LoadTest.__init__(self, options)
+
+  def s3_check(self):
+    self.test_bucket()
+    # Connections are set up before the clock starts
+    clients = [self.s3_connection().get_bucket(DEFAULT_BUCKET_NAME, validate=False)
+               for _ in range(self.workers)]
+    return self.run_load(clients)
+
+  def load_put(self, bucket, key):
+    Key(bucket, key).set_contents_from_string(self.payload)
+
+  def load_get(self, bucket, key):
+    self.verify(key, Key(bucket, key).get_contents_as_string())
+
+  def load_head(self, bucket, key):
+    if bucket.get_key(key) is None:
+      raise KeyError(key)
+
+  def load_delete(self, bucket, key):
+    bucket.delete_key(key)
+
+class SwiftLoadTest(LoadTest):
+  '''
+  Small object load test of Swift, see LoadTest. The workers share the
+  cached token.
+  '''
+
+  def __init__(self, options):
+    LoadTest.__init__(self, options)
+    self.auth = SwiftAuth(options)
+
+  def execute(self):
+    conn = self.auth.swift_connection()
+    try:
+      conn.put_container(DEFAULT_BUCKET_NAME)
+    except swiftclient.exceptions.ClientException as e:
+      if e.http_status != 401:
+        raise
+      conn = self.auth.swift_connection(refresh=True)
+      conn.put_container(DEFAULT_BUCKET_NAME)
+    clients = [self.auth.swift_connection() for _ in range(self.workers)]
+    results = self.run_load(clients)
+    results.update(time_used('keystone', self.auth.seconds))
     return results
 
+  def load_put(self, conn, key):
+    conn.put_object(DEFAULT_BUCKET_NAME, key, self.payload)
+
+  def load_get(self, conn, key):
+    self.verify(key, conn.get_object(DEFAULT_BUCKET_NAME, key)[1])
+
+  def load_head(self, conn, key):
+    conn.head_object(DEFAULT_BUCKET_NAME, key)
+
+  def load_delete(self, conn, key):
+    conn.delete_object(DEFAULT_BUCKET_NAME, key)
+
+OS_CHECK = {
+  'swift': OSSwiftAvailability,
+  'swiftpublic': SwiftPublicAvailability,
+  's3public': S3PublicAvailability,
+  's3private': S3PrivateAvailability,
+  's3func': S3FunctionalityTest,
+  'swiftfunc': SwiftFunctionalityTest,
+  's3load': S3LoadTest,
+  'swiftload': SwiftLoadTest,
+}
+
+# Exit state of every exception that a check reports instead of crashing
+EXCEPTION_STATE = [
+  (ProjectNotAvailableException, NAGIOS_STATE_UNKNOWN),
+  (CredentialsOrParametersMissingException, NAGIOS_STATE_UNKNOWN),
+  (EC2CredentialsException, NAGIOS_STATE_UNKNOWN),
+  (ObjectIntegrityException, NAGIOS_STATE_CRITICAL),
+  (PublicBucketException, NAGIOS_STATE_CRITICAL),
+  (PhaseTimeoutException, NAGIOS_STATE_CRITICAL),
+  (LoadErrorsException, NAGIOS_STATE_WARNING),
+  (CleanupException, NAGIOS_STATE_WARNING),
+]
+HANDLED_EXCEPTIONS = tuple(exception for exception, state in EXCEPTION_STATE)
+
+# Order used to pick the worst state of several endpoints
+NAGIOS_STATE_SEVERITY = [NAGIOS_STATE_OK, NAGIOS_STATE_UNKNOWN,
+                         NAGIOS_STATE_WARNING, NAGIOS_STATE_CRITICAL]
+
+def exception_state(e):
+  for exception, state in EXCEPTION_STATE:
+    if isinstance(e, exception):
+      return state
+  return NAGIOS_STATE_CRITICAL
+
 ###
 def parse_command_line():
   '''
   Parse command line and execute check according to command line arguments
   '''
-  usage = '%prog { swift | ?? }'
+  usage = '%prog { swift | swiftpublic | s3public | s3private | s3func | swiftfunc | s3load | swiftload }'
   parser = optparse.OptionParser(usage)
   parser.add_option("-a", "--auth_url", dest='auth_url', help='identity endpoint URL')
   parser.add_option("-u", "--username", dest='username', help='username')
@@ -381,7 +1443,28 @@ def parse_command_line():
   parser.add_option("-d", "--debug", dest='debug', action='store_true', help='Debug mode. Enables logging')
   parser.add_option("-w", "--swift_publicurl", dest='swift_publicurl', help='Swift publicurl')
   parser.add_option("-c", "--swift_bucket", dest='swift_bucket', help='Swift bucket')
+  parser.add_option("-A", "--auth-cache", dest='auth_cache', help='project id, Swift URL and token cache file of the Swift checks (default %s)' % DEFAULT_AUTH_CACHE)
+  parser.add_option("-L", "--auth-cache-ttl", dest='auth_cache_ttl', type='int', help='seconds the project id and Swift URL are cached (default %d)' % DEFAULT_AUTH_CACHE_TTL)
+  parser.add_option("-e", "--ec2-cache", dest='ec2_cache', help='EC2 credentials cache file of the S3 checks (default %s)' % DEFAULT_EC2_CACHE)
+  parser.add_option("-z", "--object-sizes", dest='object_sizes', help='s3func, swiftfunc: comma separated object sizes, e.g. 4K,1M,64M,512M (default %s)' % DEFAULT_OBJECT_SIZES)
+  parser.add_option("-m", "--multipart-threshold", dest='multipart_threshold', help='s3func: upload objects of this size or more in %dMB parts (default %s)' % (MULTIPART_CHUNK_SIZE // (1024 * 1024), DEFAULT_MULTIPART_THRESHOLD))
+  parser.add_option("-G", "--segment-threshold", dest='segment_threshold', help='swiftfunc: store objects of this size or more as large objects (default %s)' % DEFAULT_SEGMENT_THRESHOLD)
+  parser.add_option("-Z", "--segment-size", dest='segment_size', help='swiftfunc: large object segment size (default %s)' % DEFAULT_SEGMENT_SIZE)
+  parser.add_option("-Y", "--segment-type", dest='segment_type', choices=SEGMENT_TYPES, help='swiftfunc: static (slo) or dynamic (dlo) large objects (default %s)' % DEFAULT_SEGMENT_TYPE)
+  parser.add_option("-X", "--segment-workers", dest='segment_workers', type='int', help='swiftfunc: segments uploaded at the same time (default %d)' % DEFAULT_SEGMENT_WORKERS)
+  parser.add_option("-D", "--phase-timeout", dest='phase_timeout', type='float', help='swiftfunc: seconds each PUT, GET and HEAD may take (default %d)' % DEFAULT_PHASE_TIMEOUT)
+  parser.add_option("-W", "--load-workers", dest='load_workers', type='int', help='s3load, swiftload: concurrent workers (default %d)' % DEFAULT_LOAD_WORKERS)
+  parser.add_option("-T", "--load-duration", dest='load_duration', type='float', help='s3load, swiftload: seconds to run (default %d)' % DEFAULT_LOAD_DURATION)
+  parser.add_option("-M", "--load-mix", dest='load_mix', help='s3load, swiftload: operation weights (default %s)' % DEFAULT_LOAD_MIX)
+  parser.add_option("-S", "--load-object-size", dest='load_object_size', help='s3load, swiftload: object size (default %s)' % DEFAULT_LOAD_OBJECT_SIZE)
+  parser.add_option("-n", "--samples", dest='samples', type='int', help='s3public: requests to send on one keep-alive connection (default 1)')
+  parser.add_option("-H", "--public-method", dest='public_method', choices=['get', 'head', 'GET', 'HEAD'], help='s3public: GET with max-keys=1 (default) or HEAD the bucket')
+  parser.add_option("-E", "--endpoints", dest='endpoints', help='comma separated endpoint URLs, e.g. the gateway nodes; the check runs against all of them at the same time')
+  parser.add_option("-R", "--require", dest='require', type='int', help='with --endpoints, OK when at least this many endpoints are OK instead of the worst state of all')
+  parser.add_option("-P", "--s3-pool-size", dest='s3_pool_size', type='int', help='S3 checks: idle keep-alive connections kept (default %d)' % DEFAULT_S3_POOL_SIZE)
+  parser.add_option("-O", "--s3-timeout", dest='s3_timeout', type='float', help='S3 checks: connect and read timeout in seconds (default %d)' % DEFAULT_HTTP_TIMEOUT)
   parser.add_option("-j", "--milliseconds", dest='milliseconds', action='store_true', help='Show time in milliseconds')
+  add_profile_arguments(parser)
 
   (options, args) = parser.parse_args()
 
@@ -399,14 +1482,7 @@ def execute_check(options, args):
   Execute check given as command argument
   '''
   command = args.pop()
-  os_check = {
-    'swift': OSSwiftAvailability,
-    'swiftpublic': SwiftPublicAvailability,
-    's3public': S3PublicAvailability,
-    's3private': S3PrivateAvailability,
-    's3func': S3FunctionalityTest,
-  }
-
+  os_check = OS_CHECK
 
   if not command in os_check:
     print('Unknown command argument! Use --help.')
@@ -414,6 +1490,88 @@ def execute_check(options, args):
 
   return os_check[command](options).execute()
 
+def endpoint_options(options, endpoint):
+  '''
+  Copy of options that points the check at endpoint, a URL like
+  https://gw1.example.org:8080. The host part of the URLs given on the
+  command line is replaced, for swift the storage URL from the catalog.
+  '''
+  endpoint_url = urllib.parse.urlsplit(endpoint)
+  def with_endpoint(url):
+    if not url:
+      return url
+    return urllib.parse.urlunsplit(endpoint_url[:2] + urllib.parse.urlsplit(url)[2:])
+  endpoint_opts = copy.copy(options)
+  endpoint_opts.endpoint = endpoint
+  endpoint_opts.endpoint_label = re.sub(r'[^A-Za-z0-9]+', '_', endpoint_url.netloc).strip('_')
+  endpoint_opts.s3_host = endpoint
+  endpoint_opts.s3_bucket_url = with_endpoint(options.s3_bucket_url)
+  endpoint_opts.swift_publicurl = with_endpoint(options.swift_publicurl)
+  return endpoint_opts
+
+def execute_check_at_endpoint(command, options):
+  '''
+  Run a check and return (exit_code, stats, message, seconds) instead of exiting
+  '''
+  started = time.time()
+  try:
+    stats = OS_CHECK[command](options).execute() or dict()
+    exit_code, message = NAGIOS_STATE_OK, None
+  except HANDLED_EXCEPTIONS as e:
+    stats = getattr(e, 'stats', None) or dict()
+    exit_code, message = exception_state(e), str(e)
+  except Exception as e:
+    stats = dict()
+    exit_code, message = NAGIOS_STATE_CRITICAL, "{0}: {1}".format(e.__class__.__name__, e)
+  return (exit_code, stats, message, time.time() - started)
+
+def execute_check_at_endpoints(options, args):
+  '''
+  Execute the check against every endpoint of --endpoints at the same time.
+  Returns the overall exit code, the perfdata of every endpoint prefixed
+  with its host and port, and one message per endpoint that was not OK.
+  The overall exit code is the worst of all endpoints, or with --require N
+  OK when at least N endpoints are OK and CRITICAL otherwise.
+  '''
+  command = args.pop()
+  if not command in OS_CHECK:
+    print('Unknown command argument! Use --help.')
+    sys.exit(NAGIOS_STATE_UNKNOWN)
+
+  endpoints = [endpoint_options(options, e.strip()) for e in options.endpoints.split(',') if e.strip()]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+    futures = [(e.endpoint_label, executor.submit(execute_check_at_endpoint, command, e))
+               for e in endpoints]
+
+  results = dict()
+  messages = []
+  exit_codes = []
+  seconds = []
+  for (label, future) in futures:
+    (exit_code, stats, message, elapsed) = future.result()
+    exit_codes.append(exit_code)
+    seconds.append(elapsed)
+    for key in stats:
+      results[label + '_' + key] = stats[key]
+    results[label + '_status'] = exit_code
+    results.update(time_used(label + '_endpoint', elapsed))
+    if message:
+      messages.append('%s: %s' % (label, message))
+
+  results['endpoints_ok'] = exit_codes.count(NAGIOS_STATE_OK)
+  results['endpoints_total'] = len(exit_codes)
+  results.update(time_used('endpoint_fastest', min(seconds)))
+  results.update(time_used('endpoint_slowest', max(seconds)))
+  results.update(time_used('endpoint_spread', max(seconds) - min(seconds)))
+  if options.require:
+    if exit_codes.count(NAGIOS_STATE_OK) >= options.require:
+      exit_code = NAGIOS_STATE_OK
+    else:
+      exit_code = NAGIOS_STATE_CRITICAL
+  else:
+    exit_code = max(exit_codes, key=NAGIOS_STATE_SEVERITY.index)
+  return (exit_code, results, messages)
+
 def exit_with_stats(exit_code=NAGIOS_STATE_OK, stats=dict()):
   '''
   Exits with the specified exit_code and outputs any stats in the format
@@ -457,21 +1615,23 @@ def main():
     (options, args) = parse_command_line()
     if options.debug:
       logging.basicConfig(level=logging.DEBUG)
+    start_profiler(options, args[-1])
 
     # Call the check
+    if options.endpoints:
+      (exit_code, results, messages) = execute_check_at_endpoints(options, args)
+      for message in messages:
+        print(message)
+      exit_with_stats(exit_code, results)
     results = execute_check(options, args)
 
+  except HANDLED_EXCEPTIONS as e:
+    print(e)
+    exit_with_stats(exception_state(e), getattr(e, 'stats', None))
+
   except Exception as e:
     print("{0}: {1}".format(e.__class__.__name__, e))
     exit_with_stats(NAGIOS_STATE_CRITICAL)
-  
-  except ProjectNotAvailableException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_UNKNOWN)
-
-  except CredentialsOrParametersMissingException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_UNKNOWN)
 
   exit_with_stats(NAGIOS_STATE_OK, results)
 
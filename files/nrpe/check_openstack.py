@@ -8,7 +8,9 @@ import os
 import os.path
 import sys
 import time
+import copy
 import optparse
+import concurrent.futures
 import novaclient.client as nova
 from novaclient.api_versions import APIVersion
 import cinderclient.exceptions
@@ -18,10 +20,13 @@ import keystoneclient.v2_0.client as keystoneclient
 
 import paramiko
 import socket
+import threading
 import logging
 import yaml
 import re
 
+from check_profile import add_profile_arguments, start_profiler
+
 # Imports for API availability checks
 import glanceclient
 from heatclient import client as heatclient
@@ -31,6 +36,7 @@ import novaclient
 from keystoneauth1 import loading
 from keystoneauth1 import session
 from keystoneauth1 import identity
+from keystoneauth1 import exceptions as keystoneauth_exceptions
 from keystoneclient.v3 import client as keystoneclientv3
 
 LOCAL_DEBUG           = False
@@ -51,6 +57,15 @@ DEFAULT_PING_COUNT       = 5
 DEFAULT_PING_INTERVAL    = 2
 DEFAULT_NO_PING          = False
 DEFAULT_ONLY_WINDOWS     = False
+DEFAULT_DEADLINE         = None
+DEFAULT_CONCURRENCY      = 4
+# clouds file keys the checks honour, any other key is rejected
+CLOUD_KEYS               = ['auth', 'auth_type', 'region_name', 'interface',
+                            'identity_api_version', 'verify', 'cacert']
+CLOUD_AUTH_KEYS          = ['auth_url', 'username', 'password', 'project_name',
+                            'tenant_name', 'user_domain_name', 'domain_name',
+                            'project_domain_name']
+DEADLINE_CLEANUP_TIMEOUT = 5
 
 STATUS_VOLUME_AVAILABLE  = 'available'
 STATUS_VOLUME_OK_DELETE  = ['available', 'error']
@@ -68,6 +83,9 @@ class CheckOpenStackException(Exception):
   def __str__(self):
     return self.message
 
+class CloudsFileException(CheckOpenStackException):
+  msg_fmt = "cloud %(cloud)s: %(reason)s"
+
 class CredentialsMissingException(CheckOpenStackException):
   msg_fmt = "%(key)s parameter or environment variable missing!"
 
@@ -115,6 +133,72 @@ class NeutronL3AgentsWarning(CheckOpenStackException):
 class NeutronL3AgentsCritical(CheckOpenStackException):
   msg_fmt = "Neutron L3 agent has admin_state_up=True and alive=False \n %(msgs)s"
 
+class DeadlineExceededException(CheckOpenStackException):
+  msg_fmt = "Deadline of %(deadline)s seconds exhausted during %(phase)s"
+  # Perfdata gathered before the deadline ran out
+  stats = None
+
+class Deadline(object):
+  '''
+  Time budget of the whole check run. API requests, polling loops, ssh and
+  ping take their timeouts from what is left of it, and the phase that was
+  running when it ran out is named in the error. Without a deadline every
+  timeout is None, i.e. the old behaviour.
+  '''
+
+  def __init__(self, seconds=None):
+    self.seconds = seconds
+    self.expires = None
+    if seconds:
+      self.expires = time.time() + seconds
+    # The phase is per thread when several clouds are checked at once
+    self.local = threading.local()
+
+  @property
+  def phase(self):
+    return getattr(self.local, 'phase', 'startup')
+
+  @phase.setter
+  def phase(self, phase):
+    self.local.phase = phase
+
+  @property
+  def cleaning_up(self):
+    return getattr(self.local, 'cleaning_up', False)
+
+  @cleaning_up.setter
+  def cleaning_up(self, cleaning_up):
+    self.local.cleaning_up = cleaning_up
+
+  def enter(self, phase):
+    self.phase = phase
+    self.remaining()
+
+  def cleanup(self):
+    '''
+    Cleanup of created resources must not be skipped, so from here on each
+    call gets at least DEADLINE_CLEANUP_TIMEOUT seconds.
+    '''
+    self.cleaning_up = True
+
+  def expired(self):
+    return self.expires is not None and time.time() >= self.expires
+
+  def exceeded(self):
+    return DeadlineExceededException(deadline=self.seconds, phase=self.phase)
+
+  def remaining(self):
+    if self.expires is None:
+      return None
+    left = self.expires - time.time()
+    if self.cleaning_up:
+      return max(left, DEADLINE_CLEANUP_TIMEOUT)
+    if left <= 0:
+      raise self.exceeded()
+    return left
+
+DEADLINE = Deadline(DEFAULT_DEADLINE)
+
 class TimeStateMachine():
   '''
   This class can be used to mesure how long it takes to run a function.
@@ -147,6 +231,10 @@ class OSCredentials(object):
   keystone_v3_cred = dict()
 
   def __init__(self, options):
+    # Per instance, several clouds may be checked at the same time
+    self.cred = dict()
+    self.keystone_cred = dict()
+    self.keystone_v3_cred = dict()
     self.environment_credentials()
     self.options_credentials(options)
     self.credentials_available()
@@ -190,6 +278,9 @@ class OSCredentials(object):
     if options.user_and_project_domain_name:
         self.keystone_v3_cred['user_domain_name'] = options.user_and_project_domain_name
         self.keystone_v3_cred['project_domain_name'] = options.user_and_project_domain_name
+    # Only set for clouds read from a clouds file
+    if getattr(options, 'project_domain_name', None):
+        self.keystone_v3_cred['project_domain_name'] = options.project_domain_name
   def credentials_available(self):
     for key in ['auth_url', 'username', 'api_key', 'project_id']:
       if not key in self.cred:
@@ -210,14 +301,50 @@ class OSCredentials(object):
   def provide_keystone_v3(self):
     return self.keystone_v3_cred
 
+class DeadlineSession(session.Session):
+  '''
+  keystoneauth Session taking the timeout of every request from DEADLINE
+  '''
+
+  @property
+  def timeout(self):
+    return DEADLINE.remaining()
+
+  @timeout.setter
+  def timeout(self, value):
+    pass
+
+  def request(self, *args, **kwargs):
+    try:
+      return super(DeadlineSession, self).request(*args, **kwargs)
+    except keystoneauth_exceptions.ConnectTimeout:
+      if DEADLINE.expired():
+        raise DEADLINE.exceeded()
+      raise
+
 def keystone_session_v3(options):
     creds = OSCredentials(options).provide_keystone_v3()
     auth = identity.v3.Password(**creds)
-    sessionx = session.Session(auth=auth)
+    # Only set for clouds read from a clouds file
+    verify = getattr(options, 'verify', None)
+    sessionx = DeadlineSession(auth=auth, verify=True if verify is None else verify)
     return sessionx
 
-def get_project_id(session, name):
-    keystone = keystoneclientv3.Client(session=session)
+def endpoint_arguments(options, interface_key='interface'):
+    '''
+    Keyword arguments selecting the region and interface of the service
+    endpoints for the clients of a cloud from a clouds file. Nova, cinder
+    and neutron take the interface as endpoint_type.
+    '''
+    arguments = dict()
+    if getattr(options, 'region_name', None):
+      arguments['region_name'] = options.region_name
+    if getattr(options, 'interface', None):
+      arguments[interface_key] = options.interface
+    return arguments
+
+def get_project_id(session, name, options):
+    keystone = keystoneclientv3.Client(session=session, **endpoint_arguments(options))
     projects = keystone.projects.list()
     project_list = list(filter(lambda d: name == d.name , projects))
     if len(project_list) != 1:
@@ -234,7 +361,7 @@ class OSVolumeCheck():
 
   def __init__(self, options):
     self.options = options
-    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options))
+    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def volume_create(self):
     self.volume = self.cinder.volumes.create(name=self.options.volume_name,
@@ -249,10 +376,10 @@ class OSVolumeCheck():
     return volume._info['status']
 
   def wait_volume_is_available(self):
-    inc = 0
-    while (inc < self.options.wait):
-      inc += 1
-      time.sleep(1)
+    wait_until = time.time() + self.options.wait
+    status = None
+    while time.time() < wait_until:
+      time.sleep(min(1, DEADLINE.remaining() or 1))
       status = self.volume_status()
       if status == STATUS_VOLUME_AVAILABLE:
         return
@@ -266,12 +393,16 @@ class OSVolumeCheck():
 
   def execute(self):
     try:
+      DEADLINE.enter('delete_orphaned_volumes')
       self.delete_orphaned_volumes()
+      DEADLINE.enter('create_volume')
       self.volume_create()
+      DEADLINE.enter('volume_available')
       self.wait_volume_is_available()
     except:
       raise
     finally:
+      DEADLINE.cleanup()
       self.volume_destroy()
 
 class OSInstanceCheck(TimeStateMachine):
@@ -283,9 +414,9 @@ class OSInstanceCheck(TimeStateMachine):
   def __init__(self, options):
     self.options = options
     self.session = keystone_session_v3(options)
-    self.nova = novaclient.client.Client('2.79', session=self.session)
-    self.neutron = neutronclient.Client('2', session=self.session)
-    self.keystone = keystoneclientv3.Client(session=self.session)
+    self.nova = novaclient.client.Client('2.79', session=self.session, **endpoint_arguments(options, 'endpoint_type'))
+    self.neutron = neutronclient.Client('2', session=self.session, **endpoint_arguments(options, 'endpoint_type'))
+    self.keystone = keystoneclientv3.Client(session=self.session, **endpoint_arguments(options))
 
   def instance_status(self):
     instance = self.nova.servers.get(self.instance.id)
@@ -338,16 +469,21 @@ class OSInstanceCheck(TimeStateMachine):
   def floating_ip_ping(self):
     count = self.options.ping_count
     interval = self.options.ping_interval
+    remaining = DEADLINE.remaining()
+    # ping -w stops ping after that many seconds whatever the count
+    ping_deadline = '' if remaining is None else ' -w{0}'.format(max(1, int(remaining)))
     if hasattr(self, 'fip'):
-     status = os.system('ping -qA -c{0} -i{1} {2}'.format(count, interval, self.fip['floatingip']['floating_ip_address']))
+     status = os.system('ping -qA -c{0} -i{1}{2} {3}'.format(count, interval, ping_deadline, self.fip['floatingip']['floating_ip_address']))
      if status != 0:
+      if DEADLINE.expired():
+        raise DEADLINE.exceeded()
       raise InstanceNotPingableException(status=status)
 
   def wait_instance_is_available(self):
-    inc = 0
-    while (inc < self.options.wait):
-      inc += 1
-      time.sleep(1)
+    wait_until = time.time() + self.options.wait
+    status = None
+    while time.time() < wait_until:
+      time.sleep(min(1, DEADLINE.remaining() or 1))
       status = self.instance_status()
       if status == STATUS_INSTANCE_ACTIVE:
         return
@@ -391,29 +527,38 @@ class OSInstanceCheck(TimeStateMachine):
   def execute(self):
     results = dict()
     try:
+      DEADLINE.enter('check_admin')
       self.raise_if_admin()
+      DEADLINE.enter('delete_instance')
       self.delete_orphaned_instances()
       results['10_delete_instance_ms'] = self.time_diff()
       if self.options.no_ping == False:
+        DEADLINE.enter('delete_floatingip')
         self.delete_orphaned_floating_ips()
         results['20_delete_floatingip_ms'] = self.time_diff()
+      DEADLINE.enter('create_instance')
       self.instance_create()
       results['30_create_instance_ms'] = self.time_diff()
+      DEADLINE.enter('instance_available')
       self.wait_instance_is_available()
       results['40_instance_available_ms'] = self.time_diff()
       if self.options.no_ping == False:
+        DEADLINE.enter('attach_floatingip')
         self.instance_attach_floating_ip()
         results['50_attach_floatingip_ms'] = self.time_diff()
+        DEADLINE.enter('ping_instance')
         self.floating_ip_ping()
         results['60_ping_instance_ms'] = self.time_diff()
 
-    except:
+    except DeadlineExceededException as e:
+      e.stats = results
       raise
     finally:
       # We suspect the ordering is important here.
       # The working assumption is that sometimes instance_destroy()
       # takes tool long or fails, and that this might break things.
       # Now we run it last.
+      DEADLINE.cleanup()
       self.floating_ip_delete()
       results['70_delete_floatingip_ms'] = self.time_diff()
       self.instance_destroy()
@@ -429,7 +574,7 @@ class OSGhostInstanceCheck():
   options = dict()
 
   def __init__(self, options):
-    self.nova = novaclient.client.Client('2.79', session=keystone_session_v3(options))
+    self.nova = novaclient.client.Client('2.79', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def get_nova_instance_list(self, status=None):
 
@@ -502,13 +647,19 @@ class OSGhostInstanceCheck():
     for host in hosts:
       try:
         logging.info('ssh to: ' + host)
-        ssh.connect(host)
-        stdin, stdout, stderr = ssh.exec_command(virshList)
+        DEADLINE.enter('ssh to ' + host)
+        timeout = DEADLINE.remaining()
+        ssh.connect(host, timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+        stdin, stdout, stderr = ssh.exec_command(virshList, timeout=DEADLINE.remaining())
         for line in stdout.readlines():
           instance = line.strip()
           # Last line is always empty
           if len(instance) > 0:
             instances.append([line.strip(), host])
+      except socket.timeout:
+        if DEADLINE.expired():
+          raise DEADLINE.exceeded()
+        raise
       except socket.gaierror as e:
         logging.warn('unable to connect to {0}'.format(host))
         logging.warn('{0}: {1}'.format(e.__class__.__name__, e))
@@ -608,8 +759,10 @@ class OSGhostVolumeCheck():
     for host in hosts:
       try:
         logging.info('ssh to: ' + host)
-        ssh.connect(host)
-        stdin, stdout, stderr = ssh.exec_command(lvsCommand)
+        DEADLINE.enter('ssh to ' + host)
+        timeout = DEADLINE.remaining()
+        ssh.connect(host, timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+        stdin, stdout, stderr = ssh.exec_command(lvsCommand, timeout=DEADLINE.remaining())
         for line in stdout.readlines():
           '''
           Example line:
@@ -617,6 +770,10 @@ class OSGhostVolumeCheck():
           '''
           volumeId = line.split('-',1)[1]
           volumes.append([ volumeId, host ])
+      except socket.timeout:
+        if DEADLINE.expired():
+          raise DEADLINE.exceeded()
+        raise
       except socket.gaierror as e:
         logging.warn('unable to connect to {0}'.format(host))
         logging.warn('{0}: {1}'.format(e.__class__.__name__, e))
@@ -659,7 +816,7 @@ class OSGhostNodeCheck():
   options = dict()
 
   def __init__(self, options):
-    self.nova = novaclient.client.Client('2.79', session=keystone_session_v3(options))
+    self.nova = novaclient.client.Client('2.79', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def check_bad_hosts(self):
     services = self.nova.services.list()
@@ -689,7 +846,19 @@ class OSL3Agent():
   options = dict()
 
   def __init__(self, options):
-    self.neutron = neutronclient.Client('2', session=keystone_session_v3(options))
+    self.neutron = neutronclient.Client('2', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
+
+  def get_routed_hosts(self, hosts):
+    '''
+    Return the hosts that still have router ports bound to them. All hosts
+    are looked up with a single port listing.
+    '''
+    if not hosts:
+      return set()
+    ports = self.neutron.list_ports(**{"binding:host_id" : hosts,
+                                       "device_owner" : ["network:router_gateway", "network:router_interface"],
+                                       "fields" : ["binding:host_id"]})
+    return set(port['binding:host_id'] for port in ports['ports'])
 
   def check_bad_l3_agents(self):
     err_l3agents = list()
@@ -698,6 +867,8 @@ class OSL3Agent():
     l3agents = self.neutron.list_agents(agent_type='L3 agent')
 
     if 'agents' in l3agents:
+      routed_hosts = self.get_routed_hosts([agent['host'] for agent in l3agents['agents']
+                                            if agent['alive'] == True and agent['admin_state_up'] == False])
       for agent in l3agents['agents']:
         if agent['alive'] == True and agent['admin_state_up'] == True:
           OK = 1
@@ -706,8 +877,7 @@ class OSL3Agent():
         elif agent['alive'] == False and agent['admin_state_up'] == True:
           CRITICAL = 1
         elif agent['alive'] == True and agent['admin_state_up'] == False:
-          ports = self.neutron.list_ports(**{"binding:host_id" : agent['host'], "device_owner" : ["network:router_gateway", "network:router_interface"]})
-          if ports['ports']:
+          if agent['host'] in routed_hosts:
             CRITICAL = 1
           else:
             OK = 1
@@ -743,7 +913,7 @@ class OSVolumeErrorCheck():
 
   def __init__(self, options):
     self.options = options
-    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options))
+    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def check_volume_errors(self):
 
@@ -775,8 +945,8 @@ class OSCapacityCheck():
   def __init__(self, options):
     self.options = options
     self.session = keystone_session_v3(options)
-    self.neutron = neutronclient.Client('2', session=self.session )
-    self.nova = novaclient.client.Client('2.79', session=self.session)
+    self.neutron = neutronclient.Client('2', session=self.session, **endpoint_arguments(options, 'endpoint_type'))
+    self.nova = novaclient.client.Client('2.79', session=self.session, **endpoint_arguments(options, 'endpoint_type'))
 
   def check_network_capacity(self):
     vlan_params = { 'provider:network_type':'vlan', }
@@ -837,7 +1007,7 @@ class OSCapacityCheck():
 
     SERVICE_TENANT_NAME="service" # This is a legacy HACK and only work in cPouta
     PUBLIC_NET_NAME="public"
-    service_project_id = get_project_id(self.session, SERVICE_TENANT_NAME)
+    service_project_id = get_project_id(self.session, SERVICE_TENANT_NAME, self.options)
     public_network_id = self.neutron.list_networks(project_id=service_project_id,
                          name=PUBLIC_NET_NAME)['networks'][0]['id']
 
@@ -932,11 +1102,15 @@ class OSCapacityCheck():
   def execute(self):
     results = dict()
     try:
+      DEADLINE.enter('network_capacity')
       results.update(self.check_network_capacity())
       if self.options.no_ping == False:
+        DEADLINE.enter('floating_ips')
         results.update(self.check_floating_ips())
+      DEADLINE.enter('host_aggregate_capacities')
       results.update(self.check_host_aggregate_capacities())
-    except:
+    except DeadlineExceededException as e:
+      e.stats = results
       raise
     return results
 
@@ -945,10 +1119,13 @@ class OSCapacityCheckNetwork(OSCapacityCheck):
   def execute(self):
     results = dict()
     try:
+      DEADLINE.enter('network_capacity')
       results.update(self.check_network_capacity())
       if self.options.no_ping == False:
+        DEADLINE.enter('floating_ips')
         results.update(self.check_floating_ips())
-    except:
+    except DeadlineExceededException as e:
+      e.stats = results
       raise
     return results
 
@@ -979,7 +1156,7 @@ class OSBarbicanAvailability():
   options = dict()
 
   def __init__(self, options):
-    self.barbican = barbicanclient.Client(session=keystone_session_v3(options))
+    self.barbican = barbicanclient.Client(session=keystone_session_v3(options), **endpoint_arguments(options))
 
 
   def get_barbican_images(self):
@@ -1002,7 +1179,7 @@ class OSCinderAvailability():
   options = dict()
 
   def __init__(self, options):
-    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options))
+    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def get_cinder_volumes(self):
     search_opts = { }
@@ -1020,7 +1197,7 @@ class OSCinderAvailability():
 class OSCinderServiceAvailability():
 
   def __init__(self, options):
-    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options))
+    self.cinder = cinderclient.client.Client('3', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def check_cinder_services(self):
     warning_msgs = []
@@ -1054,7 +1231,7 @@ class OSGlanceAvailability():
   options = dict()
 
   def __init__(self, options):
-    self.glance = glanceclient.Client('2', session=keystone_session_v3(options))
+    self.glance = glanceclient.Client('2', session=keystone_session_v3(options), **endpoint_arguments(options))
 
   def get_glance_images(self):
     image_generator = self.glance.images.list()
@@ -1084,7 +1261,7 @@ class OSHeatAvailability():
     creds = OSCredentials(options).provide_keystone()
     loader = loading.get_plugin_loader('password')
     auth = loader.load_from_options(**creds)
-    sessionx = session.Session(auth=auth)
+    sessionx = DeadlineSession(auth=auth)
     if LOCAL_DEBUG:
       print(creds)
 #    self.heat = heatclient.Client('1', session=sessionx)
@@ -1108,7 +1285,7 @@ class OSKeystoneAvailability():
   options = dict()
 
   def __init__(self, options):
-    self.keystone = keystoneclientv3.Client(session=keystone_session_v3(options))
+    self.keystone = keystoneclientv3.Client(session=keystone_session_v3(options), **endpoint_arguments(options))
 
   def get_keystone(self):
     user = self.keystone.projects.list()
@@ -1128,7 +1305,7 @@ class OSMagnumAvailability():
   options = dict()
 
   def __init__(self, options):
-    self.magnum = magnumclient.Client('1', session=keystone_session_v3(options))
+    self.magnum = magnumclient.Client('1', session=keystone_session_v3(options), **endpoint_arguments(options))
 
   def get_magnum_clusters(self):
     vols = self.magnum.clusters.list()
@@ -1150,7 +1327,7 @@ class OSNeutronAvailability():
   options = dict()
 
   def __init__(self, options):
-    self.neutron = neutronclient.Client('2', session=keystone_session_v3(options))
+    self.neutron = neutronclient.Client('2', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def get_neutron_subnetpools(self):
     vols = self.neutron.list_subnetpools()
@@ -1173,7 +1350,7 @@ class OSNovaAvailability():
   options = dict()
 
   def __init__(self, options):
-    self.nova = novaclient.client.Client('2', session=keystone_session_v3(options))
+    self.nova = novaclient.client.Client('2', session=keystone_session_v3(options), **endpoint_arguments(options, 'endpoint_type'))
 
   def get_nova_images(self):
     vols = self.nova.servers.list()
@@ -1189,6 +1366,82 @@ class OSNovaAvailability():
       raise
 
 
+# Check command name -> check class
+OS_CHECK = {
+  'volume'  : OSVolumeCheck,
+  'instance': OSInstanceCheck,
+  'ghostinstance': OSGhostInstanceCheck,
+  'ghostvolumessh': OSGhostVolumeCheck,
+  'ghostvolume': OSVolumeErrorCheck,
+  'ghostnodes': OSGhostNodeCheck,
+  'l3agent': OSL3Agent,
+  'capacity': OSCapacityCheck,
+  'barbican': OSBarbicanAvailability,
+  'cinder': OSCinderAvailability,
+  'cinder_service': OSCinderServiceAvailability,
+  'glance': OSGlanceAvailability,
+  'heat':   OSHeatAvailability,
+  'magnum': OSMagnumAvailability,
+  'neutron': OSNeutronAvailability,
+  'nova': OSNovaAvailability,
+  'keystone': OSKeystoneAvailability,
+  'capacitynetwork': OSCapacityCheckNetwork,
+  'capacitycpus': OSCapacityCheckCPUs,
+  'capacityram': OSCapacityCheckRAM,
+}
+
+# Maximum number of API requests per check command, authentication included.
+# The count must not grow with the size of the cloud, this is enforced by
+# benchmarks/check_api_budget.py. Commands without an entry are not run there.
+OS_CHECK_API_BUDGET = {
+  'volume': 5,
+  'instance': 10,
+  'ghostvolume': 2,
+  'ghostnodes': 2,
+  'l3agent': 3,
+  'capacity': 15,
+  'cinder': 2,
+  'cinder_service': 2,
+  'glance': 3,
+  'heat': 0,
+  'neutron': 2,
+  'nova': 2,
+  'keystone': 2,
+  'capacitynetwork': 12,
+  'capacitycpus': 4,
+  'capacityram': 4,
+}
+
+# Exit state of every exception that a check reports instead of crashing
+EXCEPTION_STATE = [
+  (cinderclient.exceptions.BadRequest, NAGIOS_STATE_WARNING),
+  (cinderclient.exceptions.Unauthorized, NAGIOS_STATE_UNKNOWN),
+  (CredentialsMissingException, NAGIOS_STATE_UNKNOWN),
+  (CloudsFileException, NAGIOS_STATE_UNKNOWN),
+  (InstanceNotPingableException, NAGIOS_STATE_WARNING),
+  (LostInstancesException, NAGIOS_STATE_WARNING),
+  (HostsEnabledAndDownException, NAGIOS_STATE_WARNING),
+  (HostNotAvailableException, NAGIOS_STATE_WARNING),
+  (VolumeErrorException, NAGIOS_STATE_WARNING),
+  (CinderServiceDownException, NAGIOS_STATE_CRITICAL),
+  (CinderServiceDisabledException, NAGIOS_STATE_WARNING),
+  (NeutronL3AgentsUnknown, NAGIOS_STATE_UNKNOWN),
+  (NeutronL3AgentsWarning, NAGIOS_STATE_WARNING),
+  (NeutronL3AgentsCritical, NAGIOS_STATE_CRITICAL),
+  (DeadlineExceededException, NAGIOS_STATE_CRITICAL),
+]
+HANDLED_EXCEPTIONS = tuple(exception for exception, state in EXCEPTION_STATE)
+
+# Order used to pick the worst state of several clouds
+NAGIOS_STATE_SEVERITY = [NAGIOS_STATE_OK, NAGIOS_STATE_UNKNOWN,
+                         NAGIOS_STATE_WARNING, NAGIOS_STATE_CRITICAL]
+
+def exception_state(e):
+  for exception, state in EXCEPTION_STATE:
+    if isinstance(e, exception):
+      return state
+  return NAGIOS_STATE_UNKNOWN
+
 def parse_command_line():
   '''
   Parse command line and execute check according to command line arguments
@@ -1218,6 +1471,11 @@ def parse_command_line():
   parser.add_option("-z", "--no-ping", dest='no_ping', action='store_true', help='no ping test')
   parser.add_option("-j", "--milliseconds", dest='milliseconds', action='store_true', help='Show time in milliseconds')
   parser.add_option("-k", "--only-windows", dest='only_windows', action='store_true', help='Option to only print windows aggregate OSCapacity as a way to combat 1024 character limit in check_nrpe')
+  add_profile_arguments(parser)
+  parser.add_option("-C", "--clouds", dest='clouds', help='clouds.yaml style file; run the check against every cloud in it concurrently')
+  parser.add_option("-r", "--cloud", dest='cloud_names', action='append', help='with --clouds, only check this cloud. Can be repeated')
+  parser.add_option("-x", "--concurrency", dest='concurrency', type='int', help='with --clouds, number of clouds checked at the same time (default %d)' % DEFAULT_CONCURRENCY)
+  parser.add_option("-D", "--deadline", dest='deadline', type='float', help='seconds the whole check may take, shared by all API calls, polling, ssh and ping. Set it a few seconds below the NRPE command_timeout')
 
   (options, args) = parser.parse_args()
 
@@ -1249,6 +1507,12 @@ def parse_command_line():
     USE_SECONDS = False
   if not options.only_windows:
     options.only_windows = DEFAULT_ONLY_WINDOWS
+  if not options.deadline:
+    options.deadline = DEFAULT_DEADLINE
+  if not options.concurrency:
+    options.concurrency = DEFAULT_CONCURRENCY
+  global DEADLINE
+  DEADLINE = Deadline(options.deadline)
 
   if len(args) == 0:
     sys.exit(NAGIOS_STATE_UNKNOWN, 'Command argument missing! Use --help.')
@@ -1260,29 +1524,8 @@ def execute_check(options, args):
   Execute check given as command argument
   '''
   command = args.pop()
-  os_check = {
-    'volume'  : OSVolumeCheck,
-    'instance': OSInstanceCheck,
-    'ghostinstance': OSGhostInstanceCheck,
-    'ghostvolumessh': OSGhostVolumeCheck,
-    'ghostvolume': OSVolumeErrorCheck,
-    'ghostnodes': OSGhostNodeCheck,
-    'l3agent': OSL3Agent,
-    'capacity': OSCapacityCheck,
-    'barbican': OSBarbicanAvailability,
-    'cinder': OSCinderAvailability,
-    'cinder_service': OSCinderServiceAvailability,
-    'glance': OSGlanceAvailability,
-    'heat':   OSHeatAvailability,
-    'magnum': OSMagnumAvailability,
-    'neutron': OSNeutronAvailability,
-    'nova': OSNovaAvailability,
-    'keystone': OSKeystoneAvailability,
-    'capacitynetwork': OSCapacityCheckNetwork,
-    'capacitycpus': OSCapacityCheckCPUs,
-    'capacityram': OSCapacityCheckRAM,
-  }
-
+  os_check = OS_CHECK
+  DEADLINE.enter(command)
 
   if not command in os_check:
     print('Unknown command argument! Use --help.')
@@ -1290,6 +1533,119 @@ def execute_check(options, args):
 
   return os_check[command](options).execute()
 
+def cloud_options_from(name, cloud, options):
+  '''
+  Copy of the command line options with the credentials, region, interface
+  and TLS verification of one cloud of the clouds file. Keys the checks
+  cannot honour are rejected rather than ignored.
+  '''
+  unsupported = sorted(set(cloud) - set(CLOUD_KEYS))
+  auth = cloud.get('auth', {})
+  unsupported += sorted('auth.' + key for key in set(auth) - set(CLOUD_AUTH_KEYS))
+  if cloud.get('auth_type', 'password') != 'password':
+    unsupported.append('auth_type ' + str(cloud['auth_type']))
+  if str(cloud.get('identity_api_version', '3')) != '3':
+    unsupported.append('identity_api_version ' + str(cloud['identity_api_version']))
+  if unsupported:
+    raise CloudsFileException(cloud=name, reason='unsupported ' + ', '.join(unsupported))
+
+  cloud_options = copy.copy(options)
+  cloud_options.auth_url = auth.get('auth_url')
+  cloud_options.username = auth.get('username')
+  cloud_options.password = auth.get('password')
+  cloud_options.tenant = auth.get('project_name') or auth.get('tenant_name')
+  cloud_options.user_and_project_domain_name = auth.get('user_domain_name') \
+    or auth.get('domain_name') or options.user_and_project_domain_name
+  cloud_options.project_domain_name = auth.get('project_domain_name')
+  cloud_options.region_name = cloud.get('region_name')
+  cloud_options.interface = cloud.get('interface')
+  # cacert is only used when verify is not turned off, like openstacksdk
+  cloud_options.verify = cloud.get('verify', True)
+  if cloud_options.verify and cloud.get('cacert'):
+    cloud_options.verify = cloud['cacert']
+  return cloud_options
+
+def read_clouds(options):
+  '''
+  Return (label, options) for every cloud of the clouds file. The options
+  are a copy of the command line options with the cloud's settings, so
+  each cloud gets its own sessions. The label is the region_name of the
+  cloud, or its name if it has none.
+  '''
+  with open(options.clouds) as clouds_file:
+    clouds = yaml.safe_load(clouds_file)['clouds']
+  for name in options.cloud_names or []:
+    if name not in clouds:
+      raise CloudsFileException(cloud=name, reason='not found in clouds file')
+
+  labels = []
+  for name in sorted(clouds):
+    if options.cloud_names and name not in options.cloud_names:
+      continue
+    cloud = clouds[name]
+    cloud_options = cloud_options_from(name, cloud, options)
+    label = cloud.get('region_name') or name
+    # Two clouds with the same region name would mix their perfdata
+    if label in labels:
+      label = name + '_' + label
+    labels.append(label)
+    yield (label, cloud_options)
+
+def execute_check_in_cloud(command, cloud_options):
+  '''
+  Run a check and return (exit_code, stats, message) instead of exiting
+  '''
+  started = time.time()
+  try:
+    stats = OS_CHECK[command](cloud_options).execute() or dict()
+    exit_code, message = NAGIOS_STATE_OK, None
+  except HANDLED_EXCEPTIONS as e:
+    stats = getattr(e, 'stats', None) or dict()
+    exit_code, message = exception_state(e), str(e)
+  except SystemExit as e:
+    stats = dict()
+    exit_code, message = e.code, 'check exited with %s' % e.code
+  except Exception as e:
+    stats = dict()
+    exit_code, message = NAGIOS_STATE_UNKNOWN, "{0}: {1}".format(e.__class__.__name__, e)
+  elapsed = time.time() - started
+  if USE_SECONDS:
+    stats['seconds_used'] = int(elapsed)
+  else:
+    stats['milliseconds_used'] = int(1000 * elapsed)
+  return (exit_code, stats, message)
+
+def execute_check_in_clouds(options, args):
+  '''
+  Execute the check against every cloud of the clouds file, at most
+  options.concurrency at a time. Returns the worst exit code, the perfdata
+  of all clouds prefixed with their label, and one message per cloud that
+  was not OK.
+  '''
+  command = args.pop()
+  if not command in OS_CHECK:
+    print('Unknown command argument! Use --help.')
+    sys.exit(NAGIOS_STATE_UNKNOWN)
+  DEADLINE.enter(command)
+
+  clouds = list(read_clouds(options))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+    futures = [(label, executor.submit(execute_check_in_cloud, command, cloud_options))
+               for (label, cloud_options) in clouds]
+
+  exit_code = NAGIOS_STATE_OK
+  results = dict()
+  messages = []
+  for (label, future) in futures:
+    (cloud_exit_code, stats, message) = future.result()
+    if NAGIOS_STATE_SEVERITY.index(cloud_exit_code) > NAGIOS_STATE_SEVERITY.index(exit_code):
+      exit_code = cloud_exit_code
+    for key in stats:
+      results[label + '_' + key] = stats[key]
+    if message:
+      messages.append('%s: %s' % (label, message))
+  return (exit_code, results, messages)
+
 def exit_with_stats(exit_code=NAGIOS_STATE_OK, stats=dict()):
   '''
   Exits with the specified exit_code and outputs any stats in the format
@@ -1333,49 +1689,19 @@ def main():
     (options, args) = parse_command_line()
     if options.debug:
       logging.basicConfig(level=logging.DEBUG)
+    start_profiler(options, args[-1])
 
     # Call the check
+    if options.clouds:
+      (exit_code, results, messages) = execute_check_in_clouds(options, args)
+      for message in messages:
+        print(message)
+      exit_with_stats(exit_code, results)
     results = execute_check(options, args)
 
-  except cinderclient.exceptions.BadRequest as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except cinderclient.exceptions.Unauthorized as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_UNKNOWN)
-  except CredentialsMissingException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_UNKNOWN)
-  except InstanceNotPingableException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except LostInstancesException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except HostsEnabledAndDownException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except HostNotAvailableException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except VolumeErrorException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except CinderServiceDownException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_CRITICAL)
-  except CinderServiceDisabledException as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except NeutronL3AgentsUnknown as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_UNKNOWN)
-  except NeutronL3AgentsWarning as e:
-    print(e)
-    exit_with_stats(NAGIOS_STATE_WARNING)
-  except NeutronL3AgentsCritical as e:
+  except HANDLED_EXCEPTIONS as e:
     print(e)
-    exit_with_stats(NAGIOS_STATE_CRITICAL)
+    exit_with_stats(exception_state(e), getattr(e, 'stats', None))
   #except Exception as e:
   #  print "{0}: {1}".format(e.__class__.__name__, e)
   #  exit_with_stats(NAGIOS_STATE_CRITICAL)
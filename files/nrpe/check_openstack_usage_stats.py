@@ -6,25 +6,70 @@
 #  * Number of users with at least one VM
 #  * Number of CSC users with at least one VM
 #  * Number of running VMs owned by CSC users
+#  * Users, users with VMs and VMs per user domain and email suffix
+#  * VMs, vCPUs and RAM per flavor
+#  * Number and total size of volumes, optionally per volume type and backend
+#
+# With --snapshot, the servers are kept in a file and only the servers
+# changed since the previous run are fetched.
 #
 # Author: CSC Cloud Team
 
 import os
+import os.path
 import time
 import sys
 import argparse
-from functools import reduce
+import collections
+import json
+import logging
+import tempfile
 
 from openstack_credentials import OpenStackCredentials as oscred
-from novaclient.exceptions import NotFound as NovaNotFound
+from cinderclient import exceptions as cinder_exceptions
+from check_profile import add_profile_arguments, start_profiler
 
 NAGIOS_STATE_OK       = 0
 NAGIOS_STATE_WARNING  = 1
 NAGIOS_STATE_CRITICAL = 2
 NAGIOS_STATE_UNKNOWN  = 3
 
-def get_all_servers(nova):
-    return nova.servers.list(search_opts={'all_tenants': True})
+# Servers embed their flavor details since 2.47, hypervisor statistics
+# are gone after 2.87
+NOVA_MICROVERSION = '2.79'
+SERVER_PAGE_SIZE = 1000
+# The volume summary API is there since 3.12, the volume list is read with
+# the base version every Cinder v3 API accepts
+CINDER_MICROVERSION = '3.12'
+CINDER_LIST_MICROVERSION = '3.0'
+VOLUME_PAGE_SIZE = 1000
+UNKNOWN_BACKEND = 'unknown'
+DEFAULT_SNAPSHOT_RESYNC = 24 * 3600
+# Servers changed this many seconds before the previous update are fetched
+# again, in case the clocks of nova and this host differ
+CHANGES_SINCE_OVERLAP = 300
+CSC_EMAIL = '@csc.fi'
+DEFAULT_EMAIL_SUFFIXES = 'csc.fi'
+OTHER_EMAIL_SUFFIX = 'other'
+
+def get_all_servers(nova, page_size=SERVER_PAGE_SIZE, changes_since=None):
+    '''
+    Yield the servers of all projects, holding one page of them in memory
+    at a time. With changes_since, only the servers changed since then,
+    deleted ones included.
+    '''
+    search_opts = {'all_tenants': True}
+    if changes_since:
+        search_opts['changes-since'] = changes_since
+    marker = None
+    while True:
+        page = nova.servers.list(search_opts=search_opts,
+                                 limit=page_size, marker=marker)
+        if not page:
+            return
+        for server in page:
+            yield server
+        marker = page[-1].id
 
 def get_list_of_users_with_vms(nova):
     return list(map(lambda x: x.user_id, get_all_servers(nova)))
@@ -32,33 +77,184 @@ def get_list_of_users_with_vms(nova):
 def get_number_of_users_with_vms(nova):
     return len(set(get_list_of_users_with_vms(nova)))
 
+def is_real_user(user):
+    email = getattr(user, 'email', None)
+    return 'trng' not in user.name and email is not None and \
+        '@localhost' not in email
+
 def get_real_users(keystone, user_domain_name="default"):
     user_domain_id = keystone.domains.find(name=user_domain_name).id
-    all_users = keystone.users.list(domain=user_domain_id)
-
-    users = list(filter(lambda user: 'trng' not in user.name, all_users))
-    users = list(filter(lambda user: hasattr(user, 'email'), users))
-    users = list(filter(lambda user: '@localhost' not in user.email, users))
-
-    return users
-
-def get_vm_user_ids(servers):
-    return list(map(lambda x: x.user_id, servers))
-
-def get_csc_user_ids(users):
-    csc_users = list(filter(lambda user: '@csc.fi' in user.email, users))
-    return list(map(lambda x: x.id, csc_users))
-
-def get_csc_user_ids_with_vms(servers, users):
-    csc_vm_users = list()
-    vm_user_ids = get_vm_user_ids(servers)
-    csc_user_ids = get_csc_user_ids(users)
-
-    for user_id in vm_user_ids:
-        if user_id in csc_user_ids:
-            csc_vm_users.append(user_id)
-
-    return csc_vm_users
+    return filter(is_real_user, keystone.users.list(domain=user_domain_id))
+
+def email_suffix_group(email, email_suffixes):
+    '''
+    The first of email_suffixes that the domain of email is or is a
+    subdomain of, or OTHER_EMAIL_SUFFIX
+    '''
+    domain = email.rpartition('@')[2].lower()
+    for suffix in email_suffixes:
+        if domain == suffix or domain.endswith('.' + suffix):
+            return suffix
+    return OTHER_EMAIL_SUFFIX
+
+def get_user_index(keystone, user_domain_names, email_suffixes):
+    '''
+    Map the id of every real user of the domains to a tuple of its domain
+    name, email suffix group and whether it is a CSC user
+    '''
+    index = dict()
+    # Email domains repeat a lot, match each of them only once
+    groups = dict()
+    for domain in user_domain_names:
+        for user in get_real_users(keystone, domain):
+            email_domain = user.email.rpartition('@')[2].lower()
+            group = groups.get(email_domain)
+            if group is None:
+                group = groups[email_domain] = email_suffix_group(user.email, email_suffixes)
+            index[user.id] = (domain, group, CSC_EMAIL in user.email)
+    return index
+
+def perfdata_name(name):
+    return str(name).replace(".", '_')
+
+def flavor_key(flavor):
+    '''
+    (name, vcpus, ram) of the flavor embedded in a server
+    '''
+    return (flavor['original_name'], flavor['vcpus'], flavor['ram'])
+
+def server_record(server):
+    '''
+    The compact form of a server used for the usage statistics: user id,
+    project id, flavor_key() and status
+    '''
+    return (server.user_id, server.tenant_id, flavor_key(server.flavor),
+            server.status)
+
+class ServerSnapshot(object):
+    '''
+    server_record() of every server by id, kept in a JSON file between runs
+    and updated with the servers changed since the previous update, deleted
+    ones included. The servers are listed in full instead when there is no
+    snapshot of this cloud or its last full listing is older than resync
+    seconds, which also corrects any drift.
+    '''
+
+    def __init__(self, path, cloud, resync=DEFAULT_SNAPSHOT_RESYNC):
+        self.path = path
+        self.cloud = cloud
+        self.resync = resync
+        self.servers = dict()
+        self.full_sync_at = None
+        self.updated_at = None
+        self.delta = 0
+        self.full_sync = False
+
+    def load(self):
+        try:
+            with open(self.path) as snapshot:
+                data = json.load(snapshot)
+        except (OSError, ValueError):
+            return
+        if data.get('cloud') != self.cloud:
+            return
+        # JSON has no tuples, flavor keys come back as lists
+        self.servers = dict((server_id, (r[0], r[1], tuple(r[2]), r[3]))
+                            for server_id, r in data['servers'].items())
+        self.full_sync_at = data['full_sync_at']
+        self.updated_at = data['updated_at']
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            (fd, path) = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as snapshot:
+                json.dump({'cloud': self.cloud, 'full_sync_at': self.full_sync_at,
+                           'updated_at': self.updated_at, 'servers': self.servers},
+                          snapshot, separators=(',', ':'))
+            os.replace(path, self.path)
+        except OSError as e:
+            logging.warning('Could not write server snapshot %s: %s', self.path, e)
+
+    def update(self, nova):
+        self.load()
+        started = time.time()
+        if self.full_sync_at is None or started - self.full_sync_at > self.resync:
+            self.servers = dict((server.id, server_record(server))
+                                for server in get_all_servers(nova))
+            self.delta = len(self.servers)
+            self.full_sync = True
+            self.full_sync_at = started
+        else:
+            changes_since = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                          time.gmtime(self.updated_at - CHANGES_SINCE_OVERLAP))
+            self.delta = 0
+            for server in get_all_servers(nova, changes_since=changes_since):
+                self.delta += 1
+                if server.status == 'DELETED':
+                    self.servers.pop(server.id, None)
+                else:
+                    self.servers[server.id] = server_record(server)
+        self.updated_at = started
+        self.save()
+
+    def perfdata(self):
+        return {"snapshot_servers": len(self.servers),
+                "snapshot_delta": self.delta,
+                "snapshot_full_sync": int(self.full_sync),
+                "snapshot_age_seconds": int(time.time() - self.full_sync_at)}
+
+def get_user_vm_usage(servers, user_index, user_domain_names, email_suffixes):
+    '''
+    Count VMs and their users in one pass over the server_record() of every
+    server, looking each owner up in user_index. Returns the usage
+    perfdata, including users, users with VMs and VMs per domain and email
+    suffix group, and the number of VMs per flavor_key().
+    '''
+    total_vms = 0
+    flavor_counts = collections.Counter()
+    users_with_vms = set()
+    csc_vms = 0
+    vms = collections.Counter()
+    for (user_id, project_id, flavor, status) in servers:
+        total_vms += 1
+        flavor_counts[flavor] += 1
+        users_with_vms.add(user_id)
+        user = user_index.get(user_id)
+        if user is None:
+            continue
+        (domain, group, csc) = user
+        vms['domain', domain] += 1
+        vms['email', group] += 1
+        csc_vms += csc
+
+    users = collections.Counter()
+    vm_users = collections.Counter()
+    csc_vm_users = 0
+    for user_id, (domain, group, csc) in user_index.items():
+        users['domain', domain] += 1
+        users['email', group] += 1
+        if user_id in users_with_vms:
+            vm_users['domain', domain] += 1
+            vm_users['email', group] += 1
+            csc_vm_users += csc
+
+    results = {"total_number_of_vms": total_vms,
+               "users_with_vms": len(users_with_vms),
+               "total_number_of_users": len(user_index),
+               "num_vms_by_csc_users": csc_vms,
+               "num_csc_users_with_vm": csc_vm_users,
+              }
+    groups = [('domain', domain) for domain in user_domain_names] + \
+             [('email', group) for group in list(email_suffixes) + [OTHER_EMAIL_SUFFIX]]
+    for group in groups:
+        name = "%s.%s" % (group[0], perfdata_name(group[1]))
+        results[name + ".users"] = users[group]
+        results[name + ".users_with_vms"] = vm_users[group]
+        results[name + ".vms"] = vms[group]
+    return (results, flavor_counts)
 
 def get_hypervisor_utilization(nova):
     hv_stats = nova.hypervisor_stats.statistics()
@@ -68,27 +264,76 @@ def get_hypervisor_utilization(nova):
 
     return (used_mem, total_mem, hv_util_percent)
 
-def get_cinder_usage(cinder):
-  search_opts = {'all_tenants': '1'}
-  vols = cinder.volumes.list(search_opts=search_opts)
-  cinder_usage_gb = reduce(lambda x, y: x + y.size, [0] + vols)
-  return cinder_usage_gb
-
-def get_per_flavor_active_vm_count(nova,servers):
-  flavor_id_dict = dict()
-  for server in servers:
-    flavor = server.flavor['id']
-    flavor_id_dict[flavor] = flavor_id_dict.get(flavor, 0) + 1
+def volume_backend(volume):
+  '''
+  Backend of a volume from its host@backend#pool
+  '''
+  host = getattr(volume, 'os-vol-host-attr:host', None) or ''
+  return host.partition('#')[0].partition('@')[2] or UNKNOWN_BACKEND
 
-  flavor_name_dict = dict()
-  for flavor in flavor_id_dict:
-     # If the flavor have been modified the name will be missing.
-     try:
-       name = nova.flavors.get(flavor)
-     except NovaNotFound:
-       continue
-     flavor_name_dict["vms." + str(name.name).replace(".", '_')] = flavor_id_dict[flavor]
-  return flavor_name_dict
+def get_cinder_usage_from_volumes(cinder, breakdown=False, page_size=VOLUME_PAGE_SIZE):
+  '''
+  Number and total size of the volumes of all projects from the volume
+  list, holding one page of it in memory at a time. With breakdown also
+  per volume type and backend. Returns (perfdata, requests made).
+  '''
+  search_opts = {'all_tenants': '1'}
+  usage = collections.Counter({"cinder_total_volumes": 0, "cinder_total_usage_gb": 0})
+  requests = 0
+  marker = None
+  while True:
+    page = cinder.volumes.list(search_opts=search_opts, limit=page_size, marker=marker)
+    requests += 1
+    if not page:
+      break
+    for volume in page:
+      usage["cinder_total_volumes"] += 1
+      usage["cinder_total_usage_gb"] += volume.size
+      if breakdown:
+        for group in [("type", volume.volume_type or 'none'), ("backend", volume_backend(volume))]:
+          name = "cinder.%s.%s" % (group[0], perfdata_name(group[1]))
+          usage[name + ".volumes"] += 1
+          usage[name + ".gb"] += volume.size
+    marker = page[-1].id
+  return (dict(usage), requests)
+
+def get_cinder_usage(openstack, breakdown=False):
+  '''
+  Number and total size of the volumes of all projects, and the number of
+  Cinder API requests it took. Uses the volume summary API, one request
+  whatever the number of volumes. The volume list is read instead when the
+  per volume type and backend breakdown is wanted, or when the summary is
+  refused by a Cinder API older than 3.12 or by policy.
+  '''
+  requests = 0
+  if not breakdown:
+    try:
+      cinder = openstack.get_cinder(CINDER_MICROVERSION)
+      summary = cinder.volumes.summary(all_tenants=True)['volume-summary']
+      return {"cinder_total_usage_gb": summary['total_size'],
+              "cinder_total_volumes": summary['total_count'],
+              "cinder_requests": 1}
+    except (cinder_exceptions.NotAcceptable, cinder_exceptions.Forbidden):
+      requests += 1
+  cinder = openstack.get_cinder(CINDER_LIST_MICROVERSION)
+  (usage, list_requests) = get_cinder_usage_from_volumes(cinder, breakdown)
+  usage["cinder_requests"] = requests + list_requests
+  return usage
+
+def get_per_flavor_active_vm_count(flavor_counts):
+  '''
+  VMs, vCPUs and RAM per flavor name and in total, from the number of VMs
+  per flavor_key()
+  '''
+  flavor_dict = collections.Counter()
+  for ((name, vcpus, ram), count) in flavor_counts.items():
+    name = perfdata_name(name)
+    flavor_dict["vms." + name] += count
+    flavor_dict["vcpus." + name] += count * vcpus
+    flavor_dict["ram_mb." + name] += count * ram
+    flavor_dict["total_vcpus"] += count * vcpus
+    flavor_dict["total_ram_mb"] += count * ram
+  return dict(flavor_dict)
 
 
 
@@ -121,10 +366,48 @@ def parse_command_line():
                       default="default")
   parser.add_argument("-d", "--user_domain_name",
                       dest='user_domain_name',
-                      help="""The domain in which the users to count are.
+                      help="""The domain in which the users to count are,
+                           or a comma separated list of them.
                            Defaults to 'default'.""",
                       required=False,
                       default="default")
+  parser.add_argument("-c", "--token_cache",
+                      dest='token_cache',
+                      help="""File to keep the Keystone token in between
+                           runs. Not used by default.""",
+                      required=False)
+  parser.add_argument("-v", "--verbose",
+                      dest='verbose', action='store_true',
+                      help="Log debug output, like API client timings.",
+                      required=False,
+                      default=False)
+  parser.add_argument("-s", "--snapshot",
+                      dest='snapshot',
+                      help="""File to keep the servers in between runs, so
+                           that only the servers changed since the previous
+                           run are fetched. Not used by default.""",
+                      required=False)
+  parser.add_argument("-r", "--snapshot_resync",
+                      dest='snapshot_resync', type=int,
+                      help="""Seconds after which the snapshot is replaced
+                           by a full server listing. Defaults to %d.""" % DEFAULT_SNAPSHOT_RESYNC,
+                      required=False,
+                      default=DEFAULT_SNAPSHOT_RESYNC)
+  parser.add_argument("-b", "--volume_breakdown",
+                      dest='volume_breakdown', action='store_true',
+                      help="""Also report the volumes and their size per
+                           volume type and backend. Needs the full volume
+                           list instead of the volume summary.""",
+                      required=False,
+                      default=False)
+  parser.add_argument("-e", "--email_suffixes",
+                      dest='email_suffixes',
+                      help="""Comma separated email domains to break users
+                           and VMs down by, other users are counted as
+                           'other'. Defaults to '%s'.""" % DEFAULT_EMAIL_SUFFIXES,
+                      required=False,
+                      default=DEFAULT_EMAIL_SUFFIXES)
+  add_profile_arguments(parser)
 
   args = parser.parse_args()
 
@@ -163,6 +446,9 @@ def main():
     results = dict()
 
     options = parse_command_line()
+    if options.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    start_profiler(options, 'usagestats')
 
     cred = dict()
     cred['auth_url']   = options.auth_url
@@ -170,34 +456,35 @@ def main():
     cred['password']   = options.password
     cred['project_name'] = options.project_name
     cred['domain_name'] = options.auth_domain_name
+    cred['token_cache'] = options.token_cache
 
     openstack = oscred(**cred)
-    nova = openstack.get_nova()
+    nova = openstack.get_nova(NOVA_MICROVERSION)
     keystone = openstack.get_keystone()
-    cinder = openstack.get_cinder()
-    get_total_cinder_usage = get_cinder_usage(cinder)
-    all_servers = get_all_servers(nova)
-    all_users = get_real_users(keystone, options.user_domain_name)
-
-    total_number_of_vms = len(all_servers)
-    users_with_vms = len(set(get_vm_user_ids(all_servers)))
-    total_number_of_users = len(all_users)
-    csc_user_ids_with_vms = get_csc_user_ids_with_vms(all_servers, all_users)
-    num_vms_by_csc_users = len(csc_user_ids_with_vms)
-    num_csc_users_with_vm = len(set(csc_user_ids_with_vms))
+    cinder_usage = get_cinder_usage(openstack, options.volume_breakdown)
+    user_domain_names = [d.strip() for d in options.user_domain_name.split(',') if d.strip()]
+    email_suffixes = [s.strip().lower().lstrip('@') for s in options.email_suffixes.split(',') if s.strip()]
+    user_index = get_user_index(keystone, user_domain_names, email_suffixes)
+    if options.snapshot:
+        snapshot = ServerSnapshot(options.snapshot, options.auth_url,
+                                  options.snapshot_resync)
+        snapshot.update(nova)
+        servers = snapshot.servers.values()
+    else:
+        servers = (server_record(server) for server in get_all_servers(nova))
+    (usage, flavor_counts) = get_user_vm_usage(servers, user_index,
+                                               user_domain_names, email_suffixes)
 
     (used_mem, total_mem, hv_util_percent) = get_hypervisor_utilization(nova)
 
-    results = get_per_flavor_active_vm_count(nova,all_servers)
-    results.update({"total_number_of_vms": total_number_of_vms,
-                    "users_with_vms": users_with_vms,
-                    "total_number_of_users": total_number_of_users,
-                    "num_vms_by_csc_users": num_vms_by_csc_users,
-                    "num_csc_users_with_vm": num_csc_users_with_vm,
-                    "hypervisor_used_mem": used_mem,
+    results = get_per_flavor_active_vm_count(flavor_counts)
+    results.update(usage)
+    results.update(cinder_usage)
+    if options.snapshot:
+        results.update(snapshot.perfdata())
+    results.update({"hypervisor_used_mem": used_mem,
                     "hypervisor_total_mem": total_mem,
                     "hypervisor_util_percent": hv_util_percent,
-                    "cinder_total_usage_gb": get_total_cinder_usage,
                    })
 
     exit_with_stats(NAGIOS_STATE_OK, results)
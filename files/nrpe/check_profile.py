@@ -0,0 +1,140 @@
+# Helper for profiling a single run of a check script.
+#
+# Enabled with --profile DIR in the scripts that import it. One run writes,
+# under DIR, files named <script>-<command>-<timestamp>-<pid> with suffix:
+#
+#  .pstats     cProfile dump of the main thread, read with python -m pstats
+#  .collapsed  wall clock stack samples of all threads in the collapsed
+#              format of flamegraph.pl and speedscope
+#  .memory     tracemalloc peak and top allocations (--profile-memory only)
+#
+# Nothing is printed to stdout, so the check output stays the same.
+import atexit
+import collections
+import cProfile
+import datetime
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+
+SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 25
+
+
+def add_profile_arguments(parser):
+    '''
+    Add --profile and --profile-memory to an argparse or optparse parser.
+    '''
+    add = getattr(parser, 'add_argument', None) or parser.add_option
+    add('--profile', dest='profile', metavar='DIR',
+        help='write cProfile, stack sample and optional memory reports '
+             'of this run to DIR')
+    add('--profile-memory', dest='profile_memory', action='store_true',
+        default=False,
+        help='with --profile, also trace memory allocations')
+
+
+class CheckProfiler(object):
+
+    def __init__(self, directory, command, memory=False,
+                 interval=SAMPLE_INTERVAL):
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        stamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.directory = directory
+        self.prefix = os.path.join(directory, '%s-%s-%s-%d' % (
+            script, command, stamp, os.getpid()))
+        self.memory = memory
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.samples = collections.Counter()
+        self.stopping = threading.Event()
+        self.sampler = threading.Thread(target=self.sample,
+                                        name='check-profiler', daemon=True)
+        self.running = False
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.sampler.start()
+        self.running = True
+        # The checks leave through sys.exit() from many places, so the
+        # reports are written at interpreter exit.
+        atexit.register(self.stop)
+        self.profile.enable()
+
+    def sample(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stopping.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.profile.disable()
+        self.stopping.set()
+        self.sampler.join()
+        if self.memory:
+            # Snapshot before writing the reports allocates anything
+            traced = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.profile.dump_stats(self.prefix + '.pstats')
+            with open(self.prefix + '.collapsed', 'w') as collapsed:
+                for stack, count in sorted(self.samples.items()):
+                    collapsed.write('%s %d\n' % (stack, count))
+            if self.memory:
+                self.write_memory_report(self.prefix + '.memory', traced,
+                                         snapshot)
+        except OSError as e:
+            logging.warning('Could not write profile to %s: %s',
+                            self.directory, e)
+
+    def write_memory_report(self, path, traced, snapshot):
+        current, peak = traced
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        with open(path, 'w') as report:
+            report.write('peak_bytes=%d current_bytes=%d\n\n' % (peak, current))
+            report.write('Top %d allocations by line:\n' % TRACEMALLOC_TOP)
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                report.write('%s\n' % stat)
+            report.write('\nTop %d allocations by traceback:\n' % TRACEMALLOC_TOP)
+            for stat in snapshot.statistics('traceback')[:TRACEMALLOC_TOP]:
+                report.write('\n%s\n' % stat)
+                for line in stat.traceback.format():
+                    report.write('%s\n' % line)
+
+
+def start_profiler(options, command):
+    '''
+    Start profiling when --profile was given. Returns the profiler or None.
+    '''
+    if not getattr(options, 'profile', None):
+        return None
+    profiler = CheckProfiler(options.profile, command,
+                             getattr(options, 'profile_memory', False))
+    profiler.start()
+    return profiler
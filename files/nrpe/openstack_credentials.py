@@ -1,14 +1,31 @@
 # Helper class for authenticating against Keystone and getting OpenStack API
 # objects.
 #
+# All clients share one keystoneauth Session, created on first use, so a
+# script authenticates once and reuses the connection pool of the session
+# for every API. With token_cache, the token is also kept on disk between
+# runs and used until it is about to expire.
+#
 # Authors:
 #  Risto Laurikainen
 #  Jukka Nousiainen
+import atexit
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
 from keystoneauth1.identity import v3
+from keystoneauth1 import adapter
 from keystoneauth1 import session
 from keystoneclient.v3 import client as keystone_client
 from novaclient import client as nova_client
 from cinderclient import client as cinder_client
+from glanceclient import client as glance_client
+from neutronclient.neutron import client as neutron_client
 
 class OpenStackCredentials(object):
 
@@ -17,34 +34,107 @@ class OpenStackCredentials(object):
                  username,
                  password,
                  project_name,
-                 domain_name):
+                 domain_name,
+                 token_cache=None):
         self.auth_url = auth_url
         self.username = username
         self.password = password
         self.project_name = project_name
         self.domain_name = domain_name
+        self.token_cache = token_cache
         self.auth = v3.Password(auth_url=self.auth_url,
                                 username=self.username,
                                 password=self.password,
                                 project_name=self.project_name,
                                 user_domain_name=self.domain_name,
                                 project_domain_name=self.domain_name)
-        self.session = session
+        self.session = None
+        self.lock = threading.Lock()
+        self.cached_state = None
+
+    def cache_key(self):
+        # A cached token is only used for the same user and project
+        return [self.auth_url, self.username, self.domain_name,
+                self.project_name]
+
+    def load_token(self):
+        try:
+            with open(self.token_cache) as cache:
+                cached = json.load(cache)
+        except (OSError, ValueError):
+            return
+        if cached.get('key') != self.cache_key():
+            return
+        self.cached_state = cached.get('state')
+        self.auth.set_auth_state(self.cached_state)
+
+    def save_token(self):
+        '''
+        Write the token to token_cache when it changed, readable only by
+        the owner and replaced atomically. Called at exit.
+        '''
+        state = self.auth.get_auth_state()
+        if not state or state == self.cached_state:
+            return
+        directory = os.path.dirname(os.path.abspath(self.token_cache))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            (fd, path) = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as cache:
+                json.dump({'key': self.cache_key(), 'state': state}, cache)
+            os.replace(path, self.token_cache)
+            self.cached_state = state
+        except OSError as e:
+            logging.warning('Could not write token cache %s: %s',
+                            self.token_cache, e)
+
+    def get_session(self):
+        '''
+        The Session shared by all clients. Authenticates on the first call
+        unless a valid token was cached.
+        '''
+        with self.lock:
+            if self.session is None:
+                started = time.time()
+                if self.token_cache:
+                    self.load_token()
+                    # A token refreshed during the run is saved then
+                    atexit.register(self.save_token)
+                self.session = session.Session(auth=self.auth)
+                self.auth.get_access(self.session)
+                logging.debug('Keystone session ready in %.3fs',
+                              time.time() - started)
+        return self.session
+
+    def timed_client(self, name, factory, *args, **kwargs):
+        sess = self.get_session()
+        started = time.time()
+        client = factory(*args, session=sess, **kwargs)
+        logging.debug('%s client created in %.3fs', name,
+                      time.time() - started)
+        return client
 
     def get_keystone(self):
-        sess = self.session.Session(auth=self.auth)
-        keystone = keystone_client.Client(session=sess)
+        return self.timed_client('keystone', keystone_client.Client)
 
-        return keystone
+    def get_nova(self, version="2.1"):
+        return self.timed_client('nova', nova_client.Client, version)
 
-    def get_nova(self):
-        sess = self.session.Session(auth=self.auth)
-        nova = nova_client.Client("2.1", session=sess)
+    def get_cinder(self, version="3"):
+        return self.timed_client('cinder', cinder_client.Client, version)
 
-        return nova
+    def get_glance(self, version="2"):
+        return self.timed_client('glance', glance_client.Client, version)
 
-    def get_cinder(self):
-        sess = self.session.Session(auth=self.auth)
-        cinder = cinder_client.Client("3", session=sess)
+    def get_neutron(self):
+        return self.timed_client('neutron', neutron_client.Client, '2')
 
-        return cinder
+    def get_placement(self, microversion=None):
+        '''
+        keystoneauth Adapter for the placement API, which has no client
+        library of its own
+        '''
+        return self.timed_client('placement', adapter.Adapter,
+                                 service_type='placement',
+                                 default_microversion=microversion)